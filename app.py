@@ -1,20 +1,68 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash
+from flask import (Flask, Request, current_app, render_template, request, jsonify, redirect, url_for, flash,
+                   send_from_directory, stream_with_context)
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from community_models import db, User
 import os
+import base64
+import csv
+import datetime
+import functools
+import io
+import json
+import logging
+import importlib.util
+import shutil
+import threading
+import time
+import uuid
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.http import http_date
+from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
 from PIL import Image
 import numpy as np
 import pickle
 import pandas as pd
 import history
+import history_archive
+import color_analysis
+import color_rules
+import disease_jobs
+import inference_cascade
+import metrics
+import model_sharing
+import similarity_index
+import thumbnails
+import tiled_analysis
+import tracing
+import upload_validation
 import pdf_generator
+import resumable_uploads
 import weather
   # Import our new history module
 
+class UploadRequest(Request):
+    """Request whose body limit can be raised per endpoint
+    (MAX_CONTENT_LENGTH_BY_ENDPOINT), e.g. for batches of phone photos"""
+
+    @property
+    def max_content_length(self):
+        limits = current_app.config.get('MAX_CONTENT_LENGTH_BY_ENDPOINT', {})
+        if self.endpoint in limits:
+            return limits[self.endpoint]
+        return super().max_content_length
+
 app = Flask(__name__)
+app.request_class = UploadRequest
 app.config['UPLOAD_FOLDER'] = 'uploads'
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_CONTENT_LENGTH', 16 * 1024 * 1024))
+# 20-50 phone photos (or a ZIP of them) do not fit in 16 MB
+app.config['MAX_CONTENT_LENGTH_BY_ENDPOINT'] = {
+    'classify_disease_batch': int(os.getenv('MAX_BATCH_CONTENT_LENGTH', 256 * 1024 * 1024)),
+    'classify_disease_tiled': int(os.getenv('MAX_TILED_CONTENT_LENGTH', 512 * 1024 * 1024)),
+}
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev-secret-key-change-in-production')
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('SQLALCHEMY_DATABASE_URI', 'sqlite:///community.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
@@ -28,22 +76,29 @@ login_manager.init_app(app)
 login_manager.login_view = 'login'
 login_manager.login_message = 'Please log in to access this page.'
 
+# Request latency, inference, cache and database metrics at /metrics
+metrics.init_app(app)
+# Per-request traces, served at /debug/traces in debug mode
+tracing.init_app(app)
+logger = tracing.get_logger('disease')
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
 
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'webp'}
 
-# Try to import TensorFlow
-try:
-    import tensorflow as tf
-    from tensorflow import keras
+# Check for TensorFlow without importing it. The import itself takes seconds
+# and hundreds of MB, so it is deferred until load_trained_model() needs it.
+MODEL_AVAILABLE = importlib.util.find_spec('tensorflow') is not None
+if MODEL_AVAILABLE:
+    print("[OK] TensorFlow found (loaded on demand)")
+elif model_sharing.TFLITE_AVAILABLE and os.path.exists(model_sharing.TFLITE_MODEL_PATH):
     MODEL_AVAILABLE = True
-    print("[OK] TensorFlow loaded successfully")
-except ImportError:
-    MODEL_AVAILABLE = False
+    print("[OK] TFLite runtime found (loaded on demand)")
+else:
     print("[WARNING] TensorFlow not available - using enhanced color-based classification")
 
 # Comprehensive Disease Classes (PlantVillage dataset - 38 classes)
@@ -280,6 +335,7 @@ DISEASE_INFO = {
 # Global model variable
 model = None
 model_loaded = False
+embedding_model = None
 
 def load_trained_model():
     """Try to load a pre-trained model if available"""
@@ -289,13 +345,29 @@ def load_trained_model():
         return None
     
     try:
+        load_start = time.perf_counter()
+
         model_path = 'models/plant_disease_model.h5'
         saved_model_dir = 'models/plant_disease_model'
+        tflite_path = model_sharing.TFLITE_MODEL_PATH
+        
+        # Preferred: the weights are mapped, not copied, so pre-forked
+        # workers share them (see model_sharing)
+        if model_sharing.TFLITE_AVAILABLE and os.path.exists(tflite_path):
+            print(f"[INFO] Loading TFLite model from {tflite_path}...")
+            model = model_sharing.TFLiteModel(tflite_path)
+            model_loaded = True
+            metrics.MODEL_LOAD_SECONDS.set(time.perf_counter() - load_start)
+            print("[OK] Pre-trained model (TFLite) loaded successfully!")
+            return model
+        
+        from tensorflow import keras
         
         if os.path.exists(model_path):
             print(f"[INFO] Loading model from {model_path}...")
             model = keras.models.load_model(model_path, compile=False)
             model_loaded = True
+            metrics.MODEL_LOAD_SECONDS.set(time.perf_counter() - load_start)
             print("[OK] Pre-trained model (H5) loaded successfully!")
             return model
             
@@ -303,6 +375,7 @@ def load_trained_model():
             print(f"[INFO] Loading SavedModel from {saved_model_dir}...")
             model = keras.models.load_model(saved_model_dir, compile=False)
             model_loaded = True
+            metrics.MODEL_LOAD_SECONDS.set(time.perf_counter() - load_start)
             print("[OK] Pre-trained model (SavedModel) loaded successfully!")
             return model
             
@@ -560,13 +633,68 @@ def get_fertilizer_recommendation(crop_name):
     })
 
 
-def preprocess_image_for_ml(image_path):
-    """Preprocess image for ML model prediction"""
+ML_INPUT_SIZE = (224, 224)
+_PIXEL_SCALE = np.float32(1.0 / 255.0)
+
+# Images per model.predict() call; also the largest per-thread input buffer
+# kept between requests (32 x 224 x 224 x 3 float32 = 19 MB)
+ML_BATCH_SIZE = int(os.getenv('ML_BATCH_SIZE', 32))
+
+# Per-thread float32 input buffers, reused across requests
+_ml_buffers = threading.local()
+
+def get_ml_input_buffer(batch_size=1):
+    """Return this thread's reusable (batch_size, 224, 224, 3) float32 buffer.
+
+    The buffer grows up to ML_BATCH_SIZE images; its contents are overwritten
+    by the next call on the same thread. Larger requests get a one-off array
+    so a long-lived thread does not keep it.
+    """
+    if batch_size > ML_BATCH_SIZE:
+        metrics.CACHE_REQUESTS.inc('ml_input_buffer', 'miss')
+        return np.empty((batch_size, ML_INPUT_SIZE[1], ML_INPUT_SIZE[0], 3), dtype=np.float32)
+    buf = getattr(_ml_buffers, 'batch', None)
+    if buf is None or buf.shape[0] < batch_size:
+        metrics.CACHE_REQUESTS.inc('ml_input_buffer', 'miss')
+        buf = np.empty((batch_size, ML_INPUT_SIZE[1], ML_INPUT_SIZE[0], 3), dtype=np.float32)
+        _ml_buffers.batch = buf
+    else:
+        metrics.CACHE_REQUESTS.inc('ml_input_buffer', 'hit')
+    return buf[:batch_size]
+
+def scale_pixels_into(pixels, out):
+    """uint8 pixels -> float32 in [0, 1], written straight into out"""
+    np.multiply(pixels, _PIXEL_SCALE, out=out)
+    return out
+
+def preprocess_image_for_ml(image_path, out=None):
+    """Preprocess image for ML model prediction.
+
+    Writes into out (one (224, 224, 3) float32 slot of a batch buffer) if
+    given, otherwise into this thread's reusable buffer, and returns a
+    (1, 224, 224, 3) view that is valid until the next call on this thread.
+    """
     img = Image.open(image_path).convert('RGB')
-    img = img.resize((224, 224))
-    img_array = np.array(img) / 255.0
-    img_array = np.expand_dims(img_array, axis=0)
-    return img_array
+    img = img.resize(ML_INPUT_SIZE)
+    if out is not None:
+        return scale_pixels_into(np.asarray(img), out)
+    batch = get_ml_input_buffer(1)
+    scale_pixels_into(np.asarray(img), batch[0])
+    return batch
+
+def classify_color_features(features):
+    """
+    Rule-based plant type and disease identification from color features
+    (see color_analysis.compute_color_features and the color_rules table)
+    """
+    # Full feature dumps are sampled (see tracing.FEATURE_SAMPLE_RATE)
+    if tracing.sample_features(logger):
+        tracing.event('color_features', **features)
+        tracing.log(logger, logging.INFO, 'color features', **features)
+    
+    plant_type, disease, confidence = color_rules.ACTIVE.classify(features)
+    tracing.annotate(plant_type=plant_type)
+    return disease, confidence
 
 def analyze_image_enhanced(image_path):
     """
@@ -574,375 +702,106 @@ def analyze_image_enhanced(image_path):
     More sophisticated with plant type identification
     """
     try:
-        img = Image.open(image_path).convert('RGB')
-        img_resized = img.resize((224, 224))
-        img_array = np.array(img_resized)
-        
-        # Calculate various color features
-        r = img_array[:, :, 0]
-        g = img_array[:, :, 1]
-        b = img_array[:, :, 2]
-        
-        # Color statistics
-        r_mean, g_mean, b_mean = r.mean(), g.mean(), b.mean()
-        r_std, g_std, b_std = r.std(), g.std(), b.std()
-        
-        # Color ratios
-        rg_ratio = r_mean / (g_mean + 1)
-        rb_ratio = r_mean / (b_mean + 1)
-        gb_ratio = g_mean / (b_mean + 1)
-        
-        # Overall variability
-        total_std = (r_std + g_std + b_std) / 3
-        
-        # Detect bright spots (potential diseases)
-        bright_spots = np.sum((r > 200) & (g > 200) & (b > 200))
-        total_pixels = r.size
-        bright_ratio = bright_spots / total_pixels
-        
-        # Detect dark spots (diseases)
-        dark_spots = np.sum((r < 60) & (g < 60) & (b < 60))
-        dark_ratio = dark_spots / total_pixels
-        
-        # Detect red/ripe fruit (tomatoes, apples)
-        red_fruit = np.sum((r > 140) & (r > g * 1.3) & (r > b * 1.3))
-        red_ratio = red_fruit / total_pixels
-        
-        # Detect orange colors (tomatoes, rust diseases)
-        orange_pixels = np.sum((r > 150) & (g > 80) & (g < 150) & (b < 100))
-        orange_ratio = orange_pixels / total_pixels
-        
-        # Yellow/pale colors (rust, yellowing diseases)
-        yellow_pixels = np.sum((r > 150) & (g > 130) & (b < 120))
-        yellow_ratio = yellow_pixels / total_pixels
-        
-        # Green vegetation
-        green_pixels = np.sum((g > r) & (g > b) & (g > 60))
-        green_ratio = green_pixels / total_pixels
-        
-        # Brown/tan (dead tissue, blight)
-        brown_pixels = np.sum((r > 80) & (r < 160) & (g > 60) & (g < 140) & (b < 100))
-        brown_ratio = brown_pixels / total_pixels
-        
-        print(f"\nDetailed Image Analysis:")
-        print(f"  RGB Means: R={r_mean:.1f}, G={g_mean:.1f}, B={b_mean:.1f}")
-        print(f"  Red fruit: {red_ratio:.3f}, Orange: {orange_ratio:.3f}")
-        print(f"  Yellow: {yellow_ratio:.3f}, Green: {green_ratio:.3f}, Brown: {brown_ratio:.3f}")
-        print(f"  Dark spots: {dark_ratio:.3f}, Variability: {total_std:.1f}")
-        
-        # ========== STEP 1: IDENTIFY PLANT TYPE ==========
-        
-        plant_type = "unknown"
-        
-        # Check for tomato fruit (red/orange round fruit)
-        if red_ratio > 0.2 and (orange_ratio > 0.2 and r_mean > 150):
-            plant_type = "tomato"
-            print(f"  -> Detected: TOMATO plant (red/orange fruit present)")
-        
-        # Check for apple/fruit trees (woody stems, round fruits)
-        elif red_ratio > 0.15 and green_ratio > 0.35:
-            plant_type = "apple"
-            print(f"  -> Detected: APPLE/FRUIT tree")
-        
-        # Check for Cotton (White bolls, distinctive)
-        elif bright_ratio > 0.1 and green_ratio > 0.3:
-            plant_type = "cotton"
-            print(f"  -> Detected: COTTON plant")
-
-        # Check for corn/maize (elongated leaves, yellow-green, vertical patterns)
-        elif green_ratio > 0.45 and yellow_ratio > 0.1 and r_mean < 140 and total_std < 60:
-            plant_type = "corn"
-            print(f"  -> Detected: CORN/MAIZE plant")
-
-        # Check for Rice/Wheat (Vertical grass-like, high variability due to thin leaves)
-        elif green_ratio > 0.35 and (yellow_ratio > 0.05 or brown_ratio > 0.05 or dark_ratio > 0.05) and total_std < 65:
-            if yellow_ratio > 0.15:
-                plant_type = "wheat"
-                print(f"  -> Detected: WHEAT plant")
-            else:
-                plant_type = "rice"
-                print(f"  -> Detected: RICE plant")
-        
-        # Check for Sugarcane (Tall grass)
-        elif green_ratio > 0.5 and r_mean < 120 and total_std < 50:
-            plant_type = "sugarcane"
-            print(f"  -> Detected: SUGARCANE plant")
-
-        # Check for potato (broader leaves, darker green OR TUBER)
-        elif (green_ratio > 0.55 and r_mean < 90 and brown_ratio > 0.12) or (green_ratio < 0.15 and bright_ratio > 0.3 and total_std > 40):
-            plant_type = "potato"
-            print(f"  -> Detected: POTATO plant (leaves or tuber)")
-            
-        # Check for Grape (Broad leaves, vine) - Fixed dark_ratio bug
-        elif green_ratio > 0.5 and (dark_ratio > 0.05 or brown_ratio > 0.05) and rg_ratio < 1.1:
-            plant_type = "grape"
-            print(f"  -> Detected: GRAPE vine")
-            
-        # Check for Tea/Coffee (Bushy, dark green leaves)
-        elif green_ratio > 0.6 and dark_ratio < 0.1 and r_mean < 100:
-            if brown_ratio > 0.05:
-                plant_type = "coffee"
-                print(f"  -> Detected: COFFEE plant")
-            else:
-                plant_type = "tea"
-                print(f"  -> Detected: TEA plant")
-        
-        else:
-            plant_type = "general"
-            print(f"  -> Could not determine specific plant type")
-        
-        print(f"Final plant type determination: {plant_type}")
-        
-        # ========== STEP 2: IDENTIFY DISEASE BASED ON PLANT TYPE ==========
-        
-        # TOMATO DISEASES
-        if plant_type == "tomato":
-            # Late blight - dark brown/black lesions
-            if dark_ratio > 0.05 and brown_ratio > 0.1 and total_std > 45:
-                return 'Tomato___Late_blight', 82
-            
-            # Bacterial spot - dark spots on fruit/leaves
-            elif dark_ratio > 0.03 and total_std > 50:
-                return 'Tomato___Bacterial_spot', 78
-            
-            # Early blight - brown concentric rings
-            elif brown_ratio > 0.15 and total_std > 40:
-                return 'Tomato___Early_blight', 75
-            
-            # Target spot
-            elif brown_ratio > 0.1 and dark_ratio > 0.02:
-                return 'Tomato___Target_Spot', 72
-            
-            # Septoria leaf spot
-            elif dark_ratio > 0.02 and yellow_ratio > 0.05:
-                return 'Tomato___Septoria_leaf_spot', 70
-            
-            # Yellow leaf curl virus
-            elif yellow_ratio > 0.3 and green_ratio < 0.3:
-                return 'Tomato___Tomato_Yellow_Leaf_Curl_Virus', 80
-            
-            # Leaf mold
-            elif yellow_ratio > 0.2 and brown_ratio > 0.05:
-                return 'Tomato___Leaf_Mold', 68
-            
-            # Healthy tomato
-            elif red_ratio > 0.2 and dark_ratio < 0.02:
-                return 'Tomato___healthy', 85
-            
-            # Default tomato disease
-            else:
-                return 'Tomato___Bacterial_spot', 65
-        
-        # CORN DISEASES
-        elif plant_type == "corn":
-            # Common rust - orange/yellow pustules
-            if yellow_ratio > 0.15 and orange_ratio > 0.1:
-                return 'Corn_(maize)___Common_rust_', 78
-            
-            # Northern Leaf Blight - tan elongated lesions
-            elif brown_ratio > 0.15 and total_std > 45:
-                return 'Corn_(maize)___Northern_Leaf_Blight', 75
-            
-            # Gray leaf spot
-            elif brown_ratio > 0.1 and dark_ratio > 0.05:
-                return 'Corn_(maize)___Cercospora_leaf_spot Gray_leaf_spot', 72
-            
-            # Healthy corn
-            elif green_ratio > 0.5 and dark_ratio < 0.02:
-                return 'Corn_(maize)___healthy', 85
-            
-            else:
-                return 'Corn_(maize)___Common_rust_', 68
-        
-        # POTATO DISEASES
-        elif plant_type == "potato":
-            # Tuber Rot / Hollow Heart (Low Green)
-            if green_ratio < 0.2:
-                if bright_ratio > 0.3 or brown_ratio > 0.05 or dark_ratio > 0.05:
-                     return 'Potato___Late_blight', 90 # Mapping Rot/Hollow Heart to Late Blight
-                else:
-                     return 'Potato___healthy', 80
-
-            # Late blight (Leaves)
-            if dark_ratio > 0.1 and brown_ratio > 0.15:
-                return 'Potato___Late_blight', 82
-            
-            # Early blight
-            elif brown_ratio > 0.15 and total_std > 40:
-                return 'Potato___Early_blight', 76
-            
-            # Healthy
-            elif green_ratio > 0.6:
-                return 'Potato___healthy', 85
-            
-            else:
-                return 'Potato___Early_blight', 70
-        
-        # APPLE DISEASES
-        elif plant_type == "apple":
-            # Apple scab
-            if dark_ratio > 0.05 and brown_ratio > 0.1:
-                return 'Apple___Apple_scab', 75
-            
-            # Black rot
-            elif dark_ratio > 0.1:
-                return 'Apple___Black_rot', 78
-            
-            # Cedar apple rust
-            elif orange_ratio > 0.05 and yellow_ratio > 0.1:
-                return 'Apple___Cedar_apple_rust', 72
-            
-            # Healthy
-            elif red_ratio > 0.3 or green_ratio > 0.5:
-                return 'Apple___healthy', 85
-            
-            else:
-                return 'Apple___Apple_scab', 68
-        
-        # RICE DISEASES
-        elif plant_type == "rice":
-            if brown_ratio > 0.15:
-                return 'Rice_Brown_Spot', 75
-            elif yellow_ratio > 0.2:
-                return 'Rice_Tungro', 78
-            elif total_std > 55:
-                return 'Rice_Blast', 72
-            else:
-                return 'Rice_Blast', 65
-
-        # WHEAT DISEASES
-        elif plant_type == "wheat":
-            if orange_ratio > 0.1 or yellow_ratio > 0.15:
-                return 'Wheat_Rust', 80
-            elif brown_ratio > 0.1:
-                return 'Wheat_Septoria', 75
-            else:
-                return 'Wheat_Rust', 70
-
-        # GRAPE DISEASES
-        elif plant_type == "grape":
-            if dark_ratio > 0.1:
-                return 'Grape_Black_Rot', 82
-            elif brown_ratio > 0.15:
-                return 'Esca', 75
-            elif yellow_ratio > 0.1:
-                return 'Grape___Leaf_blight_(Isariopsis_Leaf_Spot)', 72
-            else:
-                return 'Grape___healthy', 80
-
-        # TEA DISEASES
-        elif plant_type == "tea":
-            if white_spots := (bright_ratio > 0.05):
-                return 'Tea_Blister_Blight', 78
-            elif orange_ratio > 0.05:
-                return 'Tea_Red_Rust', 75  # Assuming we add info for Red Rust or map to existing
-            else:
-                return 'Tea_Blister_Blight', 65
-
-        # COFFEE DISEASES
-        elif plant_type == "coffee":
-            if orange_ratio > 0.1 or brown_ratio > 0.1:
-                return 'Coffee_Rust', 85
-            elif dark_ratio > 0.05:
-                return 'Coffee_Berry_Disease', 75 # Need to ensure info exists
-            else:
-                return 'Coffee_Rust', 70
-
-        # COTTON DISEASES
-        elif plant_type == "cotton":
-            if dark_ratio > 0.05:
-                return 'Cotton_Bacterial_Blight', 78
-            elif yellow_ratio > 0.15:
-                return 'Cotton_Curl_Virus', 75 # Need info
-            else:
-                return 'Cotton_Bacterial_Blight', 65
-
-        # SUGARCANE DISEASES
-        elif plant_type == "sugarcane":
-            if red_ratio > 0.1 or brown_ratio > 0.15:
-                return 'Sugarcane_Red_Rot', 80
-            elif orange_ratio > 0.05 or yellow_ratio > 0.1:
-                return 'Sugarcane_Rust', 75
-            else:
-                return 'Sugarcane_Red_Rot', 70
-        
-        # GENERAL CLASSIFICATION (when plant type unknown)
-        # GENERAL CLASSIFICATION (when plant type unknown)
-        else:
-            # Rust diseases (orange/reddish-brown pustules)
-            if (orange_ratio > 0.05 or (r_mean > 130 and g_mean < 120)) and total_std > 40:
-                print(f"  -> Detected: Rust pattern (orange/brown spots)")
-                return 'Corn_(maize)___Common_rust_', 75
-            
-            # Bacterial/Leaf Spots (small dark spots with yellow halos)
-            elif dark_ratio > 0.05 and yellow_ratio > 0.05 and total_std > 45:
-                print(f"  -> Detected: Bacterial/Leaf Spots")
-                return 'Tomato___Bacterial_spot', 72
-            
-            # Early Blight (concentric rings, brown spots)
-            elif brown_ratio > 0.12 and total_std > 50:
-                print(f"  -> Detected: Blight pattern")
-                return 'Potato___Early_blight', 74
-            
-            # Powdery mildew (white powdery appearance)
-            elif bright_ratio > 0.25 and r_mean > 160 and g_mean > 160:
-                print(f"  -> Detected: Powdery Mildew")
-                return 'Squash___Powdery_mildew', 78
-            
-            # Late blight (large dark lesions)
-            elif dark_ratio > 0.15 and brown_ratio > 0.1:
-                print(f"  -> Detected: Severe Blight/Rot")
-                return 'Tomato___Late_blight', 80
-            
-            # Yellowing/Chlorosis (virus or deficiency)
-            elif yellow_ratio > 0.25 and green_ratio < 0.4:
-                print(f"  -> Detected: Yellowing/Chlorosis")
-                return 'Tomato___Tomato_Yellow_Leaf_Curl_Virus', 70
-            
-            # Healthy green (dominant green, low spots)
-            elif green_ratio > 0.55 and dark_ratio < 0.03 and brown_ratio < 0.05:
-                print(f"  -> Detected: Healthy plant")
-                return 'Soybean___healthy', 85
-            
-            # Default fallback for ambiguous cases
-            else:
-                print(f"  -> Ambiguous pattern, defaulting to general leaf spot")
-                return 'Tomato___Septoria_leaf_spot', 60
-            
+        # Decode and color statistics (runs in the process pool when enabled)
+        with tracing.span('color_features'):
+            features = color_analysis.extract_features_pooled(image_path)
+        return classify_color_features(features)
+    
     except Exception as e:
-        print(f"Error in enhanced analysis: {e}")
+        tracing.log(logger, logging.WARNING, 'enhanced analysis failed', image=image_path, error=e)
         return 'Unknown Disease', 50
 
-def analyze_image(image_path):
-    """Main analysis function - tries ML model first, then fallback"""
+def _extract_features_or_none(image_path):
+    try:
+        return color_analysis.extract_features_pooled(image_path)
+    except Exception as e:
+        tracing.log(logger, logging.WARNING, 'enhanced analysis failed', image=image_path, error=e)
+        return None
+
+def analyze_images_enhanced(image_paths, executor):
+    """Batch version of analyze_image_enhanced(): features are extracted on
+    the executor, then the decision table classifies them all in one pass"""
+    features = list(executor.map(_extract_features_or_none, image_paths))
+    results = [('Unknown Disease', 50)] * len(image_paths)
+    
+    ok = [i for i, f in enumerate(features) if f is not None]
+    if ok:
+        rows = [color_rules.features_to_row(features[i]) for i in ok]
+        for i, result in zip(ok, color_rules.ACTIVE.classify_batch(rows)):
+            results[i] = result
+    return results
+
+def predict_with_model(image_path):
+    """ML stage of the cascade - (class, confidence), or None without a model"""
     global model, model_loaded
     
-    # Try ML model if available
-    if MODEL_AVAILABLE and model_loaded and model is not None:
-        try:
+    if not (MODEL_AVAILABLE and model_loaded and model is not None):
+        return None
+    
+    try:
+        with tracing.span('ml_preprocess'):
             img_array = preprocess_image_for_ml(image_path)
+        with tracing.span('ml_predict'):
             predictions = model.predict(img_array, verbose=0)
-            
-            top_idx = np.argmax(predictions[0])
-            confidence = float(predictions[0][top_idx] * 100)
-            
-            predicted_class = DISEASE_CLASSES[top_idx]
-            
-            # If confidence is too low (e.g. dummy model guessing), fallback to color analysis
-            if confidence < 50:
-                print(f"[WARNING] ML Confidence too low ({confidence:.2f}%). Falling back to enhanced analysis.")
-                return analyze_image_enhanced(image_path)
-            
-            print(f"[OK] ML Prediction: {predicted_class} ({confidence:.2f}%)")
-            
-            return predicted_class, confidence
-            
-        except Exception as e:
-            print(f"[WARNING] ML prediction failed: {e}")
-            print("  Falling back to enhanced analysis...")
+        
+        top_idx = np.argmax(predictions[0])
+        confidence = float(predictions[0][top_idx] * 100)
+        
+        return DISEASE_CLASSES[top_idx], confidence
+        
+    except Exception as e:
+        tracing.log(logger, logging.WARNING, 'ML prediction failed, falling back to enhanced analysis', error=e)
+        return None
+
+def analyze_image(image_path):
+    """Main analysis function - runs the ML model and the color heuristics
+    as a confidence-gated cascade (see inference_cascade)"""
+    return inference_cascade.run(image_path, predict_with_model, analyze_image_enhanced)
+
+def get_embedding_model():
+    """Penultimate layer of the disease network, or None without a model"""
+    global model, model_loaded, embedding_model
+    
+    if not (MODEL_AVAILABLE and model_loaded and model is not None):
+        return None
+    if embedding_model is None:
+        if isinstance(model, model_sharing.TFLiteModel):
+            embedding_model = model.with_output(model_sharing.EMBEDDING)
+        else:
+            from tensorflow import keras
+            embedding_model = keras.Model(inputs=model.inputs, outputs=model.layers[-2].output)
+    return embedding_model
+
+def embedding_space():
+    """(space name, dimension) of the embeddings currently being produced"""
+    extractor = get_embedding_model()
+    if extractor is None:
+        return 'color_hist', similarity_index.HIST_BINS ** 3
+    dim = int(np.prod(extractor.output_shape[1:]))
+    return f"model_{dim}d", dim
+
+def compute_embedding(image_path):
+    """Embedding used for similar-case search, as (space name, vector).
+
+    Uses the disease network's penultimate layer when a model is loaded,
+    otherwise a color histogram.
+    """
+    extractor = get_embedding_model()
+    if extractor is None:
+        return 'color_hist', similarity_index.color_histogram_embedding(image_path)
     
-    # Fallback to enhanced color-based analysis
-    return analyze_image_enhanced(image_path)
+    features = extractor.predict(preprocess_image_for_ml(image_path), verbose=0)
+    vector = np.asarray(features, dtype=np.float32).reshape(-1)
+    return f"model_{vector.shape[0]}d", vector
+
+def index_embedding(entry_id, image_path):
+    """Store the embedding of a history entry; failures never block analysis"""
+    try:
+        with tracing.span('embedding_index'):
+            space, vector = compute_embedding(image_path)
+            similarity_index.get_index(space, vector.shape[0]).add(entry_id, vector)
+    except Exception as e:
+        tracing.log(logger, logging.WARNING, 'could not index embedding', entry_id=entry_id, error=e)
 
 def format_disease_name(class_name):
     """Convert class name to readable format"""
@@ -953,33 +812,78 @@ def format_disease_name(class_name):
         return f"{plant} - {disease}"
     return class_name.replace('_', ' ')
 
-def get_disease_info(disease_name):
-    """Get disease information from database"""
-    # Normalize disease name for lookup
-    disease_key = disease_name.lower().replace(' ', '_').replace('-', '_').replace('(', '').replace(')', '').replace(',', '')
-    
+DEFAULT_DISEASE_INFO = {
+    'severity': 'Moderate',
+    'treatment': 'Consult with an agricultural expert or extension service for proper identification and treatment plan for this specific condition.',
+    'prevention': 'Maintain good agricultural practices including proper spacing, adequate nutrition, appropriate watering, and regular monitoring for early detection.'
+}
+
+def normalize_disease_key(disease_name):
+    """'Tomato - Late blight' / 'Tomato___Late_blight' -> 'tomato___late_blight'"""
+    return disease_name.lower().replace(' ', '_').replace('-', '_').replace('(', '').replace(')', '').replace(',', '')
+
+_disease_info_keys = [(key.lower(), info) for key, info in DISEASE_INFO.items()]
+
+# Token (longer than 3 chars) -> position of the first DISEASE_INFO key containing it
+_disease_token_index = {}
+for _position, (_key, _) in enumerate(_disease_info_keys):
+    for _part in _key.split('_'):
+        if len(_part) > 3:
+            _disease_token_index.setdefault(_part, _position)
+
+@functools.lru_cache(maxsize=1024)
+def _match_disease_info(disease_key):
+    """Fuzzy lookup for names that are not in the startup index"""
     # Try to find matching disease info
-    for key, info in DISEASE_INFO.items():
-        if key.lower() in disease_key or disease_key in key.lower():
+    for key, info in _disease_info_keys:
+        if key in disease_key or disease_key in key:
             return info
     
-    # Try partial matching
-    for key, info in DISEASE_INFO.items():
-        key_parts = key.lower().split('_')
-        disease_parts = disease_key.split('_')
-        if any(part in disease_parts for part in key_parts if len(part) > 3):
-            return info
+    # Try partial matching (first key sharing a word with the name)
+    positions = [_disease_token_index[part] for part in disease_key.split('_') if part in _disease_token_index]
+    if positions:
+        return _disease_info_keys[min(positions)][1]
     
-    # Default info
-    return {
-        'severity': 'Moderate',
-        'treatment': 'Consult with an agricultural expert or extension service for proper identification and treatment plan for this specific condition.',
-        'prevention': 'Maintain good agricultural practices including proper spacing, adequate nutrition, appropriate watering, and regular monitoring for early detection.'
-    }
+    return DEFAULT_DISEASE_INFO
+
+# Every class the model or the color heuristic can emit, raw and formatted,
+# resolved once at startup
+DISEASE_INFO_INDEX = {}
+for _name in list(DISEASE_CLASSES) + list(DISEASE_INFO) + ['Unknown Disease']:
+    for _label in (_name, format_disease_name(_name)):
+        _key = normalize_disease_key(_label)
+        DISEASE_INFO_INDEX[_key] = _match_disease_info(_key)
+
+def get_disease_info(disease_name):
+    """Get disease information from database"""
+    disease_key = normalize_disease_key(disease_name)
+    info = DISEASE_INFO_INDEX.get(disease_key)
+    if info is None:
+        metrics.CACHE_REQUESTS.inc('disease_info_index', 'miss')
+        info = _match_disease_info(disease_key)
+    else:
+        metrics.CACHE_REQUESTS.inc('disease_info_index', 'hit')
+    return info
+
+def _disease_info_memo_counts():
+    # Includes one miss per key resolved while building DISEASE_INFO_INDEX
+    cache_info = _match_disease_info.cache_info()
+    return {('disease_info_memo', 'hit'): cache_info.hits, ('disease_info_memo', 'miss'): cache_info.misses}
+
+metrics.Counter('cache_memo_requests_total', 'Memoized lookups by cache and result (hit or miss)',
+                ['cache', 'result'], callback=_disease_info_memo_counts)
+metrics.Gauge('model_loaded', 'Whether the disease model is loaded (1) or the color heuristic is used (0)',
+              callback=lambda: int(model_loaded))
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def unique_upload_name(original):
+    """Safe file name for an upload that cannot overwrite another one
+    (phones name every photo IMG_0001.jpg, the upload page sends every
+    re-encoded image as leaf.webp, ZIPs repeat names across folders)"""
+    return f"{uuid.uuid4().hex[:12]}_{secure_filename(os.path.basename(original))}"
+
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     """User registration"""
@@ -1031,11 +935,115 @@ def logout():
 def index():
     return render_template('index.html')
 
+def history_filters():
+    """Paging and filter arguments for history.get_history_page() from the query string.
+
+    start and end are dates (YYYY-MM-DD), both inclusive. Raises ValueError.
+    """
+    args = request.args
+    filters = {
+        'before_id': args.get('before', type=int),
+        'limit': args.get('limit', history.PAGE_SIZE, type=int),
+        'prediction': args.get('prediction') or None,
+        'start': None,
+        'end': None,
+    }
+    if args.get('start'):
+        filters['start'] = datetime.datetime.strptime(args['start'], '%Y-%m-%d')
+    if args.get('end'):
+        filters['end'] = datetime.datetime.strptime(args['end'], '%Y-%m-%d') + datetime.timedelta(days=1)
+    return filters
+
 @app.route('/history')
 def history_page():
-    """View analysis history"""
-    entries = history.get_history()
-    return render_template('history.html', entries=entries)
+    """View analysis history, one page at a time"""
+    try:
+        entries, cursor = history.get_history_page(**history_filters())
+    except ValueError:
+        return "Invalid date; use YYYY-MM-DD", 400
+    # Links to the next page keep the filters
+    filter_args = {key: request.args[key] for key in ('start', 'end', 'prediction', 'limit') if request.args.get(key)}
+    return render_template('history.html', entries=entries, cursor=cursor, filters=filter_args)
+
+@app.route('/api/history')
+def history_api():
+    """History as JSON: ?before=<cursor>&limit=&start=&end=&prediction="""
+    try:
+        entries, cursor = history.get_history_page(**history_filters())
+    except ValueError:
+        return jsonify({'error': 'Invalid date; use YYYY-MM-DD'}), 400
+    next_url = url_for('history_api', **dict(request.args.items(), before=cursor)) if cursor else None
+    return jsonify({'entries': entries, 'next_cursor': cursor, 'next': next_url})
+
+@app.route('/api/history/rollups')
+def history_rollups():
+    """Entry counts and mean confidence per prediction and day (or ?granularity=hour)"""
+    granularity = request.args.get('granularity', 'day')
+    try:
+        filters = history_filters()
+        rollups = history.get_rollups(granularity, filters['start'], filters['end'], filters['prediction'])
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'granularity': granularity, 'rollups': rollups})
+
+EXPORT_FIELDS = ['id', 'date', 'created_at', 'filename', 'prediction', 'confidence']
+EXPORT_FORMATS = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+# Rows are encoded into chunks of about this size before being sent
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+def export_chunks(rows, export_format):
+    """Encode rows as CSV (with a header) or JSON lines, EXPORT_CHUNK_BYTES at a time"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if export_format == 'csv' else None
+    if writer:
+        writer.writerow(EXPORT_FIELDS)
+    for row in rows:
+        if writer:
+            writer.writerow([row.get(field) for field in EXPORT_FIELDS])
+        else:
+            buffer.write(json.dumps({field: row.get(field) for field in EXPORT_FIELDS}) + '\n')
+        if buffer.tell() >= EXPORT_CHUNK_BYTES:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def gzip_chunks(chunks):
+    """gzip a stream of text chunks on the fly"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+@app.route('/api/history/export')
+def history_export():
+    """Stream history as CSV or JSON lines (?format=jsonl), oldest first.
+
+    Filters as /api/history (start, end, prediction); ?archived=1 also
+    includes rows moved out by history_archive.py. Rows are read in
+    fetchmany batches and sent as they are encoded, so memory does not grow
+    with the export. Gzipped when the client accepts it.
+    """
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': f'format must be one of {", ".join(EXPORT_FORMATS)}'}), 400
+    try:
+        filters = history_filters()
+    except ValueError:
+        return jsonify({'error': 'Invalid date; use YYYY-MM-DD'}), 400
+    
+    include_archived = request.args.get('archived', '').lower() in ('1', 'true', 'yes')
+    source = history_archive.iter_all if include_archived else history.iter_range
+    chunks = export_chunks(source(filters['start'], filters['end'], filters['prediction']), export_format)
+    
+    headers = {'Content-Disposition': f'attachment; filename=history.{export_format}', 'Vary': 'Accept-Encoding'}
+    if request.accept_encodings['gzip']:
+        chunks = gzip_chunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    return current_app.response_class(stream_with_context(chunks), mimetype=EXPORT_FORMATS[export_format],
+                                      headers=headers)
 
 @app.route('/predict', methods=['POST'])
 def predict():
@@ -1119,6 +1127,61 @@ def predict():
     except Exception as e:
         return jsonify({'error': str(e)}), 400
 
+def analyze_and_record(filename, abs_filepath):
+    """Analyze a saved upload, record it in history and return the result dict"""
+    # Analyze image
+    predicted_class, confidence = analyze_image(abs_filepath)
+    
+    with tracing.span('disease_info'):
+        # Format disease name
+        disease_name = format_disease_name(predicted_class)
+        
+        # Get disease information
+        disease_data = get_disease_info(predicted_class)
+    
+    result = {
+        'disease': disease_name,
+        'confidence': round(confidence, 2),
+        'severity': disease_data['severity'],
+        'treatment': disease_data['treatment'],
+        'prevention': disease_data['prevention']
+    }
+    
+    tracing.annotate(disease=predicted_class, confidence=round(confidence, 2))
+    tracing.log(logger, logging.INFO, 'classified', filename=filename, disease=predicted_class,
+                confidence=round(confidence, 2))
+    tracing.log(logger, logging.DEBUG, 'result', **result)
+    
+    # Save to history
+    with tracing.span('history_insert'):
+        result['history_id'] = history.add_entry(filename, disease_name, confidence)
+    index_embedding(result['history_id'], abs_filepath)
+    
+    return result
+
+def wants_async():
+    """True when the client asked for async job mode (?async=1 or form field)"""
+    value = request.args.get('async') or request.form.get('async') or ''
+    return value.lower() in ('1', 'true', 'yes')
+
+def enqueue_disease_job(filename, abs_filepath):
+    """Queue a saved upload for background analysis and return a 202 response"""
+    disease_jobs.start_workers(analyze_and_record)
+    callback_url = request.args.get('callback_url') or request.form.get('callback_url')
+
+    try:
+        job_id = disease_jobs.submit_job(filename, abs_filepath, callback_url)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except disease_jobs.QueueFullError as e:
+        return jsonify({'error': str(e)}), 503
+
+    return jsonify({
+        'job_id': job_id,
+        'status': 'queued',
+        'status_url': url_for('job_status', job_id=job_id)
+    }), 202
+
 @app.route('/classify_disease', methods=['POST'])
 def classify_disease():
     """Disease classification endpoint"""
@@ -1132,7 +1195,13 @@ def classify_disease():
             return jsonify({'error': 'No selected file'}), 400
         
         if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
+            try:
+                with tracing.span('upload_validate'):
+                    upload_validation.validate_image(file.stream)
+            except upload_validation.InvalidImage as e:
+                return jsonify({'error': str(e)}), 400
+            
+            filename = unique_upload_name(file.filename)
             upload_folder = app.config.get('UPLOAD_FOLDER', 'uploads')
             
             # Ensure upload folder exists
@@ -1143,44 +1212,559 @@ def classify_disease():
             # Use absolute path to avoid [Errno 22] on Windows
             abs_filepath = os.path.abspath(filepath)
             
-            file.save(abs_filepath)
-            print(f"[INFO] Image saved to {abs_filepath}")
-            
-            # Analyze image
-            predicted_class, confidence = analyze_image(abs_filepath)
-            print(f"[INFO] Classification result: {predicted_class} ({confidence}%)")
+            with tracing.span('upload_save'):
+                file.save(abs_filepath)
+            tracing.log(logger, logging.DEBUG, 'image saved', path=abs_filepath)
             
-            # Format disease name
-            disease_name = format_disease_name(predicted_class)
+            if wants_async():
+                return enqueue_disease_job(filename, abs_filepath)
             
-            # Get disease information
+            return jsonify(analyze_and_record(filename, abs_filepath))
+        
+        return jsonify({'error': 'Invalid file type. Please upload JPG, JPEG, PNG or WebP'}), 400
+    
+    except Exception as e:
+        tracing.log(logger, logging.ERROR, 'classify_disease failed', error=e)
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Poll the status of an async disease analysis job"""
+    # Resumes jobs left queued by a previous run
+    disease_jobs.start_workers(analyze_and_record)
+    job = disease_jobs.get_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@app.route('/jobs/stats')
+def job_stats():
+    """Queue depth and per-job timing of the async analysis workers"""
+    return jsonify(disease_jobs.get_stats())
+
+@app.route('/similar_cases/<int:entry_id>')
+def similar_cases(entry_id):
+    """Past history entries that look most like the given one"""
+    k = min(request.args.get('k', 5, type=int), 50)
+    
+    entries = history.get_entries([entry_id])
+    if not entries:
+        return jsonify({'error': 'Entry not found'}), 404
+    
+    space, dim = embedding_space()
+    index = similarity_index.get_index(space, dim)
+    vector = index.get_vector(entry_id)
+    if vector is None:
+        # Analyzed before indexing was enabled (or with another model)
+        image_path = os.path.join(app.config['UPLOAD_FOLDER'], entries[0]['filename'])
+        if not os.path.exists(image_path):
+            return jsonify({'error': 'No embedding or image for this entry'}), 404
+        space, vector = compute_embedding(image_path)
+    
+    matches = index.search(vector, k=k, exclude_id=entry_id)
+    similarity = dict(matches)
+    cases = history.get_entries([match_id for match_id, _ in matches])
+    for case in cases:
+        case['similarity'] = round(similarity[case['id']], 4)
+    
+    return jsonify({'entry_id': entry_id, 'embedding': space, 'similar_cases': cases})
+
+@app.route('/cascade/stats')
+def cascade_stats():
+    """Per-stage hit rates, latency and agreement of the inference cascade"""
+    return jsonify(inference_cascade.get_stats())
+
+@app.route('/upload_config')
+def upload_config():
+    """Largest useful image size and preferred format, for clients that
+    downscale and re-encode photos before uploading them"""
+    config = upload_validation.client_upload_config(current_app.config.get('MAX_CONTENT_LENGTH'))
+    config['resumable'] = {
+        'url': url_for('create_resumable_upload'),
+        'min_bytes': resumable_uploads.CLIENT_MIN_BYTES,
+        'chunk_bytes': resumable_uploads.CLIENT_CHUNK_BYTES,
+    }
+    response = jsonify(config)
+    response.cache_control.public = True
+    response.cache_control.max_age = 3600
+    return response
+
+# Resumable uploads (tus-style): create, PATCH chunks at the current offset,
+# HEAD to resync after a dropped connection, then finalize to analyze.
+TUS_VERSION = '1.0.0'
+
+def _tus_response(response, upload=None, offset=None):
+    response.headers['Tus-Resumable'] = TUS_VERSION
+    response.headers['Cache-Control'] = 'no-store'
+    if upload is not None:
+        response.headers['Upload-Offset'] = str(upload['offset'] if offset is None else offset)
+        response.headers['Upload-Length'] = str(upload['length'])
+        response.headers['Upload-Expires'] = http_date(upload['expires_at'])
+    elif offset is not None:
+        response.headers['Upload-Offset'] = str(offset)
+    return response
+
+def _tus_error(message, status, offset=None):
+    return _tus_response(jsonify({'error': message}), offset=offset), status
+
+def _parse_upload_metadata(header):
+    """tus Upload-Metadata: 'key base64value,key base64value'"""
+    metadata = {}
+    for pair in filter(None, (part.strip() for part in header.split(','))):
+        key, _, value = pair.partition(' ')
+        try:
+            metadata[key] = base64.b64decode(value).decode('utf-8') if value else ''
+        except (ValueError, UnicodeDecodeError):
+            raise ValueError(f'Invalid Upload-Metadata value for {key}')
+    return metadata
+
+@app.route('/resumable_uploads', methods=['POST'])
+def create_resumable_upload():
+    """Start a resumable upload (Upload-Length and Upload-Metadata filename,
+    or a JSON body with length and filename)"""
+    try:
+        body = request.get_json(silent=True) or {}
+        metadata = _parse_upload_metadata(request.headers.get('Upload-Metadata', ''))
+        filename = metadata.get('filename') or body.get('filename') or ''
+        length = int(request.headers.get('Upload-Length') or body.get('length') or 0)
+        
+        if not allowed_file(filename):
+            return _tus_error('Invalid file type. Please upload JPG, JPEG, PNG or WebP', 400)
+        
+        upload = resumable_uploads.create_upload(secure_filename(filename), length)
+    except ValueError as e:
+        return _tus_error(str(e), 400)
+    
+    upload_url = url_for('resumable_upload', upload_id=upload['id'])
+    response = _tus_response(jsonify({'upload_id': upload['id'], 'upload_url': upload_url,
+                                      'offset': 0, 'length': upload['length'],
+                                      'expires_at': upload['expires_at']}), upload)
+    response.headers['Location'] = upload_url
+    return response, 201
+
+@app.route('/resumable_uploads/<upload_id>', methods=['GET', 'PATCH', 'DELETE'])
+def resumable_upload(upload_id):
+    """GET/HEAD: current offset; PATCH: append a chunk; DELETE: abandon"""
+    if request.method == 'DELETE':
+        if not resumable_uploads.delete_upload(upload_id):
+            return _tus_error('Upload not found', 404)
+        return _tus_response(current_app.response_class(status=204))
+    
+    upload = resumable_uploads.get_upload(upload_id)
+    if upload is None:
+        return _tus_error('Upload not found or expired', 404)
+    
+    if request.method in ('GET', 'HEAD'):
+        return _tus_response(jsonify({key: upload[key] for key in ('offset', 'length', 'status', 'expires_at')}),
+                             upload)
+    
+    if request.mimetype != 'application/offset+octet-stream':
+        return _tus_error('Content-Type must be application/offset+octet-stream', 415)
+    try:
+        offset = int(request.headers['Upload-Offset'])
+    except (KeyError, ValueError):
+        return _tus_error('Upload-Offset header is required', 400)
+    
+    try:
+        with tracing.span('upload_chunk'):
+            new_offset = resumable_uploads.write_chunk(upload_id, offset, request.stream)
+    except resumable_uploads.UploadNotFound as e:
+        return _tus_error(str(e), 404)
+    except resumable_uploads.UploadConflict as e:
+        return _tus_error(str(e), 409, e.offset)
+    except ValueError as e:
+        return _tus_error(str(e), 413)
+    
+    # Reject a bad image as soon as its header is in, not after the whole transfer
+    if new_offset >= 32:
+        try:
+            with open(resumable_uploads.data_path(upload_id), 'rb') as f:
+                upload_validation.validate_image(f, partial=new_offset < upload['length'])
+        except upload_validation.InvalidImage as e:
+            resumable_uploads.delete_upload(upload_id)
+            return _tus_error(str(e), 400)
+    
+    return _tus_response(current_app.response_class(status=204), upload, new_offset)
+
+@app.route('/resumable_uploads/<upload_id>/finalize', methods=['POST'])
+def finalize_resumable_upload(upload_id):
+    """Analyze a fully received upload, like /classify_disease (?async=1 for
+    a background job). Repeating it returns the first result."""
+    try:
+        upload = resumable_uploads.begin_finalize(upload_id)
+    except resumable_uploads.UploadNotFound as e:
+        return _tus_error(str(e), 404)
+    except resumable_uploads.UploadConflict as e:
+        return _tus_error(str(e), 409, e.offset)
+    
+    if upload['result'] is not None:
+        status = 202 if 'job_id' in upload['result'] else 200
+        return _tus_response(jsonify(upload['result'])), status
+    
+    part_path = resumable_uploads.data_path(upload_id)
+    upload_folder = current_app.config.get('UPLOAD_FOLDER', 'uploads')
+    os.makedirs(upload_folder, exist_ok=True)
+    filename = unique_upload_name(upload['filename'])
+    abs_filepath = os.path.abspath(os.path.join(upload_folder, filename))
+    
+    try:
+        os.replace(part_path, abs_filepath)
+        if wants_async():
+            response, status = enqueue_disease_job(filename, abs_filepath)
+            if status != 202:
+                raise RuntimeError(response.get_json()['error'])
+            result = response.get_json()
+        else:
+            result = analyze_and_record(filename, abs_filepath)
+    except Exception as e:
+        if os.path.exists(abs_filepath):
+            os.replace(abs_filepath, part_path)
+        resumable_uploads.abort_finalize(upload_id)
+        tracing.log(logger, logging.ERROR, 'finalize_resumable_upload failed', upload_id=upload_id, error=e)
+        return _tus_error(str(e), 400)
+    
+    resumable_uploads.finish_finalize(upload_id, result)
+    return _tus_response(jsonify(result)), 202 if 'job_id' in result else 200
+
+MAX_BATCH_IMAGES = 100
+MAX_BATCH_UNCOMPRESSED_BYTES = 256 * 1024 * 1024
+BATCH_DECODE_WORKERS = min(8, (os.cpu_count() or 1) + 4)
+
+SEVERITY_ORDER = ['None', 'Low', 'Moderate', 'High', 'Critical']
+
+def save_batch_uploads(upload_folder):
+    """Save images from a batch request (multipart files or a ZIP archive).
+
+    Returns a list of (filename, absolute_path). Raises ValueError on bad input,
+    after removing the images of the batch saved so far.
+    """
+    saved = []
+
+    try:
+        for file in request.files.getlist('images'):
+            if not file or file.filename == '':
+                continue
+            if not allowed_file(file.filename):
+                raise ValueError(f'Invalid file type: {file.filename}')
+            if len(saved) >= MAX_BATCH_IMAGES:
+                raise ValueError(f'Too many images (max {MAX_BATCH_IMAGES})')
+            try:
+                upload_validation.validate_image(file.stream)
+            except upload_validation.InvalidImage as e:
+                raise ValueError(f'{file.filename}: {e}')
+            filename = unique_upload_name(file.filename)
+            abs_filepath = os.path.abspath(os.path.join(upload_folder, filename))
+            saved.append((filename, abs_filepath))
+            file.save(abs_filepath)
+
+        archive = request.files.get('archive')
+        if archive and archive.filename:
+            try:
+                zf = zipfile.ZipFile(archive.stream)
+            except zipfile.BadZipFile:
+                raise ValueError('Archive is not a valid ZIP file')
+            with zf:
+                members = [info for info in zf.infolist()
+                           if not info.is_dir() and allowed_file(os.path.basename(info.filename))]
+                if len(saved) + len(members) > MAX_BATCH_IMAGES:
+                    raise ValueError(f'Too many images (max {MAX_BATCH_IMAGES})')
+                if sum(info.file_size for info in members) > MAX_BATCH_UNCOMPRESSED_BYTES:
+                    raise ValueError('Archive is too large when uncompressed')
+                for info in members:
+                    if not secure_filename(os.path.basename(info.filename)):
+                        continue
+                    filename = unique_upload_name(info.filename)
+                    abs_filepath = os.path.abspath(os.path.join(upload_folder, filename))
+                    with zf.open(info) as src:
+                        try:
+                            upload_validation.validate_image(src)
+                        except upload_validation.InvalidImage as e:
+                            raise ValueError(f'{info.filename}: {e}')
+                        saved.append((filename, abs_filepath))
+                        with open(abs_filepath, 'wb') as dst:
+                            shutil.copyfileobj(src, dst)
+    except Exception:
+        # A rejected batch leaves nothing behind in the upload folder
+        for _, abs_filepath in saved:
+            if os.path.exists(abs_filepath):
+                os.remove(abs_filepath)
+        raise
+
+    return saved
+
+def _preprocess_into(image_path, out):
+    """Decode into one slot of a batch buffer; False if the image is unreadable"""
+    try:
+        preprocess_image_for_ml(image_path, out=out)
+        return True
+    except Exception as e:
+        tracing.log(logger, logging.WARNING, 'could not decode image', image=image_path, error=e)
+        return False
+
+def analyze_images_batch(image_paths):
+    """Batch version of analyze_image().
+
+    Images are decoded in parallel on a thread pool and the ML model runs once
+    on the stacked batch, following the same cascade order and thresholds as
+    analyze_image(). Images without an accepted ML prediction use the
+    enhanced color-based analysis.
+    """
+    global model, model_loaded
+
+    results = [None] * len(image_paths)
+    model_ready = MODEL_AVAILABLE and model_loaded and model is not None
+    inference_cascade.record_images(len(image_paths))
+
+    with ThreadPoolExecutor(max_workers=BATCH_DECODE_WORKERS) as executor:
+        color_results = [None] * len(image_paths)
+        ml_results = {}
+        ml_candidates = list(range(len(image_paths)))
+
+        if inference_cascade.CASCADE_ORDER == 'color_first':
+            start = time.perf_counter()
+            with tracing.span('color_batch', images=len(image_paths)):
+                color_results = analyze_images_enhanced(image_paths, executor)
+            inference_cascade.record_stage('color', len(image_paths), 0, (time.perf_counter() - start) * 1000)
+            ml_candidates = [i for i, r in enumerate(color_results) if inference_cascade.is_ambiguous(*r)]
+
+        if model_ready and ml_candidates:
+            try:
+                start = time.perf_counter()
+                # Decode threads write straight into this thread's preallocated
+                # buffer, ML_BATCH_SIZE images at a time
+                for first in range(0, len(ml_candidates), ML_BATCH_SIZE):
+                    chunk = ml_candidates[first:first + ML_BATCH_SIZE]
+                    batch = get_ml_input_buffer(len(chunk))
+                    with tracing.span('ml_preprocess_batch', images=len(chunk)):
+                        ok = list(executor.map(_preprocess_into, [image_paths[i] for i in chunk], batch))
+                    if not any(ok):
+                        continue
+                    with tracing.span('ml_predict_batch', images=len(chunk)):
+                        predictions = model.predict(batch, verbose=0)
+                    for n, (i, row) in enumerate(zip(chunk, predictions)):
+                        if not ok[n]:
+                            continue
+                        top_idx = int(np.argmax(row))
+                        ml_results[i] = (DISEASE_CLASSES[top_idx], float(row[top_idx] * 100))
+                        if inference_cascade.accept_ml(*ml_results[i]):
+                            results[i] = ml_results[i]
+                accepted = sum(r is not None for r in results)
+                inference_cascade.record_stage('ml', len(ml_candidates), accepted,
+                                               (time.perf_counter() - start) * 1000)
+            except Exception as e:
+                tracing.log(logger, logging.WARNING, 'batch ML prediction failed, falling back to enhanced analysis',
+                            error=e)
+
+        pending = [i for i, r in enumerate(results) if r is None]
+        missing = [i for i in pending if color_results[i] is None]
+        if missing:
+            start = time.perf_counter()
+            with tracing.span('color_batch', images=len(missing)):
+                for i, r in zip(missing, analyze_images_enhanced([image_paths[i] for i in missing], executor)):
+                    color_results[i] = r
+            inference_cascade.record_stage('color', len(missing), 0, (time.perf_counter() - start) * 1000)
+        inference_cascade.record_stage('color', 0, len(pending), 0.0)
+        for i in pending:
+            results[i] = color_results[i]
+
+        for i, ml_result in ml_results.items():
+            if color_results[i] is not None:
+                inference_cascade.record_agreement(ml_result, color_results[i])
+
+    return results
+
+def summarize_field(results):
+    """Build a field-level summary from per-image batch results"""
+    total = len(results)
+    disease_counts = {}
+    healthy_count = 0
+    worst_severity = 'None'
+
+    for r in results:
+        if 'healthy' in r['disease'].lower():
+            healthy_count += 1
+        else:
+            disease_counts[r['disease']] = disease_counts.get(r['disease'], 0) + 1
+        if SEVERITY_ORDER.index(r['severity']) > SEVERITY_ORDER.index(worst_severity):
+            worst_severity = r['severity']
+
+    disease_counts = dict(sorted(disease_counts.items(), key=lambda item: item[1], reverse=True))
+
+    return {
+        'total_images': total,
+        'healthy_count': healthy_count,
+        'diseased_count': total - healthy_count,
+        'disease_incidence': round((total - healthy_count) / total * 100, 2) if total else 0.0,
+        'mean_confidence': round(sum(r['confidence'] for r in results) / total, 2) if total else 0.0,
+        'most_common_disease': next(iter(disease_counts), None),
+        'highest_severity': worst_severity,
+        'disease_counts': disease_counts
+    }
+
+@app.route('/classify_disease_batch', methods=['POST'])
+def classify_disease_batch():
+    """Batch disease classification endpoint.
+
+    Accepts many images as multipart files under 'images' and/or a ZIP
+    archive under 'archive'.
+    """
+    try:
+        upload_folder = app.config.get('UPLOAD_FOLDER', 'uploads')
+        os.makedirs(upload_folder, exist_ok=True)
+
+        try:
+            saved = save_batch_uploads(upload_folder)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        if not saved:
+            return jsonify({'error': 'No images provided'}), 400
+
+        tracing.annotate(images=len(saved))
+
+        predictions = analyze_images_batch([path for _, path in saved])
+
+        results = []
+        for (filename, _), (predicted_class, confidence) in zip(saved, predictions):
             disease_data = get_disease_info(predicted_class)
-            
-            result = {
-                'disease': disease_name,
+            results.append({
+                'filename': filename,
+                'disease': format_disease_name(predicted_class),
                 'confidence': round(confidence, 2),
                 'severity': disease_data['severity'],
                 'treatment': disease_data['treatment'],
                 'prevention': disease_data['prevention']
-            }
-            
-            print(f"[DEBUG] Final result dict: {result}")
-            print(f"\nResult: {disease_name} ({confidence:.2f}%)")
-            print(f"{'='*60}\n")
-            
+            })
+
+        # Save all rows to history in one transaction
+        with tracing.span('history_insert', rows=len(results)):
+            entry_ids = history.add_entries((r['filename'], r['disease'], r['confidence']) for r in results)
+        for r, entry_id, (_, path) in zip(results, entry_ids, saved):
+            r['history_id'] = entry_id
+            index_embedding(entry_id, path)
+
+        return jsonify({
+            'results': results,
+            'summary': summarize_field(results)
+        })
 
-            # Save to history
-            history.add_entry(filename, disease_name, confidence)
-            
-            return jsonify(result)
-        
-        return jsonify({'error': 'Invalid file type. Please upload JPG, JPEG, or PNG'}), 400
-    
     except Exception as e:
-        print(f"Error in classify_disease: {e}")
+        tracing.log(logger, logging.ERROR, 'classify_disease_batch failed', error=e)
         return jsonify({'error': str(e)}), 400
 
-import sqlite3
+def classify_tile_batch(batch):
+    """Classify a uint8 batch of 224x224 tiles with the ML model or color rules"""
+    global model, model_loaded
+
+    if MODEL_AVAILABLE and model_loaded and model is not None:
+        inputs = scale_pixels_into(batch, get_ml_input_buffer(len(batch)))
+        predictions = model.predict(inputs, verbose=0)
+        top = predictions.argmax(axis=1)
+        return [(DISEASE_CLASSES[idx], float(predictions[n, idx] * 100)) for n, idx in enumerate(top)]
+
+    rows = [color_rules.features_to_row(color_analysis.compute_color_features(tile)) for tile in batch]
+    return color_rules.ACTIVE.classify_batch(rows)
+
+@app.route('/classify_disease_tiled', methods=['POST'])
+def classify_disease_tiled():
+    """Tiled disease analysis for large field and drone images.
+
+    Returns a per-tile class and confidence grid plus a rendered heatmap.
+    """
+    try:
+        if 'image' not in request.files:
+            return jsonify({'error': 'No image provided'}), 400
+
+        file = request.files['image']
+
+        if file.filename == '':
+            return jsonify({'error': 'No selected file'}), 400
+
+        if not allowed_file(file.filename):
+            return jsonify({'error': 'Invalid file type. Please upload JPG, JPEG, PNG or WebP'}), 400
+
+        try:
+            upload_validation.validate_image(file.stream, max_pixels=tiled_analysis.MAX_IMAGE_PIXELS)
+        except upload_validation.InvalidImage as e:
+            return jsonify({'error': str(e)}), 400
+
+        filename = unique_upload_name(file.filename)
+        upload_folder = app.config.get('UPLOAD_FOLDER', 'uploads')
+        os.makedirs(upload_folder, exist_ok=True)
+
+        abs_filepath = os.path.abspath(os.path.join(upload_folder, filename))
+        file.save(abs_filepath)
+
+        heatmap_name = f"heatmap_{os.path.splitext(filename)[0]}.png"
+        heatmap_path = os.path.abspath(os.path.join(upload_folder, heatmap_name))
+
+        try:
+            analysis = tiled_analysis.analyze_tiled(abs_filepath, classify_tile_batch, heatmap_path)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        analysis['classes'] = [format_disease_name(name) for name in analysis['classes']]
+        analysis['tile_counts'] = {format_disease_name(name): n for name, n in analysis['tile_counts'].items()}
+        analysis['heatmap_url'] = url_for('uploaded_file', filename=heatmap_name)
+
+        return jsonify(analysis)
+
+    except Exception as e:
+        tracing.log(logger, logging.ERROR, 'classify_disease_tiled failed', error=e)
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/uploads/<filename>')
+def uploaded_file(filename):
+    """Serve uploaded images"""
+    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+
+def thumbnail_url(filename, size='small'):
+    """URL of an upload's thumbnail, versioned by its cache key so browsers
+    can keep it for a year; the original's URL if the file is missing"""
+    source = safe_join(current_app.config['UPLOAD_FOLDER'], filename or '')
+    try:
+        key = thumbnails.cache_key(source, size, 'jpeg')
+    except (TypeError, OSError):
+        return url_for('uploaded_file', filename=filename)
+    return url_for('thumbnail', filename=filename, size=size, v=key.split('-')[0])
+
+app.add_template_global(thumbnail_url)
+
+@app.route('/thumbnails/<filename>')
+def thumbnail(filename):
+    """Downscaled copy of an upload, WebP when the browser accepts it.
+    ?size=small|report; the ETag is checked before any image is opened."""
+    size = request.args.get('size', 'small')
+    if size not in thumbnails.SIZES:
+        return jsonify({'error': f"size must be one of {', '.join(thumbnails.SIZES)}"}), 400
+    source = safe_join(current_app.config['UPLOAD_FOLDER'], filename)
+    if source is None or not os.path.isfile(source):
+        return "Image not found", 404
+
+    image_format = thumbnails.best_format(request.accept_mimetypes['image/webp'])
+    key = thumbnails.cache_key(source, size, image_format)
+    if key in request.if_none_match:
+        response = current_app.response_class(status=304)
+        response.set_etag(key)
+    else:
+        try:
+            path = thumbnails.thumbnail_path(source, size, image_format)
+        except (OSError, Image.DecompressionBombError) as e:
+            return jsonify({'error': f'Cannot make a thumbnail: {e}'}), 400
+        response = send_file(os.path.abspath(path), mimetype=thumbnails.FORMATS[image_format][1],
+                             etag=key, conditional=False)
+
+    response.vary.add('Accept')
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    if request.args.get('v') == key.split('-')[0]:
+        # Versioned URL from thumbnail_url(): a new upload gets a new URL
+        response.cache_control.max_age = 365 * 24 * 3600
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.max_age = 24 * 3600
+    return response
+
 from flask import send_file
 
 @app.route('/download_report/<int:report_id>')
@@ -1188,12 +1772,8 @@ def download_report(report_id):
     """Generate and download PDF report"""
     try:
         # Get entry from history
-        conn = sqlite3.connect(history.DB_NAME)
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-        c.execute('SELECT * FROM history WHERE id = ?', (report_id,))
-        entry = c.fetchone()
-        conn.close()
+        entries = history.get_entries([report_id])
+        entry = entries[0] if entries else None
         
         if not entry:
             return "Report not found", 404
@@ -1205,6 +1785,9 @@ def download_report(report_id):
         image_path = os.path.join(app.config['UPLOAD_FOLDER'], entry['filename'])
         # Ensure absolute path
         image_path = os.path.abspath(image_path)
+        if os.path.isfile(image_path):
+            # A report-sized JPEG instead of the full-resolution original
+            image_path = os.path.abspath(thumbnails.thumbnail_path(image_path, 'report', 'jpeg'))
         
         print(f"Generating PDF for {image_path}")
         
@@ -1246,6 +1829,13 @@ if __name__ == '__main__':
         print("\n[WARNING] TensorFlow not available")
         print("  Using enhanced color-based disease detection")
     
+    # Pre-fork color analysis workers (COLOR_POOL_WORKERS > 0) before the
+    # server starts any threads
+    color_analysis.start_pool()
+    
+    # Upgrade history rows from before created_at and the rollups
+    history.start_maintenance()
+    
     print("\n" + "="*60)
     print("Starting Flask server...")
     print("="*60 + "\n")
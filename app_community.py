@@ -14,7 +14,12 @@ load_dotenv()
 
 # Import existing modules
 import history
+import color_analysis
+import metrics
+import tracing
+import upload_validation
 import pdf_generator
+import thumbnails
 import weather
 
 # Import community modules
@@ -25,12 +30,18 @@ from expert_api import expert_bp
 # Import existing disease detection logic
 from app import (MODEL_AVAILABLE, model, model_loaded, load_trained_model,
                  DISEASE_CLASSES, DISEASE_INFO, get_disease_info,
-                 preprocess_image_for_ml, analyze_image_enhanced,
+                 preprocess_image_for_ml, analyze_image_enhanced, analyze_image,
                  crop_model, crop_le, get_fertilizer_recommendation,
-                 ALLOWED_EXTENSIONS)
+                 ALLOWED_EXTENSIONS, classify_disease_batch, classify_disease_tiled,
+                 wants_async, enqueue_disease_job, job_status, job_stats,
+                 cascade_stats, index_embedding, similar_cases, upload_config,
+                 create_resumable_upload, resumable_upload, finalize_resumable_upload,
+                 history_page, history_api, history_rollups, history_export,
+                 thumbnail_url, thumbnail, UploadRequest, unique_upload_name)
 
 # Initialize Flask app
 app = Flask(__name__)
+app.request_class = UploadRequest
 
 # Configuration
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev-secret-key-change-in-production')
@@ -38,6 +49,10 @@ app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('SQLALCHEMY_DATABASE_URI', 'sq
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['UPLOAD_FOLDER'] = os.getenv('UPLOAD_FOLDER', 'uploads')
 app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_CONTENT_LENGTH', 16 * 1024 * 1024))
+app.config['MAX_CONTENT_LENGTH_BY_ENDPOINT'] = {
+    'classify_disease_batch': int(os.getenv('MAX_BATCH_CONTENT_LENGTH', 256 * 1024 * 1024)),
+    'classify_disease_tiled': int(os.getenv('MAX_TILED_CONTENT_LENGTH', 512 * 1024 * 1024)),
+}
 
 # Pagination settings
 app.config['POSTS_PER_PAGE'] = int(os.getenv('POSTS_PER_PAGE', 20))
@@ -62,6 +77,11 @@ login_manager.init_app(app)
 login_manager.login_view = 'login'
 login_manager.login_message = 'Please log in to access this page.'
 
+# Request latency, inference, cache and database metrics at /metrics
+metrics.init_app(app)
+# Per-request traces, served at /debug/traces in debug mode
+tracing.init_app(app)
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
@@ -234,19 +254,22 @@ def classify_disease():
             return jsonify({'error': 'No file selected'}), 400
         
         if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
+            try:
+                with tracing.span('upload_validate'):
+                    upload_validation.validate_image(file.stream)
+            except upload_validation.InvalidImage as e:
+                return jsonify({'error': str(e)}), 400
+            
+            filename = unique_upload_name(file.filename)
             filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(filepath)
+            with tracing.span('upload_save'):
+                file.save(filepath)
+            
+            if wants_async():
+                return enqueue_disease_job(filename, os.path.abspath(filepath))
             
-            # Use ML model if available, otherwise use color-based detection
-            if model_loaded and model:
-                img_array = preprocess_image_for_ml(filepath)
-                predictions = model.predict(img_array)
-                predicted_class_idx = predictions[0].argmax()
-                confidence = float(predictions[0][predicted_class_idx]) * 100
-                disease_name = DISEASE_CLASSES[predicted_class_idx]
-            else:
-                disease_name, confidence = analyze_image_enhanced(filepath)
+            # ML model and color-based detection, as configured by the cascade
+            disease_name, confidence = analyze_image(filepath)
             
             disease_info = get_disease_info(disease_name)
             
@@ -259,27 +282,47 @@ def classify_disease():
             }
             
             # Save to history
-            history.add_entry(filename, disease_name, confidence)
+            with tracing.span('history_insert'):
+                result['history_id'] = history.add_entry(filename, disease_name, confidence)
+            index_embedding(result['history_id'], os.path.abspath(filepath))
             
             return jsonify(result)
         
-        return jsonify({'error': 'Invalid file type'}), 400
+        return jsonify({'error': 'Invalid file type. Please upload JPG, JPEG, PNG or WebP'}), 400
         
     except Exception as e:
         return jsonify({'error': str(e)}), 400
 
 
+# Batch and tiled classification are shared with the original app
+app.add_url_rule('/classify_disease_batch', view_func=classify_disease_batch, methods=['POST'])
+app.add_url_rule('/classify_disease_tiled', view_func=classify_disease_tiled, methods=['POST'])
+
+# Async job status routes are shared with the original app
+app.add_url_rule('/jobs/<job_id>', view_func=job_status)
+app.add_url_rule('/jobs/stats', view_func=job_stats)
+app.add_url_rule('/cascade/stats', view_func=cascade_stats)
+app.add_url_rule('/upload_config', view_func=upload_config)
+
+# Resumable uploads are shared with the original app
+app.add_url_rule('/resumable_uploads', view_func=create_resumable_upload, methods=['POST'])
+app.add_url_rule('/resumable_uploads/<upload_id>', view_func=resumable_upload, methods=['GET', 'PATCH', 'DELETE'])
+app.add_url_rule('/resumable_uploads/<upload_id>/finalize', view_func=finalize_resumable_upload, methods=['POST'])
+app.add_url_rule('/similar_cases/<int:entry_id>', view_func=similar_cases)
+
+
 def allowed_file(filename):
     """Check if file extension is allowed"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
-@app.route('/history')
-def get_history():
-    """View analysis history"""
-    import history
-    entries = history.get_history()
-    return render_template('history.html', entries=entries)
+# Paginated history page and its JSON variant are shared with the original app
+app.add_url_rule('/history', view_func=history_page)
+app.add_url_rule('/api/history', view_func=history_api)
+app.add_url_rule('/api/history/rollups', view_func=history_rollups)
+app.add_url_rule('/api/history/export', view_func=history_export)
+app.add_url_rule('/thumbnails/<filename>', view_func=thumbnail)
+app.add_template_global(thumbnail_url)
 
 
 from flask import send_from_directory
@@ -294,16 +337,11 @@ def uploaded_file(filename):
 def download_report(report_id):
     """Generate and download PDF report"""
     try:
-        import sqlite3
         from app import get_disease_info
         
         # Get entry from history
-        conn = sqlite3.connect(history.DB_NAME)
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-        c.execute('SELECT * FROM history WHERE id = ?', (report_id,))
-        entry = c.fetchone()
-        conn.close()
+        entries = history.get_entries([report_id])
+        entry = entries[0] if entries else None
         
         if not entry:
             return "Report not found", 404
@@ -314,6 +352,8 @@ def download_report(report_id):
         # Generate PDF
         image_path = os.path.join(app.config['UPLOAD_FOLDER'], entry['filename'])
         image_path = os.path.abspath(image_path)
+        if os.path.isfile(image_path):
+            image_path = os.path.abspath(thumbnails.thumbnail_path(image_path, 'report', 'jpeg'))
         
         # We need to ensure pdf_generator is imported and working
         report_file, report_path = pdf_generator.generate_report(
@@ -431,6 +471,13 @@ if __name__ == '__main__':
         print("\n[WARNING] TensorFlow not available")
         print("  Using enhanced color-based disease detection")
     
+    # Pre-fork color analysis workers (COLOR_POOL_WORKERS > 0) before the
+    # server starts any threads
+    color_analysis.start_pool()
+    
+    # Upgrade history rows from before created_at and the rollups
+    history.start_maintenance()
+    
     print("\n" + "="*60)
     print("Starting Flask server...")
     print("="*60 + "\n")
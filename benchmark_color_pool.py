@@ -0,0 +1,90 @@
+"""
+Color analysis throughput benchmark
+Compares in-thread feature extraction (what a threaded Flask server does by
+default) against the shared-memory process pool for increasing worker counts.
+
+Usage:
+    python benchmark_color_pool.py
+    python benchmark_color_pool.py --images 64 --size 3000x4000 --threads 8
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+import color_analysis
+
+
+def make_images(folder, count, size):
+    """Write synthetic leaf-like JPEGs (green base with brown/yellow blotches)"""
+    rng = np.random.default_rng(0)
+    height, width = size
+    paths = []
+    for i in range(count):
+        img = np.empty((height, width, 3), dtype=np.uint8)
+        img[..., 0] = rng.integers(30, 90, (height, width))
+        img[..., 1] = rng.integers(100, 200, (height, width))
+        img[..., 2] = rng.integers(20, 80, (height, width))
+        for _ in range(20):
+            y, x = rng.integers(0, height - 50), rng.integers(0, width - 50)
+            img[y:y + 50, x:x + 50] = (140, 110, 40)
+        path = os.path.join(folder, f'leaf_{i}.jpg')
+        Image.fromarray(img).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def measure(paths, client_threads):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=client_threads) as executor:
+        list(executor.map(color_analysis.extract_features_pooled, paths))
+    return len(paths) / (time.perf_counter() - start)
+
+
+def worker_counts(max_workers):
+    counts, n = [], 1
+    while n < max_workers:
+        counts.append(n)
+        n *= 2
+    counts.append(max_workers)
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Color analysis throughput vs process pool size')
+    parser.add_argument('--images', type=int, default=32)
+    parser.add_argument('--size', default='3000x4000', help='HEIGHTxWIDTH of synthetic images')
+    parser.add_argument('--threads', type=int, default=8, help='concurrent request threads')
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    size = tuple(int(v) for v in args.size.lower().split('x'))
+    folder = tempfile.mkdtemp(prefix='color_bench_')
+
+    try:
+        print(f"Generating {args.images} synthetic {args.size} images...")
+        paths = make_images(folder, args.images, size)
+
+        print("\n" + "="*60)
+        print(f"{'mode':<24}{'images/s':>12}{'speedup':>12}")
+        print("-"*60)
+
+        baseline = measure(paths, args.threads)
+        print(f"{'in-thread':<24}{baseline:>12.2f}{1.0:>11.2f}x")
+
+        for n in worker_counts(args.max_workers):
+            color_analysis.start_pool(n)
+            rate = measure(paths, args.threads)
+            color_analysis.shutdown_pool()
+            print(f"{f'pool ({n} workers)':<24}{rate:>12.2f}{rate / baseline:>11.2f}x")
+
+        print("="*60)
+        print(f"CPUs: {os.cpu_count()}, request threads: {args.threads}\n")
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
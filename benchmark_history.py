@@ -0,0 +1,141 @@
+"""
+History database benchmark
+Concurrent request threads writing analysis results to the history table and
+reading them back (as the report and similar-cases routes do), comparing:
+
+  per-call      a new connection per statement, rollback journal (the old history.py)
+  pooled        one reused connection per thread, WAL, a commit per entry
+  write-behind  pooled, and entries are queued and written in batches (history.py)
+
+Usage:
+    python benchmark_history.py
+    python benchmark_history.py --threads 16 --ops 500 --read-ratio 0.5
+    python benchmark_history.py --json > bench_output.txt
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+import history
+
+MODES = ['per-call', 'pooled', 'write-behind']
+
+
+def per_call_add(filename, prediction, confidence):
+    conn = sqlite3.connect(history.DB_NAME)
+    c = conn.cursor()
+    date_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    c.execute('INSERT INTO history (filename, date, prediction, confidence) VALUES (?, ?, ?, ?)',
+              (filename, date_str, prediction, confidence))
+    entry_id = c.lastrowid
+    conn.commit()
+    conn.close()
+    return entry_id
+
+
+def per_call_get(entry_ids):
+    conn = sqlite3.connect(history.DB_NAME)
+    conn.row_factory = sqlite3.Row
+    placeholders = ','.join('?' * len(entry_ids))
+    rows = [dict(row) for row in conn.execute(f'SELECT * FROM history WHERE id IN ({placeholders})',
+                                              list(entry_ids))]
+    conn.close()
+    return rows
+
+
+def run_mode(mode, folder, threads, ops, read_ratio, seed_rows):
+    history.close_connection()
+    history.DB_NAME = os.path.join(folder, f'{mode}.db')
+    history.init_db()
+    if mode == 'per-call':
+        conn = sqlite3.connect(history.DB_NAME)
+        conn.execute('PRAGMA journal_mode = DELETE')
+        conn.close()
+        add, get = per_call_add, per_call_get
+    else:
+        add, get = history.add_entry, history.get_entries
+    history.WRITE_BEHIND = mode == 'write-behind'
+    history.add_entries(('seed.jpg', 'Healthy', 90.0) for _ in range(seed_rows))
+    history.flush()
+
+    latencies = [[] for _ in range(threads)]
+    errors = [0] * threads
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(index):
+        rng = random.Random(index)
+        barrier.wait()
+        for _ in range(ops):
+            start = time.perf_counter()
+            try:
+                if rng.random() < read_ratio:
+                    get([rng.randint(1, seed_rows)])
+                else:
+                    add(f'leaf_{index}.jpg', 'Tomato - Early blight', rng.uniform(50, 99))
+            except sqlite3.OperationalError:
+                errors[index] += 1
+            latencies[index].append(time.perf_counter() - start)
+        history.close_connection()
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in workers:
+        t.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - start
+    history.flush()
+
+    conn = sqlite3.connect(history.DB_NAME)
+    rows = conn.execute('SELECT COUNT(*) FROM history').fetchone()[0]
+    conn.close()
+    all_latencies = np.concatenate([np.array(l) for l in latencies]) * 1000
+    return {
+        'mode': mode,
+        'ops_per_s': round(threads * ops / elapsed, 1),
+        'p50_ms': round(float(np.percentile(all_latencies, 50)), 3),
+        'p99_ms': round(float(np.percentile(all_latencies, 99)), 3),
+        'errors': sum(errors),
+        'rows_written': rows - seed_rows,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='History inserts and lookups under concurrent requests')
+    parser.add_argument('--threads', type=int, default=8, help='concurrent request threads')
+    parser.add_argument('--ops', type=int, default=300, help='operations per thread')
+    parser.add_argument('--read-ratio', type=float, default=0.5, help='fraction of operations that are lookups')
+    parser.add_argument('--seed-rows', type=int, default=10000, help='rows in the table before the run')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES)
+    parser.add_argument('--json', action='store_true', help='print raw JSON results')
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix='history_bench_')
+    try:
+        results = [run_mode(mode, folder, args.threads, args.ops, args.read_ratio, args.seed_rows)
+                   for mode in args.modes]
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print("\n" + "="*76)
+        print(f"HISTORY DB ({args.threads} threads x {args.ops} ops, {args.read_ratio:.0%} reads)")
+        print("="*76)
+        print(f"{'mode':<14}{'ops/s':>12}{'p50':>12}{'p99':>12}{'errors':>10}{'rows written':>16}")
+        for r in results:
+            print(f"{r['mode']:<14}{r['ops_per_s']:>12.1f}{r['p50_ms']:>9.3f} ms{r['p99_ms']:>9.3f} ms"
+                  f"{r['errors']:>10}{r['rows_written']:>16}")
+        print("="*76 + "\n")
@@ -0,0 +1,258 @@
+"""
+Disease classification pipeline benchmark
+Times every stage of a /classify_disease request separately on synthetic
+leaf photos at common phone camera resolutions, for both the app.py and the
+app_community.py code paths, plus the full request through Flask's test
+client.
+
+History rows, uploads and embeddings go to a temporary directory, so the
+real database is not touched.
+
+Usage:
+    python benchmark_pipeline.py
+    python benchmark_pipeline.py --sizes 4032x3024 -n 10
+    python benchmark_pipeline.py --json > bench_output.txt
+    python benchmark_pipeline.py --compare bench_output.txt
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw
+from werkzeug.datastructures import FileStorage
+
+# 12 MP (most current phones), 8 MP and a 1080p screenshot-sized photo
+DEFAULT_SIZES = ['4032x3024', '3264x2448', '1920x1080']
+PATHS = ['app', 'app_community']
+REQUEST_STAGES = ['upload_validate', 'upload_save', 'cascade_total', 'disease_info', 'history_insert', 'embedding_index']
+
+
+def make_leaf_jpeg(width, height, seed=0, quality=90):
+    """JPEG bytes of a green leaf with brown lesions on a soil background"""
+    rng = np.random.default_rng(seed)
+    img = Image.new('RGB', (width, height), (96, 72, 48))
+    draw = ImageDraw.Draw(img)
+    draw.ellipse((width * 0.15, height * 0.1, width * 0.85, height * 0.9), fill=(52, 140, 46))
+    for _ in range(40):
+        x, y = rng.uniform(0.25, 0.75) * width, rng.uniform(0.2, 0.8) * height
+        r = rng.uniform(0.005, 0.03) * min(width, height)
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=(120, 82, 40))
+
+    # Sensor noise, so JPEG size and decode cost are close to a real photo
+    pixels = np.asarray(img, dtype=np.int16) + rng.integers(-12, 13, (height, width, 3), dtype=np.int16)
+    buf = io.BytesIO()
+    Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(buf, 'JPEG', quality=quality)
+    return buf.getvalue()
+
+
+def summarize(samples_ms):
+    ordered = sorted(samples_ms)
+    return {
+        'median_ms': round(statistics.median(ordered), 3),
+        'p95_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 3),
+        'min_ms': round(ordered[0], 3),
+    }
+
+
+class StageTimer:
+    """Collects per-stage samples across runs"""
+
+    def __init__(self):
+        self.samples = {}
+
+    def time(self, stage, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        self.samples.setdefault(stage, []).append((time.perf_counter() - start) * 1000)
+        return result
+
+    def report(self):
+        stages = {stage: summarize(samples) for stage, samples in self.samples.items()}
+        # decode .. inference break cascade_total down, so only the
+        # request-level stages add up to (roughly) end_to_end
+        stages['request_sum'] = {'median_ms': round(sum(stages[stage]['median_ms'] for stage in REQUEST_STAGES
+                                                        if stage in stages), 3)}
+        return stages
+
+
+def run_stages(path_name, jpeg_bytes, workdir, timer):
+    """One request's worth of work, stage by stage, as the given app does it"""
+    import app
+    import color_analysis
+    import history
+
+    filename = 'benchmark_leaf.jpg'
+    filepath = os.path.abspath(os.path.join(workdir, 'uploads', filename))
+
+    upload = FileStorage(stream=io.BytesIO(jpeg_bytes), filename=filename, content_type='image/jpeg')
+    timer.time('upload_validate', app.upload_validation.validate_image, upload.stream)
+    timer.time('upload_save', upload.save, filepath)
+
+    img = timer.time('decode', lambda: Image.open(filepath).convert('RGB'))
+    resized = timer.time('resize', img.resize, color_analysis.ANALYSIS_SIZE)
+    features = timer.time('color_features', color_analysis.compute_color_features, np.array(resized))
+    timer.time('color_rules', app.classify_color_features, features)
+
+    batch = timer.time('ml_preprocess', app.preprocess_image_for_ml, filepath)
+    if app.model_loaded and app.model is not None:
+        timer.time('inference', app.model.predict, batch)
+
+    # The class the real request would report, from the configured cascade
+    predicted_class, confidence = timer.time('cascade_total', app.analyze_image, filepath)
+
+    if path_name == 'app':
+        # analyze_and_record formats the name and looks up the raw class
+        timer.time('disease_info', lambda: (app.format_disease_name(predicted_class),
+                                            app.get_disease_info(predicted_class)))
+        disease_name = app.format_disease_name(predicted_class)
+    else:
+        # app_community looks up the class name as returned by the cascade
+        disease_name = predicted_class
+        timer.time('disease_info', app.get_disease_info, disease_name)
+
+    entry_id = timer.time('history_insert', history.add_entry, filename, disease_name, confidence)
+    timer.time('embedding_index', app.index_embedding, entry_id, filepath)
+
+
+def run_end_to_end(path_name, jpeg_bytes, timer):
+    """The whole request through the Flask test client"""
+    if path_name == 'app':
+        import app as module
+        field = 'image'
+    else:
+        import app_community as module
+        field = 'file'
+
+    client = module.app.test_client()
+    start = time.perf_counter()
+    response = client.post('/classify_disease',
+                           data={field: (io.BytesIO(jpeg_bytes), 'benchmark_leaf.jpg')},
+                           content_type='multipart/form-data')
+    timer.samples.setdefault('end_to_end', []).append((time.perf_counter() - start) * 1000)
+    if response.status_code != 200:
+        raise RuntimeError(f'{path_name} /classify_disease returned {response.status_code}: {response.get_data(as_text=True)}')
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_benchmark(sizes, runs, paths):
+    workdir = tempfile.mkdtemp(prefix='pipeline_bench_')
+    os.makedirs(os.path.join(workdir, 'uploads'))
+
+    # The apps print a lot while classifying; keep stdout clean for --json
+    with contextlib.redirect_stdout(io.StringIO()):
+        import app
+        import app_community
+        import history
+        import inference_cascade
+        import similarity_index
+
+        history.DB_NAME = os.path.join(workdir, 'history.db')
+        history.init_db()
+        similarity_index.EMBEDDINGS_DIR = os.path.join(workdir, 'embeddings')
+        app.app.config['UPLOAD_FOLDER'] = os.path.join(workdir, 'uploads')
+        app_community.app.config['UPLOAD_FOLDER'] = os.path.join(workdir, 'uploads')
+        app.load_trained_model()
+
+        results = {}
+        for size in sizes:
+            width, height = (int(v) for v in size.lower().split('x'))
+            jpeg_bytes = make_leaf_jpeg(width, height)
+            results[size] = {'upload_bytes': len(jpeg_bytes), 'paths': {}}
+
+            for path_name in paths:
+                timer = StageTimer()
+                run_stages(path_name, jpeg_bytes, workdir, StageTimer())  # warm up
+                for _ in range(runs):
+                    run_stages(path_name, jpeg_bytes, workdir, timer)
+                run_end_to_end(path_name, jpeg_bytes, StageTimer())  # warm up
+                for _ in range(runs):
+                    run_end_to_end(path_name, jpeg_bytes, timer)
+                results[size]['paths'][path_name] = timer.report()
+
+    return {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+            'runs': runs,
+            'model_loaded': bool(app.model_loaded),
+            'cascade_order': inference_cascade.CASCADE_ORDER,
+        },
+        'results': results,
+    }
+
+
+def compare(baseline, current):
+    """Median change per stage against an earlier --json run"""
+    print("\n" + "="*78)
+    print(f"BASELINE {baseline['meta'].get('commit')}  ->  CURRENT {current['meta'].get('commit')}")
+    print("="*78)
+    print(f"{'size / path / stage':<46}{'base (ms)':>10}{'now (ms)':>10}{'change':>12}")
+    print("-"*78)
+    for size, result in current['results'].items():
+        for path_name, stages in result['paths'].items():
+            base_stages = baseline['results'].get(size, {}).get('paths', {}).get(path_name, {})
+            for stage, stats in stages.items():
+                if stage not in base_stages:
+                    continue
+                before, after = base_stages[stage]['median_ms'], stats['median_ms']
+                change = f"{(after - before) / before * 100:+.1f}%" if before else 'n/a'
+                print(f"{size + ' / ' + path_name + ' / ' + stage:<46}{before:>10.2f}{after:>10.2f}{change:>12}")
+    print("="*78 + "\n")
+
+
+def print_report(report):
+    meta = report['meta']
+    print("\n" + "="*72)
+    print(f"DISEASE PIPELINE STAGES (commit {meta['commit']}, {meta['runs']} runs, "
+          f"model {'loaded' if meta['model_loaded'] else 'not loaded'}, {meta['cascade_order']})")
+    print("="*72)
+    for size, result in report['results'].items():
+        print(f"\n{size}  ({result['upload_bytes'] / 1024:.0f} KB upload)")
+        print(f"{'stage':<20}" + ''.join(f"{path_name:>18}" for path_name in result['paths']))
+        print("-"*72)
+        stages = next(iter(result['paths'].values()))
+        for stage in stages:
+            row = ''.join(f"{result['paths'][p].get(stage, {}).get('median_ms', float('nan')):>15.2f} ms"
+                          for p in result['paths'])
+            print(f"{stage:<20}{row}")
+    print("="*72 + "\n")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-stage timing of the disease classification pipeline')
+    parser.add_argument('--sizes', default=','.join(DEFAULT_SIZES), help='comma-separated WIDTHxHEIGHT list')
+    parser.add_argument('-n', '--runs', type=int, default=5, help='timed runs per size and path')
+    parser.add_argument('--paths', default=','.join(PATHS), help='app, app_community or both')
+    parser.add_argument('--json', action='store_true', help='print machine-readable JSON')
+    parser.add_argument('--compare', metavar='BASELINE', help='compare against an earlier --json output')
+    args = parser.parse_args()
+
+    report = run_benchmark(args.sizes.split(','), args.runs, args.paths.split(','))
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    elif args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+    else:
+        print_report(report)
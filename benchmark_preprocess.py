@@ -0,0 +1,86 @@
+"""
+ML preprocessing benchmark
+Compares the original float64 preprocessing (np.array(img) / 255.0 plus
+np.expand_dims) with the preallocated float32 buffer path in app.py.
+
+Usage:
+    python benchmark_preprocess.py
+    python benchmark_preprocess.py --size 3000x4000 -n 50
+"""
+
+import argparse
+import os
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+
+from app import get_ml_input_buffer, preprocess_image_for_ml, scale_pixels_into
+
+
+def legacy_preprocess(image_path):
+    """preprocess_image_for_ml as it was before the float32 buffers"""
+    img = Image.open(image_path).convert('RGB')
+    img = img.resize((224, 224))
+    img_array = np.array(img) / 255.0
+    img_array = np.expand_dims(img_array, axis=0)
+    return img_array.astype(np.float32)  # what TensorFlow does with the input
+
+
+def scale_only_legacy(pixels):
+    return np.expand_dims(pixels / 255.0, axis=0).astype(np.float32)
+
+
+def scale_only_buffer(pixels):
+    return scale_pixels_into(pixels, get_ml_input_buffer(1)[0])
+
+
+def measure(func, arg, runs):
+    func(arg)  # warm up (allocates the reusable buffer once)
+
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func(arg)
+        times.append((time.perf_counter() - start) * 1e6)
+
+    tracemalloc.start()
+    func(arg)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return statistics.median(times), peak
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Float32 preprocessing buffers vs original path')
+    parser.add_argument('--size', default='3000x4000', help='HEIGHTxWIDTH of the synthetic image')
+    parser.add_argument('-n', '--runs', type=int, default=30)
+    args = parser.parse_args()
+
+    height, width = (int(v) for v in args.size.lower().split('x'))
+    rng = np.random.default_rng(0)
+    fd, path = tempfile.mkstemp(suffix='.jpg')
+    os.close(fd)
+    Image.fromarray(rng.integers(0, 255, (height, width, 3), dtype=np.uint8)).save(path, quality=90)
+    pixels = np.asarray(Image.open(path).convert('RGB').resize((224, 224)))
+
+    try:
+        rows = [
+            ('full, original', measure(legacy_preprocess, path, args.runs)),
+            ('full, float32 buffer', measure(preprocess_image_for_ml, path, args.runs)),
+            ('scale only, original', measure(scale_only_legacy, pixels, args.runs * 20)),
+            ('scale only, float32 buffer', measure(scale_only_buffer, pixels, args.runs * 20)),
+        ]
+    finally:
+        os.remove(path)
+
+    print("\n" + "="*72)
+    print(f"{'path':<30}{'median (us)':>14}{'peak alloc (KB)':>18}")
+    print("-"*72)
+    for name, (median_us, peak) in rows:
+        print(f"{name:<30}{median_us:>14.1f}{peak / 1024:>18.1f}")
+    print("="*72 + "\n")
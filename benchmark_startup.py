@@ -0,0 +1,119 @@
+"""
+Startup-time benchmark
+Measures the cold import cost of each application module in a fresh
+interpreter using `python -X importtime`.
+
+Usage:
+    python benchmark_startup.py                 # all modules, 3 runs each
+    python benchmark_startup.py app history -n 5
+    python benchmark_startup.py --json > bench_output.txt
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+DEFAULT_MODULES = [
+    'history',
+    'weather',
+    'pdf_generator',
+    'community_models',
+    'app',
+    'app_community',
+]
+
+
+def parse_importtime(stderr):
+    """Parse `-X importtime` output into {module: (self_us, cumulative_us)}"""
+    timings = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        parts = line[len('import time:'):].split('|')
+        if len(parts) != 3:
+            continue
+        try:
+            self_us = int(parts[0].strip())
+            cumulative_us = int(parts[1].strip())
+        except ValueError:
+            continue  # header line
+        timings[parts[2].strip()] = (self_us, cumulative_us)
+    return timings
+
+
+def measure_module(module_name, cwd):
+    """Import a single module in a fresh interpreter and time it"""
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module_name}'],
+        cwd=cwd, capture_output=True, text=True
+    )
+    wall_ms = (time.perf_counter() - start) * 1000
+
+    timings = parse_importtime(proc.stderr)
+    self_us, cumulative_us = timings.get(module_name, (0, 0))
+    heaviest = sorted(
+        ((name, cum) for name, (_, cum) in timings.items() if name != module_name),
+        key=lambda item: item[1], reverse=True
+    )[:5]
+
+    return {
+        'ok': proc.returncode == 0,
+        'wall_ms': wall_ms,
+        'import_ms': cumulative_us / 1000,
+        'self_ms': self_us / 1000,
+        'tensorflow_imported': any(name.split('.')[0] == 'tensorflow' for name in timings),
+        'heaviest': [{'module': name, 'ms': cum / 1000} for name, cum in heaviest],
+    }
+
+
+def run_benchmark(modules, runs, cwd):
+    results = {}
+    for module_name in modules:
+        samples = [measure_module(module_name, cwd) for _ in range(runs)]
+        last = samples[-1]
+        results[module_name] = {
+            'ok': all(s['ok'] for s in samples),
+            'runs': runs,
+            'wall_ms_median': statistics.median(s['wall_ms'] for s in samples),
+            'import_ms_median': statistics.median(s['import_ms'] for s in samples),
+            'import_ms_min': min(s['import_ms'] for s in samples),
+            'tensorflow_imported': last['tensorflow_imported'],
+            'heaviest': last['heaviest'],
+        }
+    return results
+
+
+def print_report(results):
+    print("\n" + "="*72)
+    print("STARTUP IMPORT COST PER MODULE")
+    print("="*72)
+    print(f"{'module':<20}{'import (ms)':>14}{'min (ms)':>12}{'wall (ms)':>12}{'TF':>6}")
+    print("-"*72)
+    for module_name, r in results.items():
+        status = '' if r['ok'] else '  [FAILED]'
+        tf_flag = 'yes' if r['tensorflow_imported'] else 'no'
+        print(f"{module_name:<20}{r['import_ms_median']:>14.1f}{r['import_ms_min']:>12.1f}"
+              f"{r['wall_ms_median']:>12.1f}{tf_flag:>6}{status}")
+        for heavy in r['heaviest']:
+            print(f"    {heavy['module']:<40}{heavy['ms']:>10.1f} ms")
+    print("="*72 + "\n")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure cold import time of application modules')
+    parser.add_argument('modules', nargs='*', default=DEFAULT_MODULES)
+    parser.add_argument('-n', '--runs', type=int, default=3, help='runs per module (median is reported)')
+    parser.add_argument('--json', action='store_true', help='print machine-readable JSON')
+    args = parser.parse_args()
+
+    results = run_benchmark(args.modules, args.runs, os.path.dirname(os.path.abspath(__file__)))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results)
@@ -0,0 +1,205 @@
+"""
+Per-worker memory benchmark
+Forks workers the way gunicorn does and measures each one's memory once it
+has served some predictions, for:
+
+  per-worker        every worker imports the app and loads its own models
+                    (gunicorn without preload_app)
+  preload           the master imports the app and freezes the GC before
+                    forking (gunicorn.conf.py)
+  preload-nofreeze  preloaded, but without gc.freeze()
+
+RSS counts shared pages in every worker; PSS splits them between the
+processes sharing them, so the total PSS is the real footprint. Workers also
+run the disease model when one is loaded; with the TFLite model, the
+model-file columns show how much of the file each worker maps (RSS) and what
+that costs it once shared (PSS). Linux only.
+
+Usage:
+    python benchmark_worker_memory.py
+    python benchmark_worker_memory.py --workers 8 --requests 500
+    python benchmark_worker_memory.py --json > bench_output.txt
+"""
+
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+MODES = ['per-worker', 'preload', 'preload-nofreeze']
+
+MB = 1024 * 1024
+
+
+def import_app():
+    with contextlib.redirect_stdout(io.StringIO()):
+        import app
+    return app
+
+
+def mapped_file_memory(path, pid='self'):
+    """{'rss', 'pss', 'private'} in bytes of the mappings of one file, from /proc/<pid>/smaps"""
+    path = os.path.abspath(path)
+    totals = {'rss': 0, 'pss': 0, 'private': 0}
+    in_file = False
+    with open(f'/proc/{pid}/smaps') as f:
+        for line in f:
+            parts = line.split()
+            if not parts[0].endswith(':'):
+                # Mapping header: address perms offset dev inode [pathname]
+                in_file = len(parts) >= 6 and parts[5] == path
+            elif in_file and len(parts) == 3:
+                key = parts[0].rstrip(':')
+                if key == 'Rss':
+                    totals['rss'] += int(parts[1]) * 1024
+                elif key == 'Pss':
+                    totals['pss'] += int(parts[1]) * 1024
+                elif key in ('Private_Clean', 'Private_Dirty'):
+                    totals['private'] += int(parts[1]) * 1024
+    return totals
+
+
+def serve(app, requests):
+    """Stand-in for a worker's traffic: disease and crop predictions, color rules, disease info"""
+    rng = np.random.default_rng(os.getpid())
+    with contextlib.redirect_stdout(io.StringIO()):
+        if app.MODEL_AVAILABLE:
+            app.load_trained_model()
+        for _ in range(requests):
+            if app.model is not None:
+                app.model.predict(rng.uniform(0, 1, (1, 224, 224, 3)).astype(np.float32), verbose=0)
+            if app.crop_model is not None:
+                app.crop_model.predict_proba(rng.uniform(0, 200, (1, 7)))
+            features = {name: float(rng.uniform(0, 1)) if 'ratio' in name else float(rng.uniform(0, 255))
+                        for name in app.color_analysis.FEATURE_NAMES}
+            disease, _ = app.classify_color_features(features)
+            app.get_disease_info(disease)
+    # A long-running worker collects sooner or later
+    gc.collect()
+
+
+def run_mode(mode, workers, requests):
+    """Runs in a fresh interpreter; prints one JSON line"""
+    app = None
+    if mode != 'per-worker':
+        app = import_app()
+        if mode == 'preload':
+            with contextlib.redirect_stdout(io.StringIO()):
+                app.model_sharing.prepare_for_fork()
+
+    import metrics
+    import model_sharing
+
+    children = []
+    for _ in range(workers):
+        ready_r, ready_w = os.pipe()
+        go_r, go_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready_r)
+            os.close(go_w)
+            # Holding another worker's pipe would keep it from seeing EOF
+            for _, other_ready_r, other_go_w in children:
+                os.close(other_ready_r)
+                os.close(other_go_w)
+            serve(app or import_app(), requests)
+            os.write(ready_w, b'1')
+            os.read(go_r, 1)  # stay alive until every worker has been measured
+            os._exit(0)
+        os.close(ready_w)
+        os.close(go_r)
+        children.append((pid, ready_r, go_w))
+
+    for _, ready_r, _ in children:
+        os.read(ready_r, 1)
+    worker_memory = [metrics.process_memory(pid) for pid, _, _ in children]
+    master_memory = metrics.process_memory()
+    model_file = None
+    if os.path.exists(model_sharing.TFLITE_MODEL_PATH):
+        model_file = [mapped_file_memory(model_sharing.TFLITE_MODEL_PATH, pid) for pid, _, _ in children]
+
+    for pid, ready_r, go_w in children:
+        os.close(go_w)
+        os.close(ready_r)
+        os.waitpid(pid, 0)
+
+    app = app or import_app()
+    print(json.dumps({
+        'mode': mode,
+        'workers': worker_memory,
+        'master': master_memory,
+        'model_file': model_file,
+        'crop_model': app.crop_model is not None,
+        'disease_model': type(app.model).__name__ if app.model is not None else None,
+    }))
+
+
+def summarize(result):
+    workers = result['workers']
+    mean = lambda key: sum(w[key] for w in workers) / len(workers) / MB
+    summary = {
+        'mode': result['mode'],
+        'worker_rss_mb': round(mean('rss'), 1),
+        'worker_pss_mb': round(mean('pss'), 1),
+        'worker_private_mb': round(mean('private'), 1),
+        'master_pss_mb': round(result['master']['pss'] / MB, 1),
+        'total_pss_mb': round((sum(w['pss'] for w in workers) + result['master']['pss']) / MB, 1),
+    }
+    if result['model_file']:
+        model_file = result['model_file']
+        summary['model_file_rss_mb'] = round(sum(m['rss'] for m in model_file) / len(model_file) / MB, 1)
+        summary['model_file_pss_mb'] = round(sum(m['pss'] for m in model_file) / len(model_file) / MB, 1)
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Memory per pre-forked worker, with and without preloading')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=200, help='predictions served by each worker')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES)
+    parser.add_argument('--json', action='store_true', help='print raw JSON results')
+    parser.add_argument('--run-mode', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_mode:
+        run_mode(args.run_mode, args.workers, args.requests)
+        sys.exit(0)
+
+    env = dict(os.environ, LOG_LEVEL='WARNING', COLOR_POOL_WORKERS='0')
+    results = []
+    for mode in args.modes:
+        proc = subprocess.run([sys.executable, __file__, '--run-mode', mode,
+                               '--workers', str(args.workers), '--requests', str(args.requests)],
+                              capture_output=True, text=True, env=env)
+        if proc.returncode != 0:
+            sys.exit(f"{mode} failed:\n{proc.stderr}")
+        results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+
+    if args.json:
+        print(json.dumps({'summary': [summarize(r) for r in results], 'raw': results}, indent=2))
+        sys.exit(0)
+
+    print("\n" + "="*84)
+    print(f"MEMORY PER WORKER ({args.workers} workers, {args.requests} predictions each)")
+    print(f"Crop model loaded: {results[0]['crop_model']}   Disease model: {results[0]['disease_model']}")
+    print("="*84)
+    print(f"{'mode':<20}{'RSS/worker':>13}{'PSS/worker':>13}{'private/worker':>16}{'master PSS':>12}{'total PSS':>11}")
+    for r in results:
+        s = summarize(r)
+        print(f"{s['mode']:<20}{s['worker_rss_mb']:>10.1f} MB{s['worker_pss_mb']:>10.1f} MB"
+              f"{s['worker_private_mb']:>13.1f} MB{s['master_pss_mb']:>9.1f} MB{s['total_pss_mb']:>8.1f} MB")
+    if any('model_file_rss_mb' in summarize(r) for r in results):
+        print(f"\nTFLite model file ({results[0]['disease_model']}), mapped per worker:")
+        for r in results:
+            s = summarize(r)
+            if 'model_file_rss_mb' in s:
+                print(f"{s['mode']:<20}RSS {s['model_file_rss_mb']:>8.1f} MB   PSS {s['model_file_pss_mb']:>8.1f} MB")
+    elif results[0]['disease_model'] is None:
+        print("No disease model loaded: the TFLite sharing is not measured")
+    print("="*84 + "\n")
@@ -0,0 +1,146 @@
+"""
+Color Feature Extraction
+Decode, resize and color statistics used by the enhanced (non-ML) disease
+classifier, plus an optional process pool that runs this CPU-bound stage
+outside the request thread.
+
+Image bytes are handed to pool workers through multiprocessing.shared_memory,
+so only the small feature dict is pickled on the way back.
+"""
+
+import io
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+from PIL import Image
+
+ANALYSIS_SIZE = (224, 224)
+
+# Order of the features in a feature matrix row (see color_rules)
+FEATURE_NAMES = ('r_mean', 'g_mean', 'b_mean', 'rg_ratio', 'rb_ratio', 'gb_ratio', 'total_std',
+                 'bright_ratio', 'dark_ratio', 'red_ratio', 'orange_ratio', 'yellow_ratio',
+                 'green_ratio', 'brown_ratio')
+
+# 0 disables the pool and runs feature extraction in the calling thread
+POOL_WORKERS = int(os.getenv('COLOR_POOL_WORKERS', 0))
+
+_executor = None
+
+
+def compute_color_features(img_array):
+    """Color statistics of an RGB uint8 array, as a dict of floats"""
+    r = img_array[:, :, 0]
+    g = img_array[:, :, 1]
+    b = img_array[:, :, 2]
+    total_pixels = r.size
+
+    # Color statistics
+    r_mean, g_mean, b_mean = r.mean(), g.mean(), b.mean()
+    r_std, g_std, b_std = r.std(), g.std(), b.std()
+
+    features = {
+        'r_mean': r_mean,
+        'g_mean': g_mean,
+        'b_mean': b_mean,
+        # Color ratios
+        'rg_ratio': r_mean / (g_mean + 1),
+        'rb_ratio': r_mean / (b_mean + 1),
+        'gb_ratio': g_mean / (b_mean + 1),
+        # Overall variability
+        'total_std': (r_std + g_std + b_std) / 3,
+        # Bright spots (potential diseases)
+        'bright_ratio': np.sum((r > 200) & (g > 200) & (b > 200)) / total_pixels,
+        # Dark spots (diseases)
+        'dark_ratio': np.sum((r < 60) & (g < 60) & (b < 60)) / total_pixels,
+        # Red/ripe fruit (tomatoes, apples)
+        'red_ratio': np.sum((r > 140) & (r > g * 1.3) & (r > b * 1.3)) / total_pixels,
+        # Orange colors (tomatoes, rust diseases)
+        'orange_ratio': np.sum((r > 150) & (g > 80) & (g < 150) & (b < 100)) / total_pixels,
+        # Yellow/pale colors (rust, yellowing diseases)
+        'yellow_ratio': np.sum((r > 150) & (g > 130) & (b < 120)) / total_pixels,
+        # Green vegetation
+        'green_ratio': np.sum((g > r) & (g > b) & (g > 60)) / total_pixels,
+        # Brown/tan (dead tissue, blight)
+        'brown_ratio': np.sum((r > 80) & (r < 160) & (g > 60) & (g < 140) & (b < 100)) / total_pixels,
+    }
+    return {name: float(value) for name, value in features.items()}
+
+
+def extract_features(source):
+    """Decode an image (path or file-like), resize it and compute color features"""
+    img = Image.open(source).convert('RGB')
+    img_resized = img.resize(ANALYSIS_SIZE)
+    return compute_color_features(np.array(img_resized))
+
+
+def _warm_up(_):
+    # Long enough that the executor has to start every worker
+    time.sleep(0.1)
+    return os.getpid()
+
+
+def _extract_from_shared_memory(shm_name, size):
+    """Pool worker: decode image bytes from a shared memory block"""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    buf = shm.buf[:size]
+    try:
+        return extract_features(io.BytesIO(buf))
+    finally:
+        buf.release()
+        shm.close()
+
+
+def start_pool(num_workers=None):
+    """Start the worker processes now rather than on the first request"""
+    global _executor
+
+    num_workers = num_workers or POOL_WORKERS
+    if _executor is not None or num_workers <= 0:
+        return
+
+    # Workers must share the parent's resource tracker. If it is not running
+    # before the fork, each worker starts its own and reports every shared
+    # memory block it attached to as leaked.
+    resource_tracker.ensure_running()
+
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if 'fork' in methods else 'spawn')
+    _executor = ProcessPoolExecutor(max_workers=num_workers, mp_context=context)
+
+    # Workers are created lazily by the executor; force them all up front
+    list(_executor.map(_warm_up, range(num_workers)))
+    print(f"[OK] Color analysis pool started ({num_workers} worker processes)")
+
+
+def shutdown_pool():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+
+def pool_running():
+    return _executor is not None
+
+
+def extract_features_pooled(image_path):
+    """Extract color features in the process pool if it is running, else inline"""
+    if _executor is None:
+        return extract_features(image_path)
+
+    with open(image_path, 'rb') as f:
+        data = f.read()
+    if not data:
+        raise ValueError(f'Empty image file: {image_path}')
+
+    shm = shared_memory.SharedMemory(create=True, size=len(data))
+    try:
+        shm.buf[:len(data)] = data
+        return _executor.submit(_extract_from_shared_memory, shm.name, len(data)).result()
+    finally:
+        shm.close()
+        shm.unlink()
@@ -0,0 +1,382 @@
+"""
+Color Heuristic Decision Table
+The enhanced (non-ML) classifier as data: an ordered table of plant-type
+rules, then per-plant disease rules, each a set of thresholds over the color
+features from color_analysis. The first matching rule wins; a rule without
+a condition always matches.
+
+Conditions are nested lists/dicts so a table can be stored as JSON:
+    ['green_ratio', '>', 0.45]                  one threshold
+    {'all': [cond, ...]}, {'any': [cond, ...]}  and / or
+
+The table is compiled once into two evaluators that give identical
+results: generated if/elif code for single images, and a vectorized one
+that classifies an (N, features) matrix with one NumPy mask per condition.
+
+A re-tuned table can be loaded from COLOR_RULES_FILE (see
+tune_color_rules.py).
+"""
+
+import copy
+import json
+import operator
+import os
+
+import numpy as np
+
+from color_analysis import FEATURE_NAMES
+
+FEATURE_INDEX = {name: i for i, name in enumerate(FEATURE_NAMES)}
+
+OPERATORS = {'>': operator.gt, '<': operator.lt, '>=': operator.ge, '<=': operator.le}
+
+DEFAULT_PLANT = 'general'
+
+# Below this many rows the generated scalar code beats NumPy's per-call overhead
+VECTORIZE_MIN_ROWS = 128
+
+# ============================================================================
+# STEP 1: PLANT TYPE (first match wins, otherwise DEFAULT_PLANT)
+# ============================================================================
+
+_GRASS = {'all': [['green_ratio', '>', 0.35],
+                  {'any': [['yellow_ratio', '>', 0.05], ['brown_ratio', '>', 0.05], ['dark_ratio', '>', 0.05]]},
+                  ['total_std', '<', 65]]}
+_BUSH = {'all': [['green_ratio', '>', 0.6], ['dark_ratio', '<', 0.1], ['r_mean', '<', 100]]}
+
+PLANT_RULES = [
+    # Tomato fruit (red/orange round fruit)
+    {'plant': 'tomato', 'when': {'all': [['red_ratio', '>', 0.2], ['orange_ratio', '>', 0.2], ['r_mean', '>', 150]]}},
+    # Apple/fruit trees (woody stems, round fruits)
+    {'plant': 'apple', 'when': {'all': [['red_ratio', '>', 0.15], ['green_ratio', '>', 0.35]]}},
+    # Cotton (white bolls)
+    {'plant': 'cotton', 'when': {'all': [['bright_ratio', '>', 0.1], ['green_ratio', '>', 0.3]]}},
+    # Corn/maize (elongated yellow-green leaves)
+    {'plant': 'corn', 'when': {'all': [['green_ratio', '>', 0.45], ['yellow_ratio', '>', 0.1],
+                                       ['r_mean', '<', 140], ['total_std', '<', 60]]}},
+    # Wheat/rice (grass-like, thin leaves)
+    {'plant': 'wheat', 'when': {'all': [_GRASS, ['yellow_ratio', '>', 0.15]]}},
+    {'plant': 'rice', 'when': _GRASS},
+    # Sugarcane (tall grass)
+    {'plant': 'sugarcane', 'when': {'all': [['green_ratio', '>', 0.5], ['r_mean', '<', 120], ['total_std', '<', 50]]}},
+    # Potato (broader darker leaves, or a tuber)
+    {'plant': 'potato', 'when': {'any': [
+        {'all': [['green_ratio', '>', 0.55], ['r_mean', '<', 90], ['brown_ratio', '>', 0.12]]},
+        {'all': [['green_ratio', '<', 0.15], ['bright_ratio', '>', 0.3], ['total_std', '>', 40]]}]}},
+    # Grape (broad vine leaves)
+    {'plant': 'grape', 'when': {'all': [['green_ratio', '>', 0.5],
+                                        {'any': [['dark_ratio', '>', 0.05], ['brown_ratio', '>', 0.05]]},
+                                        ['rg_ratio', '<', 1.1]]}},
+    # Coffee/tea (bushy dark green leaves)
+    {'plant': 'coffee', 'when': {'all': [_BUSH, ['brown_ratio', '>', 0.05]]}},
+    {'plant': 'tea', 'when': _BUSH},
+]
+
+# ============================================================================
+# STEP 2: DISEASE PER PLANT TYPE (first match wins; the last rule is the default)
+# ============================================================================
+
+DISEASE_RULES = {
+    'tomato': [
+        {'disease': 'Tomato___Late_blight', 'confidence': 82,
+         'when': {'all': [['dark_ratio', '>', 0.05], ['brown_ratio', '>', 0.1], ['total_std', '>', 45]]}},
+        {'disease': 'Tomato___Bacterial_spot', 'confidence': 78,
+         'when': {'all': [['dark_ratio', '>', 0.03], ['total_std', '>', 50]]}},
+        {'disease': 'Tomato___Early_blight', 'confidence': 75,
+         'when': {'all': [['brown_ratio', '>', 0.15], ['total_std', '>', 40]]}},
+        {'disease': 'Tomato___Target_Spot', 'confidence': 72,
+         'when': {'all': [['brown_ratio', '>', 0.1], ['dark_ratio', '>', 0.02]]}},
+        {'disease': 'Tomato___Septoria_leaf_spot', 'confidence': 70,
+         'when': {'all': [['dark_ratio', '>', 0.02], ['yellow_ratio', '>', 0.05]]}},
+        {'disease': 'Tomato___Tomato_Yellow_Leaf_Curl_Virus', 'confidence': 80,
+         'when': {'all': [['yellow_ratio', '>', 0.3], ['green_ratio', '<', 0.3]]}},
+        {'disease': 'Tomato___Leaf_Mold', 'confidence': 68,
+         'when': {'all': [['yellow_ratio', '>', 0.2], ['brown_ratio', '>', 0.05]]}},
+        {'disease': 'Tomato___healthy', 'confidence': 85,
+         'when': {'all': [['red_ratio', '>', 0.2], ['dark_ratio', '<', 0.02]]}},
+        {'disease': 'Tomato___Bacterial_spot', 'confidence': 65},
+    ],
+    'corn': [
+        {'disease': 'Corn_(maize)___Common_rust_', 'confidence': 78,
+         'when': {'all': [['yellow_ratio', '>', 0.15], ['orange_ratio', '>', 0.1]]}},
+        {'disease': 'Corn_(maize)___Northern_Leaf_Blight', 'confidence': 75,
+         'when': {'all': [['brown_ratio', '>', 0.15], ['total_std', '>', 45]]}},
+        {'disease': 'Corn_(maize)___Cercospora_leaf_spot Gray_leaf_spot', 'confidence': 72,
+         'when': {'all': [['brown_ratio', '>', 0.1], ['dark_ratio', '>', 0.05]]}},
+        {'disease': 'Corn_(maize)___healthy', 'confidence': 85,
+         'when': {'all': [['green_ratio', '>', 0.5], ['dark_ratio', '<', 0.02]]}},
+        {'disease': 'Corn_(maize)___Common_rust_', 'confidence': 68},
+    ],
+    'potato': [
+        # Tuber rot / hollow heart (little green) is reported as late blight
+        {'disease': 'Potato___Late_blight', 'confidence': 90,
+         'when': {'all': [['green_ratio', '<', 0.2],
+                          {'any': [['bright_ratio', '>', 0.3], ['brown_ratio', '>', 0.05], ['dark_ratio', '>', 0.05]]}]}},
+        {'disease': 'Potato___healthy', 'confidence': 80, 'when': ['green_ratio', '<', 0.2]},
+        {'disease': 'Potato___Late_blight', 'confidence': 82,
+         'when': {'all': [['dark_ratio', '>', 0.1], ['brown_ratio', '>', 0.15]]}},
+        {'disease': 'Potato___Early_blight', 'confidence': 76,
+         'when': {'all': [['brown_ratio', '>', 0.15], ['total_std', '>', 40]]}},
+        {'disease': 'Potato___healthy', 'confidence': 85, 'when': ['green_ratio', '>', 0.6]},
+        {'disease': 'Potato___Early_blight', 'confidence': 70},
+    ],
+    'apple': [
+        {'disease': 'Apple___Apple_scab', 'confidence': 75,
+         'when': {'all': [['dark_ratio', '>', 0.05], ['brown_ratio', '>', 0.1]]}},
+        {'disease': 'Apple___Black_rot', 'confidence': 78, 'when': ['dark_ratio', '>', 0.1]},
+        {'disease': 'Apple___Cedar_apple_rust', 'confidence': 72,
+         'when': {'all': [['orange_ratio', '>', 0.05], ['yellow_ratio', '>', 0.1]]}},
+        {'disease': 'Apple___healthy', 'confidence': 85,
+         'when': {'any': [['red_ratio', '>', 0.3], ['green_ratio', '>', 0.5]]}},
+        {'disease': 'Apple___Apple_scab', 'confidence': 68},
+    ],
+    'rice': [
+        {'disease': 'Rice_Brown_Spot', 'confidence': 75, 'when': ['brown_ratio', '>', 0.15]},
+        {'disease': 'Rice_Tungro', 'confidence': 78, 'when': ['yellow_ratio', '>', 0.2]},
+        {'disease': 'Rice_Blast', 'confidence': 72, 'when': ['total_std', '>', 55]},
+        {'disease': 'Rice_Blast', 'confidence': 65},
+    ],
+    'wheat': [
+        {'disease': 'Wheat_Rust', 'confidence': 80,
+         'when': {'any': [['orange_ratio', '>', 0.1], ['yellow_ratio', '>', 0.15]]}},
+        {'disease': 'Wheat_Septoria', 'confidence': 75, 'when': ['brown_ratio', '>', 0.1]},
+        {'disease': 'Wheat_Rust', 'confidence': 70},
+    ],
+    'grape': [
+        {'disease': 'Grape_Black_Rot', 'confidence': 82, 'when': ['dark_ratio', '>', 0.1]},
+        {'disease': 'Esca', 'confidence': 75, 'when': ['brown_ratio', '>', 0.15]},
+        {'disease': 'Grape___Leaf_blight_(Isariopsis_Leaf_Spot)', 'confidence': 72, 'when': ['yellow_ratio', '>', 0.1]},
+        {'disease': 'Grape___healthy', 'confidence': 80},
+    ],
+    'tea': [
+        {'disease': 'Tea_Blister_Blight', 'confidence': 78, 'when': ['bright_ratio', '>', 0.05]},
+        {'disease': 'Tea_Red_Rust', 'confidence': 75, 'when': ['orange_ratio', '>', 0.05]},
+        {'disease': 'Tea_Blister_Blight', 'confidence': 65},
+    ],
+    'coffee': [
+        {'disease': 'Coffee_Rust', 'confidence': 85,
+         'when': {'any': [['orange_ratio', '>', 0.1], ['brown_ratio', '>', 0.1]]}},
+        {'disease': 'Coffee_Berry_Disease', 'confidence': 75, 'when': ['dark_ratio', '>', 0.05]},
+        {'disease': 'Coffee_Rust', 'confidence': 70},
+    ],
+    'cotton': [
+        {'disease': 'Cotton_Bacterial_Blight', 'confidence': 78, 'when': ['dark_ratio', '>', 0.05]},
+        {'disease': 'Cotton_Curl_Virus', 'confidence': 75, 'when': ['yellow_ratio', '>', 0.15]},
+        {'disease': 'Cotton_Bacterial_Blight', 'confidence': 65},
+    ],
+    'sugarcane': [
+        {'disease': 'Sugarcane_Red_Rot', 'confidence': 80,
+         'when': {'any': [['red_ratio', '>', 0.1], ['brown_ratio', '>', 0.15]]}},
+        {'disease': 'Sugarcane_Rust', 'confidence': 75,
+         'when': {'any': [['orange_ratio', '>', 0.05], ['yellow_ratio', '>', 0.1]]}},
+        {'disease': 'Sugarcane_Red_Rot', 'confidence': 70},
+    ],
+    # Plant type unknown: generic symptom patterns
+    'general': [
+        # Rust (orange/reddish-brown pustules)
+        {'disease': 'Corn_(maize)___Common_rust_', 'confidence': 75,
+         'when': {'all': [{'any': [['orange_ratio', '>', 0.05],
+                                   {'all': [['r_mean', '>', 130], ['g_mean', '<', 120]]}]},
+                          ['total_std', '>', 40]]}},
+        # Bacterial/leaf spots (small dark spots with yellow halos)
+        {'disease': 'Tomato___Bacterial_spot', 'confidence': 72,
+         'when': {'all': [['dark_ratio', '>', 0.05], ['yellow_ratio', '>', 0.05], ['total_std', '>', 45]]}},
+        # Early blight (concentric rings, brown spots)
+        {'disease': 'Potato___Early_blight', 'confidence': 74,
+         'when': {'all': [['brown_ratio', '>', 0.12], ['total_std', '>', 50]]}},
+        # Powdery mildew (white powdery appearance)
+        {'disease': 'Squash___Powdery_mildew', 'confidence': 78,
+         'when': {'all': [['bright_ratio', '>', 0.25], ['r_mean', '>', 160], ['g_mean', '>', 160]]}},
+        # Late blight (large dark lesions)
+        {'disease': 'Tomato___Late_blight', 'confidence': 80,
+         'when': {'all': [['dark_ratio', '>', 0.15], ['brown_ratio', '>', 0.1]]}},
+        # Yellowing/chlorosis (virus or deficiency)
+        {'disease': 'Tomato___Tomato_Yellow_Leaf_Curl_Virus', 'confidence': 70,
+         'when': {'all': [['yellow_ratio', '>', 0.25], ['green_ratio', '<', 0.4]]}},
+        # Healthy green (dominant green, few spots)
+        {'disease': 'Soybean___healthy', 'confidence': 85,
+         'when': {'all': [['green_ratio', '>', 0.55], ['dark_ratio', '<', 0.03], ['brown_ratio', '<', 0.05]]}},
+        {'disease': 'Tomato___Septoria_leaf_spot', 'confidence': 60},
+    ],
+}
+
+DEFAULT_TABLE = {'plants': PLANT_RULES, 'diseases': DISEASE_RULES}
+
+
+# ============================================================================
+# COMPILATION
+# ============================================================================
+
+def _scalar_expression(cond):
+    """Condition -> Python expression over the feature dict `f`"""
+    if isinstance(cond, dict):
+        (kind, parts), = cond.items()
+        if kind not in ('all', 'any'):
+            raise ValueError(f'Unknown condition type: {kind}')
+        joiner = ' and ' if kind == 'all' else ' or '
+        return '(' + joiner.join(_scalar_expression(part) for part in parts) + ')'
+
+    feature, op, threshold = cond
+    if feature not in FEATURE_INDEX:
+        raise ValueError(f'Unknown feature: {feature}')
+    if op not in OPERATORS:
+        raise ValueError(f'Unknown operator: {op}')
+    return f'f[{feature!r}] {op} {float(threshold)!r}'
+
+
+def _compile_scalar(plant_rules, disease_rules):
+    """Generate and compile `classify(f) -> (plant, disease, confidence)`.
+
+    Plain if/elif code is ~10x faster than interpreting the table per image.
+    """
+    lines = ['def classify(f):']
+    for n, rule in enumerate(plant_rules):
+        lines.append(f"    {'if' if n == 0 else 'elif'} {_scalar_expression(rule['when'])}:")
+        lines.append(f"        plant = {rule['plant']!r}")
+    lines.append('    else:' if plant_rules else '    if True:')
+    lines.append(f'        plant = {DEFAULT_PLANT!r}')
+
+    for plant, rules in disease_rules.items():
+        lines.append(f'    if plant == {plant!r}:')
+        for rule in rules:
+            output = f"plant, {rule['disease']!r}, {rule['confidence']!r}"
+            if rule.get('when') is None:
+                lines.append(f'        return {output}')
+                break
+            lines.append(f"        if {_scalar_expression(rule['when'])}:")
+            lines.append(f'            return {output}')
+
+    namespace = {}
+    exec(compile('\n'.join(lines), '<color_rules>', 'exec'), namespace)
+    return namespace['classify']
+
+
+def _compile_vector(cond):
+    """Condition -> function of an (N, features) matrix returning an (N,) mask"""
+    if isinstance(cond, dict):
+        (kind, parts), = cond.items()
+        if kind not in ('all', 'any'):
+            raise ValueError(f'Unknown condition type: {kind}')
+        masks = [_compile_vector(part) for part in parts]
+        combine = np.logical_and if kind == 'all' else np.logical_or
+
+        def evaluate(X):
+            result = masks[0](X)
+            for mask in masks[1:]:
+                result = combine(result, mask(X))
+            return result
+        return evaluate
+
+    feature, op, threshold = cond
+    column = FEATURE_INDEX[feature]
+    compare = OPERATORS[op]
+    return lambda X: compare(X[:, column], threshold)
+
+
+class DecisionTable:
+    """A compiled plant-type + disease rule table"""
+
+    def __init__(self, table=None):
+        self.table = copy.deepcopy(table if table is not None else DEFAULT_TABLE)
+
+        self.plants = [rule['plant'] for rule in self.table['plants']]
+        plant_names = self.plants + [DEFAULT_PLANT]
+        self.plant_index = {name: i for i, name in reversed(list(enumerate(plant_names)))}
+        self.plant_names = plant_names
+
+        self._plant_vector = [(self.plant_index[rule['plant']], _compile_vector(rule['when']))
+                              for rule in self.table['plants']]
+
+        # Disease outputs are numbered so the vectorized path works on ints
+        self.labels = []
+        label_index = {}
+        self._disease_vector = {}
+        for plant, rules in self.table['diseases'].items():
+            if rules[-1].get('when') is not None:
+                raise ValueError(f'The last {plant} rule must be a default (no condition)')
+            vector = []
+            for rule in rules:
+                output = (rule['disease'], rule['confidence'])
+                if output not in label_index:
+                    label_index[output] = len(self.labels)
+                    self.labels.append(output)
+                when = rule.get('when')
+                vector.append((label_index[output], _compile_vector(when) if when is not None else None))
+            self._disease_vector[plant] = vector
+
+        missing = set(plant_names) - set(self.table['diseases'])
+        if missing:
+            raise ValueError(f'No disease rules for plant types: {sorted(missing)}')
+
+        self._classify = _compile_scalar(self.table['plants'], self.table['diseases'])
+
+        # Plant type of every class the table can output (first plant listing it)
+        self.class_plants = {}
+        for plant, rules in self.table['diseases'].items():
+            for rule in rules:
+                self.class_plants.setdefault(rule['disease'], plant)
+
+        self.label_names = np.array([name for name, _ in self.labels], dtype=object)
+        self.label_confidence = np.array([confidence for _, confidence in self.labels], dtype=np.float64)
+
+    def classify(self, features):
+        """features dict -> (plant type, class name, confidence)"""
+        return self._classify(features)
+
+    def classify_matrix(self, X):
+        """(N, len(FEATURE_NAMES)) matrix -> (plant index array, label index array)
+
+        Same first-match semantics as classify(), one mask per condition.
+        """
+        X = np.asarray(X, dtype=np.float64)
+        n = len(X)
+
+        plants = np.full(n, self.plant_index[DEFAULT_PLANT], dtype=np.int32)
+        unassigned = np.ones(n, dtype=bool)
+        for plant_idx, mask in self._plant_vector:
+            hit = unassigned & mask(X)
+            plants[hit] = plant_idx
+            unassigned &= ~hit
+
+        labels = np.empty(n, dtype=np.int32)
+        for plant_idx, plant in enumerate(self.plant_names):
+            rows = np.flatnonzero(plants == plant_idx)
+            if len(rows) == 0 or self.plant_index[plant] != plant_idx:
+                continue
+            sub = X[rows]
+            pending = np.ones(len(rows), dtype=bool)
+            for label_idx, mask in self._disease_vector[plant]:
+                hit = pending if mask is None else pending & mask(sub)
+                labels[rows[hit]] = label_idx
+                pending &= ~hit
+        return plants, labels
+
+    def classify_batch(self, X):
+        """(N, features) matrix or list of rows -> list of (class name, confidence)"""
+        if len(X) < VECTORIZE_MIN_ROWS:
+            return [self._classify(dict(zip(FEATURE_NAMES, row)))[1:] for row in X]
+        _, labels = self.classify_matrix(X)
+        return [self.labels[i] for i in labels]
+
+
+def features_to_row(features):
+    return [features[name] for name in FEATURE_NAMES]
+
+
+def load_table(path):
+    with open(path) as f:
+        return DecisionTable(json.load(f))
+
+
+def save_table(table, path):
+    with open(path, 'w') as f:
+        json.dump(table.table if isinstance(table, DecisionTable) else table, f, indent=2)
+
+
+def set_active(table):
+    """Switch the table used by the app (e.g. after re-tuning)"""
+    global ACTIVE
+    ACTIVE = table
+
+
+ACTIVE = load_table(os.environ['COLOR_RULES_FILE']) if os.getenv('COLOR_RULES_FILE') else DecisionTable()
@@ -0,0 +1,318 @@
+"""
+Asynchronous Disease Analysis Jobs
+Persistent SQLite-backed job queue processed by a bounded pool of worker threads
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import urllib.parse
+import urllib.request
+import uuid
+
+import metrics
+import tracing
+
+DB_NAME = 'disease_jobs.db'
+
+NUM_WORKERS = int(os.getenv('INFERENCE_WORKERS', 2))
+MAX_QUEUE_DEPTH = int(os.getenv('MAX_JOB_QUEUE_DEPTH', 500))
+POLL_INTERVAL = 2.0
+# A 'running' job is taken back after this long even if its owner pid is
+# alive, in case the pid now belongs to a different process
+JOB_LEASE_SECONDS = int(os.getenv('JOB_LEASE_SECONDS', 3600))
+CALLBACK_TIMEOUT = 5
+
+# Callbacks may only target this machine
+LOCAL_CALLBACK_HOSTS = {'localhost', '127.0.0.1', '::1'}
+
+logger = tracing.get_logger('jobs')
+
+_handler = None
+_workers = []
+_start_lock = threading.Lock()
+_wakeup = threading.Condition()
+
+
+class QueueFullError(Exception):
+    """Raised when the job queue is at MAX_QUEUE_DEPTH"""
+
+
+def init_db():
+    """Initialize the database with the jobs table"""
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            filename TEXT,
+            filepath TEXT,
+            status TEXT,
+            result TEXT,
+            error TEXT,
+            callback_url TEXT,
+            created_at REAL,
+            started_at REAL,
+            finished_at REAL
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status_created ON jobs (status, created_at)')
+    # Process running each job, so a restarting worker only recovers jobs of dead ones
+    columns = [row[1] for row in c.execute('PRAGMA table_info(jobs)')]
+    if 'owner_pid' not in columns:
+        c.execute('ALTER TABLE jobs ADD COLUMN owner_pid INTEGER')
+    conn.commit()
+    conn.close()
+
+
+def _connect():
+    conn = sqlite3.connect(DB_NAME, timeout=30)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def _process_alive(pid):
+    if pid is None or pid == os.getpid() or os.name == 'nt':
+        # This process has no jobs running before its workers start, and on
+        # Windows (no gunicorn) there is no other worker process
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _recover_orphaned_jobs():
+    """Put 'running' jobs of processes that have exited back on the queue; returns how many"""
+    conn = _connect()
+    conn.isolation_level = None
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        expired = time.time() - JOB_LEASE_SECONDS
+        orphaned = [row['id'] for row in
+                    conn.execute("SELECT id, owner_pid, started_at FROM jobs WHERE status = 'running'")
+                    if not _process_alive(row['owner_pid']) or (row['started_at'] or 0) < expired]
+        conn.executemany("UPDATE jobs SET status = 'queued', started_at = NULL, owner_pid = NULL "
+                         "WHERE id = ? AND status = 'running'", [(job_id,) for job_id in orphaned])
+        conn.execute('COMMIT')
+        return len(orphaned)
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+
+def is_local_callback(url):
+    """Only plain http(s) callbacks to the local machine are allowed"""
+    parsed = urllib.parse.urlparse(url)
+    return parsed.scheme in ('http', 'https') and parsed.hostname in LOCAL_CALLBACK_HOSTS
+
+
+def start_workers(handler, num_workers=None):
+    """Start the worker pool once.
+
+    handler(filename, filepath) must return a JSON-serializable result dict.
+    Jobs left 'running' by a process that has exited are put back on the
+    queue; jobs other live workers are running are left alone.
+    """
+    global _handler
+
+    with _start_lock:
+        if _workers:
+            return
+        _handler = handler
+
+        recovered = _recover_orphaned_jobs()
+        if recovered:
+            tracing.log(logger, logging.INFO, 'requeued orphaned jobs', jobs=recovered)
+
+        for i in range(num_workers or NUM_WORKERS):
+            worker = threading.Thread(target=_worker_loop, name=f'disease-job-worker-{i}', daemon=True)
+            worker.start()
+            _workers.append(worker)
+
+        print(f"[OK] Started {len(_workers)} disease analysis workers")
+
+
+def submit_job(filename, filepath, callback_url=None):
+    """Queue an image for analysis and return the new job id"""
+    if callback_url and not is_local_callback(callback_url):
+        raise ValueError('Callback URL must point to localhost')
+
+    job_id = uuid.uuid4().hex
+    conn = _connect()
+    conn.isolation_level = None
+    try:
+        # Check and insert in one write transaction so concurrent submits
+        # cannot push the queue past MAX_QUEUE_DEPTH
+        conn.execute('BEGIN IMMEDIATE')
+        depth = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+        if depth >= MAX_QUEUE_DEPTH:
+            conn.execute('ROLLBACK')
+            raise QueueFullError('Analysis queue is full, please retry later')
+        conn.execute(
+            'INSERT INTO jobs (id, filename, filepath, status, callback_url, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+            (job_id, filename, filepath, 'queued', callback_url, time.time())
+        )
+        conn.execute('COMMIT')
+    except sqlite3.Error:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+    with _wakeup:
+        _wakeup.notify()
+
+    return job_id
+
+
+def _job_to_dict(row):
+    job = {
+        'job_id': row['id'],
+        'filename': row['filename'],
+        'status': row['status'],
+        'result': json.loads(row['result']) if row['result'] else None,
+        'error': row['error'],
+        'queue_wait_ms': None,
+        'run_ms': None
+    }
+    if row['started_at']:
+        job['queue_wait_ms'] = round((row['started_at'] - row['created_at']) * 1000, 1)
+    if row['started_at'] and row['finished_at']:
+        job['run_ms'] = round((row['finished_at'] - row['started_at']) * 1000, 1)
+    return job
+
+
+def get_job(job_id):
+    """Return a job's status and result, or None if it does not exist"""
+    conn = _connect()
+    row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    conn.close()
+    return _job_to_dict(row) if row else None
+
+
+def get_queue_depth():
+    conn = _connect()
+    depth = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+    conn.close()
+    return depth
+
+
+def get_stats(recent=100):
+    """Queue depth, job counts and average timings of the most recent jobs"""
+    conn = _connect()
+    counts = {row['status']: row['n'] for row in
+              conn.execute('SELECT status, COUNT(*) AS n FROM jobs GROUP BY status')}
+    timing = conn.execute('''
+        SELECT AVG(started_at - created_at) AS wait, AVG(finished_at - started_at) AS run
+        FROM (SELECT * FROM jobs WHERE status = 'done' ORDER BY finished_at DESC LIMIT ?)
+    ''', (recent,)).fetchone()
+    conn.close()
+
+    return {
+        'queue_depth': counts.get('queued', 0),
+        'running': counts.get('running', 0),
+        'done': counts.get('done', 0),
+        'failed': counts.get('failed', 0),
+        'workers': len(_workers),
+        'max_queue_depth': MAX_QUEUE_DEPTH,
+        'avg_queue_wait_ms': round(timing['wait'] * 1000, 1) if timing['wait'] is not None else None,
+        'avg_run_ms': round(timing['run'] * 1000, 1) if timing['run'] is not None else None
+    }
+
+
+def _pending_counts():
+    """Queued and running jobs, for the /metrics queue depth gauge"""
+    conn = _connect()
+    counts = {(status,): 0 for status in ('queued', 'running')}
+    for row in conn.execute("SELECT status, COUNT(*) AS n FROM jobs WHERE status IN ('queued', 'running') "
+                            "GROUP BY status"):
+        counts[(row['status'],)] = row['n']
+    conn.close()
+    return counts
+
+
+metrics.Gauge('disease_job_queue_depth', 'Async disease jobs waiting or running', ['status'],
+              callback=_pending_counts)
+metrics.Gauge('disease_job_workers', 'Running async job worker threads', callback=lambda: len(_workers))
+
+
+def _claim_next_job():
+    """Atomically move the oldest queued job to 'running'"""
+    conn = _connect()
+    conn.isolation_level = None
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        row = conn.execute(
+            "SELECT * FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1"
+        ).fetchone()
+        if row is None:
+            conn.execute('COMMIT')
+            return None
+        conn.execute("UPDATE jobs SET status = 'running', started_at = ?, owner_pid = ? WHERE id = ?",
+                     (time.time(), os.getpid(), row['id']))
+        conn.execute('COMMIT')
+        return row
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+
+def _finish_job(job_id, status, result=None, error=None):
+    conn = _connect()
+    with conn:
+        conn.execute('UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE id = ?',
+                     (status, json.dumps(result) if result is not None else None, error, time.time(), job_id))
+    conn.close()
+
+
+def _send_callback(job_id, callback_url):
+    try:
+        payload = json.dumps(get_job(job_id)).encode()
+        req = urllib.request.Request(callback_url, data=payload, method='POST',
+                                     headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(req, timeout=CALLBACK_TIMEOUT):
+            pass
+    except Exception as e:
+        tracing.log(logger, logging.WARNING, 'job callback failed', job_id=job_id, error=e)
+
+
+def _worker_loop():
+    while True:
+        try:
+            job = _claim_next_job()
+        except Exception as e:
+            tracing.log(logger, logging.WARNING, 'could not claim job', error=e)
+            job = None
+
+        if job is None:
+            with _wakeup:
+                _wakeup.wait(timeout=POLL_INTERVAL)
+            continue
+
+        token = tracing.start_trace('disease_job', job_id=job['id'])
+        try:
+            result = _handler(job['filename'], job['filepath'])
+            _finish_job(job['id'], 'done', result=result)
+            tracing.finish_trace(token, status='done')
+        except Exception as e:
+            tracing.log(logger, logging.WARNING, 'job failed', job_id=job['id'], error=e)
+            _finish_job(job['id'], 'failed', error=str(e))
+            tracing.finish_trace(token, status='failed', error=str(e))
+
+        if job['callback_url']:
+            _send_callback(job['id'], job['callback_url'])
+
+
+# Initialize on module load
+init_db()
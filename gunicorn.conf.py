@@ -0,0 +1,45 @@
+"""
+Gunicorn settings, read automatically from the working directory:
+
+    gunicorn app_community:app        (or app:app)
+
+The app is imported once in the master (preload_app) so the crop forest and
+the other lookup tables are shared copy-on-write by all workers instead of
+being loaded once per worker. The disease model is opened in each worker
+after the fork; from a .tflite file its weights are shared as well (see
+model_sharing.py). Check per-worker memory with benchmark_worker_memory.py
+or the process_memory_bytes metric.
+"""
+
+import os
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.getenv('WEB_CONCURRENCY', 4))
+threads = int(os.getenv('GUNICORN_THREADS', 1))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))
+preload_app = os.getenv('PRELOAD_APP', '1') == '1'
+
+
+def when_ready(server):
+    """Master, after the app is preloaded and before any worker forks"""
+    if preload_app:
+        import model_sharing
+        model_sharing.prepare_for_fork()
+
+
+def post_fork(server, worker):
+    """Each worker: what the __main__ blocks of app.py and app_community.py do"""
+    import app
+    import color_analysis
+    import history
+
+    if app.MODEL_AVAILABLE:
+        app.load_trained_model()
+    color_analysis.start_pool()
+    history.start_maintenance()
+
+
+def worker_exit(server, worker):
+    """Write history entries this worker has queued but not written yet"""
+    import history
+    history.shutdown()
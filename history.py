@@ -1,11 +1,139 @@
+"""
+Detection History
+Analysis results in SQLite (plant_disease.db). Each thread reuses one
+connection instead of opening one per query; the database runs in WAL mode
+so page views read while classifications write.
+
+New entries are written behind the request: add_entry() takes the next id
+from a counter file shared by every worker and queues the row, and a
+background thread writes queued rows in one transaction every FLUSH_ENTRIES
+entries or FLUSH_INTERVAL_MS milliseconds. Ids follow the order entries were
+added in across all workers, so keyset pages stay in time order. Reads flush
+this process's queue first; a lookup of an id another worker has not written
+yet waits for that worker's next flush.
+"""
+
+import atexit
+import logging
+import os
 import sqlite3
 import datetime
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: no fcntl, and no gunicorn either, so a single process hands out ids
+    fcntl = None
+
+import metrics
+import tracing
 
 DB_NAME = 'plant_disease.db'
 
+# Per-connection settings (see _open_connection)
+BUSY_TIMEOUT_MS = int(os.getenv('HISTORY_BUSY_TIMEOUT_MS', 5000))
+CACHE_SIZE_KB = int(os.getenv('HISTORY_CACHE_KB', 8192))
+
+# Write-behind buffer (HISTORY_WRITE_BEHIND=0 writes each entry before returning)
+WRITE_BEHIND = os.getenv('HISTORY_WRITE_BEHIND', '1') == '1'
+FLUSH_ENTRIES = int(os.getenv('HISTORY_FLUSH_ENTRIES', 64))
+FLUSH_INTERVAL_MS = int(os.getenv('HISTORY_FLUSH_MS', 200))
+# A request that finds this many entries queued writes them itself
+MAX_BACKLOG = int(os.getenv('HISTORY_MAX_BACKLOG', 5000))
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+# Incremental per-prediction rollups (get_rollups()), by bucket granularity
+ROLLUP_TABLES = {'hour': 'history_rollup_hourly', 'day': 'history_rollup_daily'}
+# SQL equivalents of hour_bucket() and day_bucket(), both in local time
+ROLLUP_BUCKET_SQL = {
+    'hour': "CAST(strftime('%s', strftime('%Y-%m-%d %H:00:00', created_at, 'unixepoch', 'localtime'), 'utc') "
+            "AS INTEGER)",
+    'day': "CAST(strftime('%s', date(created_at, 'unixepoch', 'localtime'), 'utc') AS INTEGER)",
+}
+# PRAGMA user_version once the rollups include every row written before them
+# (2: hour buckets start on the local hour, not the UTC one)
+ROLLUPS_BUILT_VERSION = 2
+ROLLUP_DEFAULT_SPAN = {'hour': datetime.timedelta(hours=48), 'day': datetime.timedelta(days=30)}
+
+# Timestamp backfill of rows from before the created_at column
+BACKFILL_BATCH = 500
+BACKFILL_PAUSE = 0.05
+
+INSERT_SQL = ('INSERT INTO history (id, filename, date, prediction, confidence, created_at) '
+              'VALUES (?, ?, ?, ?, ?, ?)')
+
+logger = tracing.get_logger('history')
+
+_local = threading.local()
+# Connections inherited over fork(); SQLite must not use or close them in the child
+_inherited = []
+
+_pending = []            # (id, filename, date, prediction, confidence, created_at) rows not written yet
+_pending_changed = threading.Condition()
+_flush_lock = threading.Lock()
+_id_lock = threading.Lock()
+_id_counter_checked = None    # DB_NAME whose counter file this process has compared with the database
+_writer = None
+_stopping = False
+
+FLUSH_SECONDS = metrics.Histogram('history_flush_duration_seconds',
+                                  'Time to write one batch of buffered history entries')
+FLUSHED_ENTRIES = metrics.Counter('history_flushed_entries_total', 'Buffered history entries written')
+metrics.Gauge('history_write_backlog', 'History entries queued and not yet written',
+              callback=lambda: len(_pending))
+
+def _open_connection():
+    conn = sqlite3.connect(DB_NAME, timeout=BUSY_TIMEOUT_MS / 1000)
+    conn.row_factory = sqlite3.Row
+    conn.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA cache_size = -{CACHE_SIZE_KB}')
+    return conn
+
+def get_connection():
+    """This thread's connection, opened on first use and reused afterwards
+    (and reopened if DB_NAME was pointed elsewhere, as benchmarks do)"""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.db_name != DB_NAME:
+        close_connection()
+        conn = None
+    if conn is None:
+        conn = _local.conn = _open_connection()
+        _local.db_name = DB_NAME
+    return conn
+
+def close_connection():
+    """Close this thread's connection (the next call reopens it)"""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        del _local.conn
+        conn.close()
+
+def _after_fork_in_child():
+    # The parent still owns (and will write) its queued entries
+    global _local, _pending_changed, _flush_lock, _id_lock, _writer
+    _inherited.append(_local)
+    _local = threading.local()
+    _pending.clear()
+    _pending_changed = threading.Condition()
+    _flush_lock = threading.Lock()
+    _id_lock = threading.Lock()
+    _writer = None
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
 def init_db():
     """Initialize the database with the history table"""
     conn = sqlite3.connect(DB_NAME)
+    # Only takes effect before the first table is created; lets history_archive.py
+    # give freed pages back a chunk at a time
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    # Persistent: stored in the database file, so every later connection uses WAL
+    conn.execute('PRAGMA journal_mode = WAL')
     c = conn.cursor()
     c.execute('''
         CREATE TABLE IF NOT EXISTS history (
@@ -16,40 +144,387 @@ def init_db():
             confidence REAL
         )
     ''')
+    # Typed timestamp (epoch seconds) for range queries; 'date' stays for display.
+    # Rows written before it existed are filled in by backfill_created_at().
+    columns = [row[1] for row in c.execute('PRAGMA table_info(history)')]
+    if 'created_at' not in columns:
+        c.execute('ALTER TABLE history ADD COLUMN created_at INTEGER')
+    c.execute('DROP INDEX IF EXISTS idx_history_date')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_history_created_at ON history (created_at)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_history_prediction_created_at ON history (prediction, created_at)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_history_prediction ON history (prediction, id)')
+    for table in ROLLUP_TABLES.values():
+        c.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                bucket INTEGER,
+                prediction TEXT,
+                count INTEGER,
+                confidence_sum REAL,
+                PRIMARY KEY (bucket, prediction)
+            ) WITHOUT ROWID
+        ''')
+    # A new database has nothing to roll up from before the rollups existed
+    if c.execute('SELECT 1 FROM history LIMIT 1').fetchone() is None:
+        c.execute(f'PRAGMA user_version = {ROLLUPS_BUILT_VERSION}')
     conn.commit()
     conn.close()
 
+def backfill_created_at(batch_size=BACKFILL_BATCH, pause=BACKFILL_PAUSE):
+    """Fill created_at from the 'date' text of older rows; returns how many rows were updated.
+
+    Works through the table in short transactions of batch_size rows,
+    sleeping pause seconds in between, so the app keeps writing meanwhile.
+    Safe to run in several processes at once.
+    """
+    conn = get_connection()
+    updated = 0
+    last_id = 0
+    while True:
+        ids = [row[0] for row in conn.execute(
+            'SELECT id FROM history WHERE created_at IS NULL AND id > ? ORDER BY id LIMIT ?',
+            (last_id, batch_size))]
+        if not ids:
+            break
+        last_id = ids[-1]
+        placeholders = ','.join('?' * len(ids))
+        # 'date' is local time; an unparsable one becomes 0 so it is not retried
+        with conn:
+            updated += conn.execute(
+                f"UPDATE history SET created_at = COALESCE(CAST(strftime('%s', date, 'utc') AS INTEGER), 0) "
+                f"WHERE id IN ({placeholders}) AND created_at IS NULL", ids).rowcount
+        time.sleep(pause)
+    return updated
+
+def start_maintenance():
+    """Background upgrade of an older database, if it needs one: backfill
+    created_at, then build the rollups from the existing rows"""
+    conn = get_connection()
+    needs_backfill = conn.execute('SELECT 1 FROM history WHERE created_at IS NULL LIMIT 1').fetchone() is not None
+    if not needs_backfill and conn.execute('PRAGMA user_version').fetchone()[0] >= ROLLUPS_BUILT_VERSION:
+        return None
+
+    def run():
+        updated = backfill_created_at()
+        tracing.log(logger, logging.INFO, 'history created_at backfill done', rows=updated)
+        if get_connection().execute('PRAGMA user_version').fetchone()[0] < ROLLUPS_BUILT_VERSION:
+            rebuild_rollups()
+            tracing.log(logger, logging.INFO, 'history rollups built')
+        close_connection()
+
+    thread = threading.Thread(target=run, name='history-maintenance', daemon=True)
+    thread.start()
+    return thread
+
+def to_epoch(value):
+    """Epoch seconds for a naive local datetime (or pass epoch seconds through)"""
+    if isinstance(value, datetime.datetime):
+        return int(value.timestamp())
+    return int(value)
+
+def _now():
+    now = datetime.datetime.now()
+    return now.strftime(DATE_FORMAT), to_epoch(now)
+
+def _id_counter_path():
+    return DB_NAME + '-ids'
+
+def _allocate(count):
+    """Ids and timestamps for count new entries: (ids, date string, epoch seconds).
+
+    The last id handed out lives in a small file next to the database, bumped
+    under an exclusive lock, so ids are unique and ordered across workers
+    without a database transaction per request.
+    """
+    global _id_counter_checked
+    with _id_lock:
+        fd = os.open(_id_counter_path(), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if fcntl:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            data = os.read(fd, 32).strip()
+            last_id = int(data) if data else 0
+            if _id_counter_checked != DB_NAME:
+                # A new counter file, or one that lost its last updates in a crash:
+                # never hand out an id the database already has
+                conn = get_connection()
+                row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'history'").fetchone()
+                last_id = max(last_id, row[0] if row else 0,
+                              conn.execute('SELECT COALESCE(MAX(id), 0) FROM history').fetchone()[0])
+                _id_counter_checked = DB_NAME
+            date_str, created_at = _now()
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.write(fd, b'%020d' % (last_id + count))
+        finally:
+            os.close(fd)   # also releases the lock
+    return list(range(last_id + 1, last_id + count + 1)), date_str, created_at
+
+def _enqueue(rows):
+    """Queue (id, filename, date, prediction, confidence, created_at) rows for the writer"""
+    with _pending_changed:
+        _pending.extend(rows)
+        backlog = len(_pending)
+        if backlog >= FLUSH_ENTRIES:
+            _pending_changed.notify()
+    _start_writer()
+    if backlog >= MAX_BACKLOG or _stopping:
+        flush()
+
+@metrics.DB_QUERY_SECONDS.time('history', 'INSERT')
+def _insert(rows):
+    with get_connection() as conn:
+        conn.executemany(INSERT_SQL, rows)
+        _update_rollups(conn, [(prediction, confidence, created_at)
+                               for _, _, _, prediction, confidence, created_at in rows])
+
 def add_entry(filename, prediction, confidence):
-    """Add a new analysis entry"""
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    date_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    c.execute('INSERT INTO history (filename, date, prediction, confidence) VALUES (?, ?, ?, ?)',
-              (filename, date_str, prediction, confidence))
-    conn.commit()
-    conn.close()
+    """Add a new analysis entry and return its id"""
+    return add_entries([(filename, prediction, confidence)])[0]
+
+def add_entries(entries):
+    """Add many analysis entries and return their ids.
+
+    entries: iterable of (filename, prediction, confidence) tuples
+    """
+    entries = list(entries)
+    if not entries:
+        return []
+    ids, date_str, created_at = _allocate(len(entries))
+    rows = [(entry_id, filename, date_str, prediction, confidence, created_at)
+            for entry_id, (filename, prediction, confidence) in zip(ids, entries)]
+    if WRITE_BEHIND:
+        _enqueue(rows)
+    else:
+        _insert(rows)
+    return ids
+
+def flush():
+    """Write every queued entry in one transaction; returns how many were written"""
+    with _flush_lock:
+        with _pending_changed:
+            rows = list(_pending)
+        if not rows:
+            return 0
+        start = time.perf_counter()
+        _insert(rows)
+        # Entries queued meanwhile were appended after these
+        with _pending_changed:
+            del _pending[:len(rows)]
+        FLUSH_SECONDS.observe(time.perf_counter() - start)
+        FLUSHED_ENTRIES.inc(amount=len(rows))
+        return len(rows)
+
+def _writer_loop():
+    while not _stopping:
+        with _pending_changed:
+            _pending_changed.wait_for(lambda: len(_pending) >= FLUSH_ENTRIES or _stopping,
+                                      timeout=FLUSH_INTERVAL_MS / 1000)
+        try:
+            flush()
+        except sqlite3.Error as e:
+            # Entries stay queued and are retried on the next round
+            tracing.log(logger, logging.ERROR, 'history flush failed', backlog=len(_pending), error=e)
+            time.sleep(FLUSH_INTERVAL_MS / 1000)
+
+def _start_writer():
+    global _writer
+    if _writer is None:
+        with _flush_lock:
+            if _writer is None:
+                _writer = threading.Thread(target=_writer_loop, name='history-writer', daemon=True)
+                _writer.start()
+
+def shutdown():
+    """Stop the background writer and write whatever is still queued"""
+    global _stopping
+    _stopping = True
+    with _pending_changed:
+        _pending_changed.notify()
+    return flush()
+
+atexit.register(shutdown)
+
+@metrics.DB_QUERY_SECONDS.time('history', 'SELECT')
+def get_entries(entry_ids):
+    """Retrieve entries by id, in the order given (missing ids are skipped)"""
+    if not entry_ids:
+        return []
+    if _pending and not set(entry_ids).isdisjoint(row[0] for row in list(_pending)):
+        flush()
+    conn = get_connection()
+    placeholders = ','.join('?' * len(entry_ids))
+    query = f'SELECT * FROM history WHERE id IN ({placeholders})'
+    rows = {row['id']: dict(row) for row in conn.execute(query, list(entry_ids))}
+    missing = [i for i in entry_ids if i not in rows]
+    if missing and max(missing) > conn.execute('SELECT COALESCE(MAX(id), 0) FROM history').fetchone()[0]:
+        # Newer than anything written: most likely still queued in another worker
+        time.sleep(FLUSH_INTERVAL_MS / 1000 * 1.5)
+        rows.update((row['id'], dict(row)) for row in conn.execute(query, list(entry_ids)))
+    return [rows[i] for i in entry_ids if i in rows]
 
 def get_history():
     """Retrieve all history entries, ordered by newest first"""
-    conn = sqlite3.connect(DB_NAME)
-    row_factory = sqlite3.Row
-    conn.row_factory = row_factory
-    c = conn.cursor()
-    c.execute('SELECT * FROM history ORDER BY id DESC')
-    rows = c.fetchall()
-    conn.close()
-    
-    # Convert sqlite3.Row objects to dictionaries
-    history = []
-    for row in rows:
-        history.append({
-            'id': row['id'],
-            'filename': row['filename'],
-            'date': row['date'],
-            'prediction': row['prediction'],
-            'confidence': row['confidence']
-        })
+    history, cursor = get_history_page(limit=MAX_PAGE_SIZE)
+    while cursor is not None:
+        page, cursor = get_history_page(before_id=cursor, limit=MAX_PAGE_SIZE)
+        history.extend(page)
     return history
 
+@metrics.DB_QUERY_SECONDS.time('history', 'SELECT')
+def get_history_page(before_id=None, limit=PAGE_SIZE, start=None, end=None, prediction=None):
+    """One page of entries, newest first.
+
+    Keyset pagination: pass the returned cursor as before_id for the next
+    page, so every page costs the same however deep it is. start and end are
+    datetimes or epoch seconds (end exclusive); prediction matches exactly. Returns
+    (entries, cursor); cursor is None on the last page.
+    """
+    if _pending:
+        flush()
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    clauses, params = [], []
+    if before_id is not None:
+        clauses.append('id < ?')
+        params.append(before_id)
+    range_where, range_params = _range_clause(start, end, prediction)
+    if range_where:
+        clauses.append(range_where)
+        params.extend(range_params)
+    where = 'WHERE ' + ' AND '.join(clauses) if clauses else ''
+
+    rows = get_connection().execute(f'SELECT * FROM history {where} ORDER BY id DESC LIMIT ?',
+                                    params + [limit + 1]).fetchall()
+    entries = [dict(row) for row in rows[:limit]]
+    cursor = entries[-1]['id'] if len(rows) > limit else None
+    return entries, cursor
+
+def _range_clause(start=None, end=None, prediction=None):
+    """SQL condition on created_at and prediction (served by the composite index)"""
+    clauses, params = [], []
+    if prediction:
+        clauses.append('prediction = ?')
+        params.append(prediction)
+    if start is not None:
+        clauses.append('created_at >= ?')
+        params.append(to_epoch(start))
+    if end is not None:
+        clauses.append('created_at < ?')
+        params.append(to_epoch(end))
+    return ' AND '.join(clauses), params
+
+@metrics.DB_QUERY_SECONDS.time('history', 'SELECT')
+def count_range(start=None, end=None, prediction=None):
+    """Number of entries with start <= created_at < end (and the given prediction)"""
+    if _pending:
+        flush()
+    where, params = _range_clause(start, end, prediction)
+    return get_connection().execute(f"SELECT COUNT(*) FROM history {'WHERE ' + where if where else ''}",
+                                    params).fetchone()[0]
+
+def iter_range(start=None, end=None, prediction=None, batch_size=500):
+    """Yield entries with start <= created_at < end, oldest first, batch_size rows at a time.
+
+    Uses its own connection so the caller can keep using this thread's one
+    while iterating.
+    """
+    if _pending:
+        flush()
+    where, params = _range_clause(start, end, prediction)
+    conn = _open_connection()
+    try:
+        c = conn.execute(f"SELECT * FROM history {'WHERE ' + where if where else ''} "
+                         'ORDER BY created_at, id', params)
+        while True:
+            rows = c.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield dict(row)
+    finally:
+        conn.close()
+
+def hour_bucket(ts):
+    """Epoch seconds of the start of ts's local hour (not the UTC one, which
+    differs in half-hour offset time zones and would not add up to days)"""
+    hour = datetime.datetime.fromtimestamp(ts).replace(minute=0, second=0, microsecond=0)
+    return int(hour.timestamp())
+
+def day_bucket(ts):
+    """Epoch seconds of local midnight on ts's day"""
+    midnight = datetime.datetime.fromtimestamp(ts).replace(hour=0, minute=0, second=0, microsecond=0)
+    return int(midnight.timestamp())
+
+ROLLUP_BUCKETS = {'hour': hour_bucket, 'day': day_bucket}
+
+def _update_rollups(conn, rows):
+    """Add (prediction, confidence, created_at) rows to the rollups, in the caller's transaction"""
+    for granularity, table in ROLLUP_TABLES.items():
+        bucket_of = ROLLUP_BUCKETS[granularity]
+        totals = {}
+        for prediction, confidence, created_at in rows:
+            key = (bucket_of(created_at), prediction)
+            count, confidence_sum = totals.get(key, (0, 0.0))
+            totals[key] = (count + 1, confidence_sum + (confidence or 0))
+        conn.executemany(
+            f'INSERT INTO {table} (bucket, prediction, count, confidence_sum) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (bucket, prediction) DO UPDATE SET count = count + excluded.count, '
+            'confidence_sum = confidence_sum + excluded.confidence_sum',
+            [key + value for key, value in totals.items()])
+
+def rebuild_rollups():
+    """Recompute the rollups from the history table in one transaction.
+
+    The compaction job for the incremental counts; start_maintenance() runs
+    it once on a database that has rows from before the rollups existed.
+    Buckets before the day of the oldest remaining row are kept, so days
+    moved out by history_archive.py stay in the rollups.
+    """
+    conn = get_connection()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        oldest = conn.execute('SELECT MIN(created_at) FROM history').fetchone()[0]
+        if oldest is not None:
+            since = day_bucket(oldest)
+            for granularity, table in ROLLUP_TABLES.items():
+                conn.execute(f'DELETE FROM {table} WHERE bucket >= ?', (since,))
+                conn.execute(f'INSERT INTO {table} (bucket, prediction, count, confidence_sum) '
+                             f'SELECT {ROLLUP_BUCKET_SQL[granularity]} AS bucket, prediction, COUNT(*), '
+                             'TOTAL(confidence) FROM history WHERE created_at >= ? GROUP BY bucket, prediction',
+                             (since,))
+        conn.execute(f'PRAGMA user_version = {ROLLUPS_BUILT_VERSION}')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+@metrics.DB_QUERY_SECONDS.time('history', 'SELECT')
+def get_rollups(granularity='day', start=None, end=None, prediction=None):
+    """Entry count and mean confidence per prediction and hour or day, oldest first.
+
+    Reads only the rollup rows of the range (by default the last 48 hours or
+    30 days), however many history rows they summarize.
+    """
+    if granularity not in ROLLUP_TABLES:
+        raise ValueError(f'granularity must be one of {", ".join(ROLLUP_TABLES)}')
+    if _pending:
+        flush()
+    end = to_epoch(end) if end is not None else int(time.time())
+    if start is None:
+        start = end - int(ROLLUP_DEFAULT_SPAN[granularity].total_seconds())
+    start = ROLLUP_BUCKETS[granularity](to_epoch(start))
+
+    query = f'SELECT * FROM {ROLLUP_TABLES[granularity]} WHERE bucket >= ? AND bucket < ?'
+    params = [start, end]
+    if prediction:
+        query += ' AND prediction = ?'
+        params.append(prediction)
+    rows = get_connection().execute(query + ' ORDER BY bucket, prediction', params).fetchall()
+    return [{
+        'bucket': row['bucket'],
+        'start': datetime.datetime.fromtimestamp(row['bucket']).strftime(DATE_FORMAT),
+        'prediction': row['prediction'],
+        'count': row['count'],
+        'mean_confidence': round(row['confidence_sum'] / row['count'], 2),
+    } for row in rows]
+
 # Initialize on module load
 init_db()
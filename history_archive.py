@@ -0,0 +1,293 @@
+"""
+History Archival
+Moves history rows older than a retention age out of plant_disease.db into
+compressed archive files, one directory per local day of created_at and one
+file per block of PART_IDS ids:
+
+    archive/history/date=2025-03-01/part-000000005000-000000009999.parquet
+
+Parquet (zstd) when pyarrow is installed, gzip JSON lines otherwise; the
+reader handles both. Rows are deleted from the database only after their
+file is written. A part's name depends only on its day and id block, and
+rows are merged into an existing part, so a re-run after a crash (even with
+a later cutoff) neither loses nor duplicates rows. Freed pages are then
+returned to the file system a chunk at a time with incremental VACUUM.
+
+The rollup tables are left alone, so dashboards keep covering archived days.
+With HISTORY_COLD_STORAGE_DIR set, images of archived rows that no remaining
+row uses are moved there as well.
+
+Usage:
+    python history_archive.py run                 # archive rows older than HISTORY_RETENTION_DAYS
+    python history_archive.py run --days 90 --dry-run
+    python history_archive.py scan --start 2025-01-01 --end 2025-02-01 --prediction "Rice - Blast"
+    python history_archive.py enable-vacuum       # one-off full VACUUM for databases created before this
+"""
+
+import argparse
+import datetime
+import gzip
+import importlib.util
+import json
+import os
+import shutil
+import time
+
+import history
+import metrics
+
+ARCHIVE_DIR = os.getenv('HISTORY_ARCHIVE_DIR', os.path.join('archive', 'history'))
+RETENTION_DAYS = int(os.getenv('HISTORY_RETENTION_DAYS', 180))
+COLD_STORAGE_DIR = os.getenv('HISTORY_COLD_STORAGE_DIR')
+UPLOAD_FOLDER = os.getenv('UPLOAD_FOLDER', 'uploads')
+
+PARQUET_AVAILABLE = importlib.util.find_spec('pyarrow') is not None
+ARCHIVE_FORMAT = os.getenv('HISTORY_ARCHIVE_FORMAT', 'parquet' if PARQUET_AVAILABLE else 'jsonl')
+
+# Rows archived and deleted per transaction
+BATCH_SIZE = 5000
+# Ids per part file: a part holds one day's rows of one block of ids
+PART_IDS = 5000
+PART_EXTENSIONS = ('.parquet', '.jsonl.gz')
+# Pages freed per incremental VACUUM step, with a pause so writers get in
+VACUUM_PAGES = 2000
+VACUUM_PAUSE = 0.05
+
+COLUMNS = ['id', 'filename', 'date', 'prediction', 'confidence', 'created_at', 'image_path']
+
+ARCHIVED_ROWS = metrics.Counter('history_archived_rows_total', 'History rows moved to archive files')
+
+
+def partition_dir(day):
+    return os.path.join(ARCHIVE_DIR, f'date={day}')
+
+
+def row_day(row):
+    """Partition of a row: the local day of created_at, as scan_archive() looks
+    it up (the 'date' text can be NULL or unparsable)"""
+    return datetime.datetime.fromtimestamp(row['created_at']).strftime('%Y-%m-%d')
+
+
+def part_name(entry_id):
+    first = entry_id - entry_id % PART_IDS
+    return f'part-{first:012d}-{first + PART_IDS - 1:012d}'
+
+
+def _write_partition(day, rows, name):
+    """Write rows to day's part file name atomically, keeping the rows already
+    in it (from an earlier batch or run); returns the file path"""
+    folder = partition_dir(day)
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, name + ('.parquet' if ARCHIVE_FORMAT == 'parquet' else '.jsonl.gz'))
+    tmp_path = path + '.tmp'
+
+    existing = [os.path.join(folder, name + extension) for extension in PART_EXTENSIONS]
+    existing = [old_path for old_path in existing if os.path.exists(old_path)]
+    if existing:
+        merged = {}
+        for old_path in existing:
+            merged.update((row['id'], row) for row in _read_partition_file(old_path))
+        merged.update((row['id'], row) for row in rows)
+        rows = [merged[entry_id] for entry_id in sorted(merged)]
+
+    if ARCHIVE_FORMAT == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pa.Table.from_pylist(rows, schema=pa.schema([
+            ('id', pa.int64()), ('filename', pa.string()), ('date', pa.string()),
+            ('prediction', pa.string()), ('confidence', pa.float64()), ('created_at', pa.int64()),
+            ('image_path', pa.string()),
+        ]))
+        pq.write_table(table, tmp_path, compression='zstd')
+    else:
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            for row in rows:
+                f.write(json.dumps(row) + '\n')
+
+    os.replace(tmp_path, path)
+    for old_path in existing:
+        if old_path != path:
+            os.remove(old_path)   # written in the other format by an earlier run
+    return path
+
+
+def _move_to_cold_storage(conn, rows, cutoff_ts, moved):
+    """Set each row's image_path, moving images that no remaining row uses to
+    COLD_STORAGE_DIR. moved maps filenames already handled in this run to
+    their new path (None: still in use, left in place)."""
+    if COLD_STORAGE_DIR:
+        days = {}
+        for row in rows:
+            if row['filename'] and row['filename'] not in moved:
+                days.setdefault(row['filename'], row_day(row))
+        new_names = list(days)
+        # Uploads can share a name; keep a file while a row that stays refers to
+        # it (rows not backfilled yet have no created_at and stay too)
+        in_use = set()
+        for i in range(0, len(new_names), 500):
+            chunk = new_names[i:i + 500]
+            in_use.update(row[0] for row in conn.execute(
+                f"SELECT DISTINCT filename FROM history WHERE (created_at >= ? OR created_at IS NULL) "
+                f"AND filename IN ({','.join('?' * len(chunk))})", [cutoff_ts] + chunk))
+        for filename in new_names:
+            source = os.path.join(UPLOAD_FOLDER, filename)
+            target = os.path.join(COLD_STORAGE_DIR, days[filename], filename)
+            moved[filename] = None
+            if filename not in in_use and os.path.isfile(source):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                moved[filename] = shutil.move(source, target)
+            elif not os.path.isfile(source) and os.path.isfile(target):
+                # Moved by an earlier run that stopped before deleting its rows
+                moved[filename] = target
+
+    for row in rows:
+        filename = row['filename'] or ''
+        row['image_path'] = moved.get(filename) or os.path.join(UPLOAD_FOLDER, filename)
+
+
+def archive_old_entries(older_than_days=RETENTION_DAYS, dry_run=False):
+    """Archive history rows from before local midnight older_than_days ago.
+
+    Returns {'rows': archived, 'files': part files written, 'cutoff': 'YYYY-MM-DD'}.
+    """
+    today = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    cutoff = today - datetime.timedelta(days=older_than_days)
+    cutoff_ts = history.to_epoch(cutoff)
+    conn = history.get_connection()
+    summary = {'rows': 0, 'files': 0, 'cutoff': cutoff.strftime('%Y-%m-%d')}
+
+    if dry_run:
+        summary['rows'] = history.count_range(end=cutoff_ts)
+        return summary
+
+    moved = {}
+    while True:
+        rows = [dict(row) for row in conn.execute(
+            'SELECT * FROM history WHERE created_at < ? ORDER BY id LIMIT ?', (cutoff_ts, BATCH_SIZE))]
+        if not rows:
+            break
+        _move_to_cold_storage(conn, rows, cutoff_ts, moved)
+
+        parts = {}
+        for row in rows:
+            parts.setdefault((row_day(row), part_name(row['id'])), []).append(
+                {key: row.get(key) for key in COLUMNS})
+        for (day, name), part_rows in parts.items():
+            _write_partition(day, part_rows, name)
+
+        ids = [row['id'] for row in rows]
+        with conn:
+            conn.execute(f"DELETE FROM history WHERE id IN ({','.join('?' * len(ids))})", ids)
+        summary['rows'] += len(rows)
+        summary['files'] += len(parts)
+        ARCHIVED_ROWS.inc(amount=len(rows))
+
+    if summary['rows']:
+        vacuum_incrementally(conn)
+    return summary
+
+
+def vacuum_incrementally(conn=None):
+    """Return free pages to the file system in small steps; returns pages freed"""
+    conn = conn or history.get_connection()
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        print("[WARNING] plant_disease.db was created without incremental auto_vacuum; "
+              "run 'python history_archive.py enable-vacuum' once to shrink it")
+        return 0
+    freed = 0
+    while True:
+        free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if not free:
+            break
+        # executescript() steps the pragma to completion; execute() frees a single page
+        conn.executescript(f'PRAGMA incremental_vacuum({min(free, VACUUM_PAGES)});')
+        freed += min(free, VACUUM_PAGES)
+        time.sleep(VACUUM_PAUSE)
+    return freed
+
+
+def enable_incremental_vacuum():
+    """Switch an existing database to incremental auto_vacuum (rewrites the whole file once)"""
+    conn = history.get_connection()
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    conn.execute('VACUUM')
+
+
+def _read_partition_file(path):
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=BATCH_SIZE):
+            yield from batch.to_pylist()
+    else:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                yield json.loads(line)
+
+
+def scan_archive(start=None, end=None, prediction=None):
+    """Yield archived rows with start <= created_at < end (datetimes or epoch
+    seconds), oldest day first. Only the partitions of the range are opened,
+    and files are read a batch at a time."""
+    if not os.path.isdir(ARCHIVE_DIR):
+        return
+    start_ts = history.to_epoch(start) if start is not None else None
+    end_ts = history.to_epoch(end) if end is not None else None
+    first_day = datetime.datetime.fromtimestamp(start_ts).strftime('%Y-%m-%d') if start_ts is not None else None
+    last_day = datetime.datetime.fromtimestamp(end_ts).strftime('%Y-%m-%d') if end_ts is not None else None
+
+    for folder in sorted(os.listdir(ARCHIVE_DIR)):
+        if not folder.startswith('date='):
+            continue
+        day = folder[len('date='):]
+        if (first_day and day < first_day) or (last_day and day > last_day):
+            continue
+        for name in sorted(os.listdir(os.path.join(ARCHIVE_DIR, folder))):
+            if name.endswith('.tmp'):
+                continue
+            for row in _read_partition_file(os.path.join(ARCHIVE_DIR, folder, name)):
+                if prediction and row['prediction'] != prediction:
+                    continue
+                if start_ts is not None and row['created_at'] < start_ts:
+                    continue
+                if end_ts is not None and row['created_at'] >= end_ts:
+                    continue
+                yield row
+
+
+def iter_all(start=None, end=None, prediction=None):
+    """Archived rows followed by the rows still in the database, for reports over any range"""
+    yield from scan_archive(start, end, prediction)
+    yield from history.iter_range(start, end, prediction)
+
+
+def _parse_day(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d') if value else None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Archive old history rows to compressed files')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('run', help='archive rows older than the retention age')
+    p.add_argument('--days', type=int, default=RETENTION_DAYS)
+    p.add_argument('--dry-run', action='store_true', help='only count the rows that would be archived')
+    p = sub.add_parser('scan', help='print archived rows as JSON lines')
+    p.add_argument('--start', help='YYYY-MM-DD')
+    p.add_argument('--end', help='YYYY-MM-DD (exclusive)')
+    p.add_argument('--prediction')
+    p.add_argument('--include-live', action='store_true', help='also rows still in the database')
+    sub.add_parser('enable-vacuum', help='switch the database to incremental auto_vacuum')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        summary = archive_old_entries(args.days, args.dry_run)
+        verb = 'would archive' if args.dry_run else 'archived'
+        print(f"[OK] {verb} {summary['rows']} rows from before {summary['cutoff']} "
+              f"into {summary['files']} files ({ARCHIVE_FORMAT})")
+    elif args.command == 'scan':
+        rows = (iter_all if args.include_live else scan_archive)(
+            _parse_day(args.start), _parse_day(args.end), args.prediction)
+        for row in rows:
+            print(json.dumps(row))
+    else:
+        enable_incremental_vacuum()
+        print("[OK] incremental auto_vacuum enabled")
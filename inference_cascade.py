@@ -0,0 +1,252 @@
+"""
+Confidence-Gated Inference Cascade
+Decides which classifier stages run for an image and keeps per-stage
+hit rate, latency and agreement counters.
+
+Orders (CASCADE_ORDER):
+    ml_first    - run the ML model; use the color heuristic when the model is
+                  unavailable or less confident than ml_min_confidence
+    color_first - run the cheap color heuristic; run the model only when the
+                  heuristic's confidence falls inside the ambiguous band
+
+Thresholds can be tuned per plant type with a JSON file named by
+CASCADE_CONFIG, e.g. {"order": "color_first",
+"plants": {"tomato": {"ambiguous_low": 65, "ambiguous_high": 82}}}.
+Plant names ignore case, punctuation and parentheses ("Pepper, bell" and
+"pepper_bell" are the same plant); see plant_of().
+"""
+
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+
+import color_rules
+import metrics
+import tracing
+
+logger = tracing.get_logger('cascade')
+
+CASCADE_ORDERS = ('ml_first', 'color_first')
+
+DEFAULT_THRESHOLDS = {
+    'ml_min_confidence': 50,   # ML results below this are not trusted
+    'ambiguous_low': 0,        # color results in [low, high) need the model
+    'ambiguous_high': 80,
+}
+
+CASCADE_ORDER = os.getenv('CASCADE_ORDER', 'ml_first')
+AUDIT_RATE = float(os.getenv('CASCADE_AUDIT_RATE', 0.0))
+PLANT_THRESHOLDS = {}
+
+_lock = threading.Lock()
+_stats = None
+
+
+def configure(order=None, plant_thresholds=None, audit_rate=None):
+    """Change the cascade order, per-plant thresholds or audit sampling rate"""
+    global CASCADE_ORDER, AUDIT_RATE
+
+    if order is not None:
+        if order not in CASCADE_ORDERS:
+            raise ValueError(f'Unknown cascade order: {order}')
+        CASCADE_ORDER = order
+    if plant_thresholds is not None:
+        PLANT_THRESHOLDS.clear()
+        PLANT_THRESHOLDS.update({normalize_plant(plant): dict(values) for plant, values in plant_thresholds.items()})
+    if audit_rate is not None:
+        AUDIT_RATE = float(audit_rate)
+
+
+def load_config(path):
+    with open(path) as f:
+        config = json.load(f)
+    configure(order=config.get('order'),
+              plant_thresholds=config.get('plants'),
+              audit_rate=config.get('audit_rate'))
+
+
+def normalize_plant(name):
+    """'Corn_(maize)' -> 'corn', 'Pepper,_bell' -> 'pepper bell'"""
+    name = re.sub(r'\(.*?\)', ' ', name)
+    return ' '.join(re.sub(r'[^0-9a-z]+', ' ', name.lower()).split())
+
+
+def plant_of(class_name):
+    """Plant type of a class, for PLANT_THRESHOLDS.
+
+    Model classes name their plant before '___'
+    ('Pepper,_bell___Bacterial_spot' -> 'pepper bell'); other classes of the
+    color rule table use the plant the table lists them under ('Esca' -> 'grape').
+    """
+    if '___' in class_name:
+        return normalize_plant(class_name.split('___', 1)[0])
+    plant = color_rules.ACTIVE.class_plants.get(class_name)
+    if plant is not None:
+        return normalize_plant(plant)
+    return normalize_plant(class_name.split('_', 1)[0])
+
+
+def thresholds_for(class_name):
+    thresholds = dict(DEFAULT_THRESHOLDS)
+    thresholds.update(PLANT_THRESHOLDS.get(plant_of(class_name), {}))
+    return thresholds
+
+
+def accept_ml(class_name, confidence):
+    return confidence >= thresholds_for(class_name)['ml_min_confidence']
+
+
+def is_ambiguous(class_name, confidence):
+    """True when a color result should be confirmed by the ML model"""
+    thresholds = thresholds_for(class_name)
+    return thresholds['ambiguous_low'] <= confidence < thresholds['ambiguous_high']
+
+
+def should_audit():
+    """Occasionally run the skipped stage too, to measure agreement"""
+    return AUDIT_RATE > 0 and random.random() < AUDIT_RATE
+
+
+# ============================================================================
+# STATISTICS
+# ============================================================================
+
+def _empty_stats():
+    return {
+        'images': 0,
+        'total_ms': 0.0,
+        'stages': {
+            'ml': {'calls': 0, 'accepted': 0, 'total_ms': 0.0},
+            'color': {'calls': 0, 'accepted': 0, 'total_ms': 0.0},
+        },
+        'compared': 0,
+        'agree_class': 0,
+        'agree_health': 0,
+    }
+
+
+def reset_stats():
+    global _stats
+    with _lock:
+        _stats = _empty_stats()
+
+
+def record_stage(stage, calls, accepted, elapsed_ms):
+    if calls:
+        metrics.INFERENCE_SECONDS.observe(elapsed_ms / 1000 / calls, stage, count=calls)
+    with _lock:
+        s = _stats['stages'][stage]
+        s['calls'] += calls
+        s['accepted'] += accepted
+        s['total_ms'] += elapsed_ms
+        _stats['total_ms'] += elapsed_ms
+
+
+def record_images(count=1):
+    with _lock:
+        _stats['images'] += count
+
+
+def record_agreement(ml_result, color_result):
+    """Compare the two stages' answers for the same image"""
+    same_class = ml_result[0] == color_result[0]
+    same_health = ('healthy' in ml_result[0].lower()) == ('healthy' in color_result[0].lower())
+    with _lock:
+        _stats['compared'] += 1
+        _stats['agree_class'] += int(same_class)
+        _stats['agree_health'] += int(same_health)
+
+
+def get_stats():
+    with _lock:
+        s = json.loads(json.dumps(_stats))
+
+    images = s['images']
+    for stage in s['stages'].values():
+        stage['hit_rate'] = round(stage['accepted'] / stage['calls'], 4) if stage['calls'] else None
+        stage['avg_ms'] = round(stage['total_ms'] / stage['calls'], 2) if stage['calls'] else None
+        stage['share_of_images'] = round(stage['accepted'] / images, 4) if images else None
+        stage['total_ms'] = round(stage['total_ms'], 2)
+
+    return {
+        'order': CASCADE_ORDER,
+        'audit_rate': AUDIT_RATE,
+        'images': images,
+        'avg_ms_per_image': round(s['total_ms'] / images, 2) if images else None,
+        'stages': s['stages'],
+        'compared': s['compared'],
+        'class_agreement': round(s['agree_class'] / s['compared'], 4) if s['compared'] else None,
+        'health_agreement': round(s['agree_health'] / s['compared'], 4) if s['compared'] else None,
+        'plant_thresholds': PLANT_THRESHOLDS,
+    }
+
+
+# ============================================================================
+# SINGLE IMAGE CASCADE
+# ============================================================================
+
+def _timed(stage, stage_func, image_path):
+    start = time.perf_counter()
+    with tracing.span(stage) as span:
+        result = stage_func(image_path)
+        if result is not None:
+            span['result'], span['confidence'] = result[0], round(result[1], 2)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def run(image_path, ml_stage, color_stage):
+    """Classify one image.
+
+    ml_stage(path) -> (class, confidence), or None when no model is loaded
+    color_stage(path) -> (class, confidence)
+    """
+    record_images()
+
+    if CASCADE_ORDER == 'color_first':
+        color_result, color_ms = _timed('color', color_stage, image_path)
+        ambiguous = is_ambiguous(*color_result)
+
+        if not ambiguous and not should_audit():
+            record_stage('color', 1, 1, color_ms)
+            return color_result
+
+        ml_result, ml_ms = _timed('ml', ml_stage, image_path)
+        use_ml = ambiguous and ml_result is not None and accept_ml(*ml_result)
+        record_stage('color', 1, int(not use_ml), color_ms)
+        if ml_result is not None:
+            record_stage('ml', 1, int(use_ml), ml_ms)
+            record_agreement(ml_result, color_result)
+        return ml_result if use_ml else color_result
+
+    # ml_first
+    ml_result, ml_ms = _timed('ml', ml_stage, image_path)
+    if ml_result is None:
+        color_result, color_ms = _timed('color', color_stage, image_path)
+        record_stage('color', 1, 1, color_ms)
+        return color_result
+
+    if accept_ml(*ml_result):
+        tracing.log(logger, logging.DEBUG, 'ML prediction accepted', disease=ml_result[0],
+                    confidence=round(ml_result[1], 2))
+        record_stage('ml', 1, 1, ml_ms)
+        if should_audit():
+            record_agreement(ml_result, color_stage(image_path))
+        return ml_result
+
+    tracing.log(logger, logging.INFO, 'ML confidence too low, falling back to enhanced analysis',
+                disease=ml_result[0], confidence=round(ml_result[1], 2))
+    color_result, color_ms = _timed('color', color_stage, image_path)
+    record_stage('ml', 1, 0, ml_ms)
+    record_stage('color', 1, 1, color_ms)
+    record_agreement(ml_result, color_result)
+    return color_result
+
+
+reset_stats()
+
+if os.getenv('CASCADE_CONFIG'):
+    load_config(os.getenv('CASCADE_CONFIG'))
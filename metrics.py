@@ -0,0 +1,303 @@
+"""
+Operational Metrics
+Counters, gauges and histograms for the hot paths, served at /metrics in the
+Prometheus text exposition format.
+
+Updates do not take a lock: each thread writes to its own shard of a metric
+and the shards are only summed when /metrics is scraped. A lock is taken
+once per thread and metric when the thread's shard is created, and once
+more when the thread exits and its shard is folded into the metric's total
+of exited threads, so short-lived pool threads do not pile up shards.
+
+Metrics are per process; with several gunicorn workers, scrape each worker
+or aggregate in Prometheus.
+"""
+
+import bisect
+import itertools
+import os
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds; covers sub-millisecond lookups up to multi-second model calls
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = {}
+
+
+def _format_labels(labelnames, labels):
+    if not labelnames:
+        return ''
+    pairs = []
+    for name, value in zip(labelnames, labels):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _ShardOwner:
+    """Lives in a thread's thread-local storage; collected when the thread exits"""
+    __slots__ = ('__weakref__',)
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        """callback() -> value, or {label tuple: value}; read at scrape time"""
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+        self._local = threading.local()
+        self._shards = {}        # key -> shard of a live thread
+        self._retired = {}       # totals of the shards of exited threads
+        self._keys = itertools.count()
+        self._lock = threading.Lock()
+        _registry[name] = self
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = {}
+            key = next(self._keys)
+            with self._lock:
+                self._shards[key] = shard
+            owner = self._local.owner = _ShardOwner()
+            weakref.finalize(owner, self._retire, key)
+            self._local.shard = shard
+            return shard
+
+    def _retire(self, key):
+        with self._lock:
+            self._merge(self._retired, self._shards.pop(key))
+
+    def _merge(self, totals, shard):
+        for labels, value in list(shard.items()):
+            totals[labels] = totals.get(labels, 0) + value
+
+    def _totals(self):
+        """{labels: value} over live and exited threads"""
+        totals = {}
+        # Under the lock, so a shard being retired is counted exactly once
+        with self._lock:
+            self._merge(totals, self._retired)
+            for shard in list(self._shards.values()):
+                self._merge(totals, shard)
+        return totals
+
+    def _callback_samples(self):
+        values = self.callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [(self.name, labels, value) for labels, value in sorted(values.items())]
+
+    def samples(self):
+        """[(sample name, label values, value)]"""
+        if self.callback is not None:
+            return self._callback_samples()
+        return [(self.name, labels, value) for labels, value in sorted(self._totals().items())]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for name, labels, value in self.samples():
+            lines.append(f'{name}{_format_labels(self.labelnames, labels)} {_format_value(value)}')
+        return lines
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    """Last value set (from any thread), or a callback read at scrape time"""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        super().__init__(name, documentation, labelnames, callback)
+        self._values = {}
+
+    def set(self, value, *labels):
+        self._values[labels] = value
+
+    def samples(self):
+        if self.callback is not None:
+            return self._callback_samples()
+        return [(self.name, labels, value) for labels, value in sorted(self._values.items())]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels, count=1):
+        """Record a value in seconds (count > 1 records the same value n times)"""
+        shard = self._shard()
+        entry = shard.get(labels)
+        if entry is None:
+            # one slot per bucket plus +Inf, then sum and count
+            entry = shard[labels] = [0] * (len(self.buckets) + 3)
+        entry[bisect.bisect_left(self.buckets, value)] += count
+        entry[-2] += value * count
+        entry[-1] += count
+
+    @contextmanager
+    def time(self, *labels):
+        """Time a block, or a function when used as a decorator"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def _merge(self, totals, shard):
+        for labels, entry in list(shard.items()):
+            total = totals.setdefault(labels, [0] * len(entry))
+            for i, value in enumerate(list(entry)):
+                total[i] += value
+
+    def samples(self):
+        samples = []
+        for labels, entry in sorted(self._totals().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), entry):
+                cumulative += count
+                samples.append((f'{self.name}_bucket', labels + (_format_value(bound),), cumulative))
+            samples.append((f'{self.name}_sum', labels, entry[-2]))
+            samples.append((f'{self.name}_count', labels, entry[-1]))
+        return samples
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for name, labels, value in self.samples():
+            labelnames = self.labelnames + ('le',) if name.endswith('_bucket') else self.labelnames
+            lines.append(f'{name}{_format_labels(labelnames, labels)} {_format_value(value)}')
+        return lines
+
+
+def render():
+    """All registered metrics in Prometheus text format"""
+    lines = []
+    for metric in list(_registry.values()):
+        try:
+            lines.extend(metric.render())
+        except Exception as e:
+            lines.append(f'# {metric.name} unavailable: {e}')
+    return '\n'.join(lines) + '\n'
+
+
+# ============================================================================
+# SHARED METRICS
+# ============================================================================
+
+HTTP_REQUEST_SECONDS = Histogram('http_request_duration_seconds', 'Request latency by route',
+                                 ['route', 'method'])
+HTTP_REQUESTS = Counter('http_requests_total', 'Requests by route, method and status code',
+                        ['route', 'method', 'status'])
+INFERENCE_SECONDS = Histogram('inference_duration_seconds', 'Per-image classification latency by backend',
+                              ['backend'])
+CACHE_REQUESTS = Counter('cache_requests_total', 'Cache lookups by cache and result (hit or miss)',
+                         ['cache', 'result'])
+DB_QUERY_SECONDS = Histogram('db_query_duration_seconds', 'Database query latency by database and statement',
+                             ['database', 'statement'])
+MODEL_LOAD_SECONDS = Gauge('model_load_duration_seconds', 'Time taken to load the disease model')
+PROCESS_START_TIME = Gauge('process_start_time_seconds', 'Start time of the process since the epoch')
+PROCESS_START_TIME.set(time.time())
+
+
+def process_memory(pid='self'):
+    """{'rss', 'pss', 'shared', 'private'} in bytes from /proc/<pid>/smaps_rollup (Linux)
+
+    RSS counts pages shared with other gunicorn workers in full; PSS splits
+    them between the processes sharing them, so summing PSS over workers gives
+    their real footprint. 'private' is what the process would free on exit.
+    """
+    fields = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1]) * 1024
+    return {
+        'rss': fields.get('Rss', 0),
+        'pss': fields.get('Pss', 0),
+        'shared': fields.get('Shared_Clean', 0) + fields.get('Shared_Dirty', 0),
+        'private': fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0),
+    }
+
+
+PROCESS_MEMORY = Gauge('process_memory_bytes', 'Memory of this process by kind (rss, pss, shared, private)',
+                       ['kind'], callback=lambda: {(kind,): value for kind, value in process_memory().items()})
+
+
+# ============================================================================
+# FLASK AND SQLALCHEMY HOOKS
+# ============================================================================
+
+_sqlalchemy_instrumented = False
+
+
+def instrument_sqlalchemy():
+    """Time every statement run by any SQLAlchemy engine"""
+    global _sqlalchemy_instrumented
+    if _sqlalchemy_instrumented:
+        return
+    _sqlalchemy_instrumented = True
+
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_query_start', []).append(time.perf_counter())
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get('metrics_query_start')
+        if not starts:
+            return
+        database = os.path.splitext(os.path.basename(conn.engine.url.database or 'memory'))[0]
+        verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'UNKNOWN'
+        DB_QUERY_SECONDS.observe(time.perf_counter() - starts.pop(), database, verb)
+
+
+def init_app(app):
+    """Time every request of a Flask app and serve /metrics"""
+    from flask import Response, g, request
+
+    @app.before_request
+    def _start_request_timer():
+        g.metrics_request_start = time.perf_counter()
+
+    @app.after_request
+    def _record_request(response):
+        start = g.pop('metrics_request_start', None)
+        if start is not None:
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, route, request.method)
+            HTTP_REQUESTS.inc(route, request.method, str(response.status_code))
+        return response
+
+    def metrics_endpoint():
+        return Response(render(), content_type=CONTENT_TYPE)
+
+    app.add_url_rule('/metrics', 'metrics', metrics_endpoint)
+    instrument_sqlalchemy()
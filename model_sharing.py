@@ -0,0 +1,127 @@
+"""
+Model Sharing Across Pre-forked Workers
+Keeps one copy of the models in memory however many gunicorn workers run
+(see gunicorn.conf.py).
+
+- The crop forest, scalers, disease tables and color rules are loaded in the
+  gunicorn master (preload_app) and inherited by every worker copy-on-write.
+  prepare_for_fork() freezes the garbage collector first: a collection walks
+  and writes to the header of every tracked object, which would otherwise
+  copy each page holding one into every worker.
+- TensorFlow cannot be started before fork (its thread pools do not survive
+  it), so the disease network is served from a TFLite file instead. The
+  interpreter maps the file read-only, and the builtin kernels read the
+  weights from that mapping, so workers share them through the page cache.
+  The XNNPACK delegate TFLite applies by default repacks the weights into
+  memory of each interpreter, which would undo that, so it is off unless
+  TFLITE_XNNPACK=1 (faster, but a private copy per worker).
+  benchmark_worker_memory.py reports how much of the model file each
+  worker maps and how much of it is shared. Convert once with:
+
+      python model_sharing.py convert
+
+  Without the .tflite file each worker loads its own Keras copy.
+"""
+
+import argparse
+import gc
+import importlib.util
+import os
+import threading
+
+import numpy as np
+
+TFLITE_MODEL_PATH = os.getenv('TFLITE_MODEL_PATH', 'models/plant_disease_model.tflite')
+TFLITE_THREADS = int(os.getenv('TFLITE_THREADS', 1))
+TFLITE_XNNPACK = os.getenv('TFLITE_XNNPACK', '0') == '1'
+
+TFLITE_AVAILABLE = (importlib.util.find_spec('tflite_runtime') is not None
+                    or importlib.util.find_spec('tensorflow') is not None)
+
+# Signature outputs written by convert_to_tflite()
+PROBABILITIES = 'probabilities'
+EMBEDDING = 'embedding'
+
+
+def _interpreter_class():
+    """(Interpreter class, its OpResolverType enum)"""
+    # tflite_runtime is a few MB; TensorFlow's own interpreter pulls in all of TF
+    try:
+        from tflite_runtime.interpreter import Interpreter, OpResolverType
+    except ImportError:
+        from tensorflow.lite import Interpreter
+        from tensorflow.lite.experimental import OpResolverType
+    return Interpreter, OpResolverType
+
+
+class TFLiteModel:
+    """Keras-style predict() over one output of a TFLite model"""
+
+    def __init__(self, path=TFLITE_MODEL_PATH, output=PROBABILITIES, num_threads=None):
+        self.path = path
+        self.output = output
+        interpreter_class, resolver_types = _interpreter_class()
+        options = {} if TFLITE_XNNPACK else {
+            # Builtin kernels only: keep the weights in the shared file mapping
+            'experimental_op_resolver_type': resolver_types.BUILTIN_WITHOUT_DEFAULT_DELEGATES}
+        self._interpreter = interpreter_class(model_path=path, num_threads=num_threads or TFLITE_THREADS,
+                                              **options)
+        self._runner = self._interpreter.get_signature_runner()
+        self._input_name = next(iter(self._runner.get_input_details()))
+        outputs = self._runner.get_output_details()
+        if output not in outputs:
+            raise KeyError(f'{path} has no {output!r} output (outputs: {sorted(outputs)})')
+        self.output_names = sorted(outputs)
+        self.output_shape = (None,) + tuple(int(d) for d in outputs[output]['shape'][1:])
+        # An interpreter runs one call at a time
+        self._lock = threading.Lock()
+
+    def with_output(self, output):
+        """Same network, another output; the weights are mapped only once"""
+        if output not in self.output_names:
+            return None
+        return TFLiteModel(self.path, output)
+
+    def predict(self, inputs, verbose=0):
+        inputs = np.ascontiguousarray(inputs, dtype=np.float32)
+        with self._lock:
+            return self._runner(**{self._input_name: inputs})[self.output]
+
+
+def prepare_for_fork():
+    """Run in the master once everything is loaded, before workers fork"""
+    gc.collect()
+    gc.freeze()
+    print(f"[OK] {gc.get_freeze_count()} objects frozen for copy-on-write sharing")
+
+
+def convert_to_tflite(model_dir, output_path=TFLITE_MODEL_PATH, float16=False):
+    """Write a TFLite copy of the Keras disease model with both the class
+    probabilities and the penultimate-layer embedding as outputs"""
+    import tensorflow as tf
+    from tensorflow import keras
+
+    model = keras.models.load_model(model_dir, compile=False)
+    dual = keras.Model(inputs=model.inputs,
+                       outputs={PROBABILITIES: model.output, EMBEDDING: model.layers[-2].output})
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(dual)
+    if float16:
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    with open(output_path, 'wb') as f:
+        f.write(converter.convert())
+    print(f"[OK] {output_path} written ({os.path.getsize(output_path) / 1e6:.1f} MB)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert the disease model for sharing across workers')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('convert', help='write a TFLite copy of the Keras model')
+    p.add_argument('model', nargs='?', default='models/plant_disease_model',
+                   help='H5 file or SavedModel directory')
+    p.add_argument('-o', '--output', default=TFLITE_MODEL_PATH)
+    p.add_argument('--float16', action='store_true', help='store weights as float16 (half the size)')
+    args = parser.parse_args()
+
+    convert_to_tflite(args.model, args.output, args.float16)
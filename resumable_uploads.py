@@ -0,0 +1,266 @@
+"""
+Resumable Uploads
+tus-style chunked uploads for flaky mobile connections: the client creates an
+upload with its total length, PATCHes chunks at the server's current offset
+(asking for it again with HEAD after a dropped connection) and finalizes once
+every byte has arrived. Bytes are kept as they arrive, so a transfer that
+drops at 90% resumes at 90%.
+
+Partial files live in UPLOAD_DIR, their state in SQLite so every gunicorn
+worker sees the same offsets. Uploads untouched for UPLOAD_TTL seconds are
+garbage-collected.
+"""
+
+import json
+import os
+import sqlite3
+import time
+import uuid
+
+DB_NAME = 'resumable_uploads.db'
+
+UPLOAD_DIR = os.getenv('RESUMABLE_UPLOAD_DIR', os.path.join('uploads', 'partial'))
+UPLOAD_TTL = int(os.getenv('RESUMABLE_UPLOAD_TTL', 24 * 3600))
+MAX_UPLOAD_BYTES = int(os.getenv('RESUMABLE_MAX_BYTES', 64 * 1024 * 1024))
+GC_INTERVAL = 300
+# Advertised to browsers (/upload_config): smaller files are posted in one go
+CLIENT_MIN_BYTES = int(os.getenv('RESUMABLE_CLIENT_MIN_BYTES', 512 * 1024))
+CLIENT_CHUNK_BYTES = int(os.getenv('RESUMABLE_CLIENT_CHUNK_BYTES', 256 * 1024))
+READ_SIZE = 64 * 1024
+# A PATCH that died without releasing its claim stops blocking after this
+WRITE_CLAIM_SECONDS = 120
+
+_last_cleanup = 0.0
+
+
+class UploadNotFound(Exception):
+    """Unknown or expired upload"""
+
+
+class UploadConflict(Exception):
+    """The request does not match the upload's state; offset is the current one"""
+
+    def __init__(self, message, offset=None):
+        super().__init__(message)
+        self.offset = offset
+
+
+def init_db():
+    """Initialize the database with the uploads table"""
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS uploads (
+            id TEXT PRIMARY KEY,
+            filename TEXT,
+            length INTEGER,
+            offset INTEGER,
+            status TEXT,
+            result TEXT,
+            created_at REAL,
+            expires_at REAL,
+            claimed_until REAL
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_uploads_expires ON uploads (expires_at)')
+    conn.commit()
+    conn.close()
+
+
+def _connect():
+    conn = sqlite3.connect(DB_NAME, timeout=30)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def data_path(upload_id):
+    return os.path.join(UPLOAD_DIR, upload_id + '.part')
+
+
+def _upload_to_dict(row):
+    return {
+        'id': row['id'],
+        'filename': row['filename'],
+        'length': row['length'],
+        'offset': row['offset'],
+        'status': row['status'],
+        'result': json.loads(row['result']) if row['result'] else None,
+        'expires_at': row['expires_at'],
+    }
+
+
+def create_upload(filename, length):
+    """Register a new upload of length bytes and return it as a dict"""
+    if length <= 0:
+        raise ValueError('Upload-Length must be a positive number of bytes')
+    if length > MAX_UPLOAD_BYTES:
+        raise ValueError(f'Upload is too large (max {MAX_UPLOAD_BYTES} bytes)')
+
+    maybe_cleanup()
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+
+    upload_id = uuid.uuid4().hex
+    now = time.time()
+    conn = _connect()
+    with conn:
+        conn.execute(
+            'INSERT INTO uploads (id, filename, length, offset, status, created_at, expires_at) '
+            'VALUES (?, ?, ?, 0, ?, ?, ?)',
+            (upload_id, filename, length, 'uploading', now, now + UPLOAD_TTL)
+        )
+    conn.close()
+    open(data_path(upload_id), 'wb').close()
+    return get_upload(upload_id)
+
+
+def get_upload(upload_id):
+    conn = _connect()
+    row = conn.execute('SELECT * FROM uploads WHERE id = ? AND expires_at > ?',
+                       (upload_id, time.time())).fetchone()
+    conn.close()
+    return _upload_to_dict(row) if row else None
+
+
+def _claim(upload_id, from_status, to_status=None, claim=False):
+    """Atomically check an upload's status and take it over; returns the row"""
+    now = time.time()
+    conn = _connect()
+    conn.isolation_level = None
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        row = conn.execute('SELECT * FROM uploads WHERE id = ? AND expires_at > ?', (upload_id, now)).fetchone()
+        if row is None:
+            conn.execute('COMMIT')
+            raise UploadNotFound(f'Upload {upload_id} not found or expired')
+        if row['status'] != from_status:
+            conn.execute('COMMIT')
+            return row
+        if claim and (row['claimed_until'] or 0) > now:
+            conn.execute('COMMIT')
+            raise UploadConflict('Another request is writing to this upload', row['offset'])
+        conn.execute('UPDATE uploads SET status = ?, claimed_until = ? WHERE id = ?',
+                     (to_status or from_status, now + WRITE_CLAIM_SECONDS if claim else None, upload_id))
+        conn.execute('COMMIT')
+        return row
+    except (UploadNotFound, UploadConflict):
+        raise
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+
+def write_chunk(upload_id, offset, stream):
+    """Append the bytes of stream at offset; returns the new offset.
+
+    offset must be the upload's current offset. Whatever arrives before the
+    connection drops is kept.
+    """
+    row = _claim(upload_id, 'uploading', claim=True)
+    if row['status'] != 'uploading':
+        raise UploadConflict('Upload is already complete', row['offset'])
+    if offset != row['offset']:
+        _release(upload_id, row['offset'], row['length'])
+        raise UploadConflict(f"Upload-Offset {offset} does not match the current offset {row['offset']}",
+                             row['offset'])
+
+    remaining = row['length'] - offset
+    written = 0
+    too_long = False
+    try:
+        with open(data_path(upload_id), 'r+b') as f:
+            f.seek(offset)
+            while True:
+                data = stream.read(min(READ_SIZE, remaining - written + 1))
+                if not data:
+                    break
+                if written + len(data) > remaining:
+                    f.write(data[:remaining - written])
+                    written = remaining
+                    too_long = True
+                    break
+                f.write(data)
+                written += len(data)
+            f.truncate(offset + written)
+    finally:
+        _release(upload_id, offset + written, row['length'])
+
+    if too_long:
+        raise ValueError('Chunk goes past the declared Upload-Length')
+    return offset + written
+
+
+def _release(upload_id, offset, length):
+    conn = _connect()
+    with conn:
+        conn.execute('UPDATE uploads SET offset = ?, status = ?, claimed_until = NULL, expires_at = ? WHERE id = ?',
+                     (offset, 'complete' if offset == length else 'uploading', time.time() + UPLOAD_TTL,
+                      upload_id))
+    conn.close()
+
+
+def begin_finalize(upload_id):
+    """Claim a fully received upload for analysis.
+
+    Returns the upload dict; if it was finalized before (the client retried
+    after losing the response), its 'result' is already set.
+    """
+    row = _claim(upload_id, 'complete', 'finalizing')
+    if row['status'] == 'uploading':
+        raise UploadConflict(f"Upload is incomplete ({row['offset']} of {row['length']} bytes)", row['offset'])
+    if row['status'] == 'finalizing':
+        raise UploadConflict('Upload is already being finalized', row['offset'])
+    return _upload_to_dict(row)
+
+
+def finish_finalize(upload_id, result):
+    """Keep the analysis result so a repeated finalize returns it"""
+    conn = _connect()
+    with conn:
+        conn.execute("UPDATE uploads SET status = 'finalized', result = ? WHERE id = ?",
+                     (json.dumps(result), upload_id))
+    conn.close()
+
+
+def abort_finalize(upload_id):
+    """Put an upload back to 'complete' so finalize can be retried"""
+    conn = _connect()
+    with conn:
+        conn.execute("UPDATE uploads SET status = 'complete' WHERE id = ? AND status = 'finalizing'", (upload_id,))
+    conn.close()
+
+
+def delete_upload(upload_id):
+    conn = _connect()
+    with conn:
+        deleted = conn.execute('DELETE FROM uploads WHERE id = ?', (upload_id,)).rowcount
+    conn.close()
+    try:
+        os.remove(data_path(upload_id))
+    except FileNotFoundError:
+        pass
+    return deleted > 0
+
+
+def cleanup_expired():
+    """Delete expired uploads and their partial files; returns how many"""
+    conn = _connect()
+    with conn:
+        expired = [row['id'] for row in conn.execute('SELECT id FROM uploads WHERE expires_at <= ?', (time.time(),))]
+    conn.close()
+    for upload_id in expired:
+        delete_upload(upload_id)
+    return len(expired)
+
+
+def maybe_cleanup():
+    """Run cleanup_expired() at most every GC_INTERVAL seconds per process"""
+    global _last_cleanup
+    now = time.time()
+    if now - _last_cleanup >= GC_INTERVAL:
+        _last_cleanup = now
+        cleanup_expired()
+
+
+init_db()
@@ -0,0 +1,309 @@
+"""
+Leaf Embedding Similarity Index
+Stores one embedding per history entry and finds similar past cases with a
+random-projection LSH index.
+
+Vectors live in an append-only file that is memory-mapped, so the index
+scales to millions of entries without loading them into RAM. Each LSH table
+keeps its hash codes sorted; a query is a binary search per table plus an
+exact cosine re-rank of the candidate rows.
+
+    embeddings/<space>/records.bin   N records: int64 history id, dim float32 (L2-normalized)
+
+Every gunicorn worker appends to the same file under an fcntl lock, one
+whole record per write, and queries map whatever the file holds by then.
+Rows past the LSH tables are scanned exactly until a background thread
+rebuilds the tables.
+
+History ids are appended in increasing order, so an id is found by a binary
+search over the mapped id column. Only rows that break the order (workers
+racing to append, an entry indexed again) are kept in a dict.
+"""
+
+import contextlib
+import os
+import threading
+
+import numpy as np
+from PIL import Image
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: no fcntl, and no gunicorn either, so a single process writes
+    fcntl = None
+
+import metrics
+
+EMBEDDINGS_DIR = os.getenv('EMBEDDINGS_DIR', 'embeddings')
+
+LSH_TABLES = 16
+LSH_BITS = 10  # codes are stored as uint16
+LSH_SEED = 1234
+MIN_CANDIDATES = 512
+MAX_CANDIDATES = 4096
+# Appended vectors are scanned exactly until this many accumulate
+REBUILD_TAIL = 5000
+BUILD_CHUNK = 65536
+# How far from its sorted place a row appended by racing workers can land
+LOOKUP_WINDOW = 64
+
+HIST_BINS = 8
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def color_histogram_embedding(image_path):
+    """Joint RGB histogram (8x8x8 bins) of the 224x224 image, Hellinger-normalized"""
+    img = Image.open(image_path).convert('RGB').resize((224, 224))
+    pixels = np.asarray(img).reshape(-1, 3) // (256 // HIST_BINS)
+    bins = (pixels[:, 0].astype(np.int32) * HIST_BINS + pixels[:, 1]) * HIST_BINS + pixels[:, 2]
+    hist = np.bincount(bins, minlength=HIST_BINS ** 3).astype(np.float32)
+    return np.sqrt(hist / hist.sum())
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class EmbeddingIndex:
+    """Append-only memory-mapped vector store with an LSH index"""
+
+    def __init__(self, space, dim, directory=EMBEDDINGS_DIR):
+        self.space = space
+        self.dim = dim
+        self.path = os.path.join(directory, space)
+        os.makedirs(self.path, exist_ok=True)
+        self.records_file = os.path.join(self.path, 'records.bin')
+        self.record_dtype = np.dtype([('id', '<i8'), ('vector', '<f4', (dim,))])
+
+        rng = np.random.default_rng(LSH_SEED)
+        self.planes = rng.standard_normal((dim, LSH_TABLES * LSH_BITS)).astype(np.float32)
+        self.bit_weights = (1 << np.arange(LSH_BITS)).astype(np.uint16)
+
+        self._lock = threading.Lock()
+        self._rebuilding = False
+        self._migrate_separate_files()
+        self._records = self._map(0)
+        self._count = 0
+        self._max_id = -1
+        self._late_rows = {}  # history id -> row, for rows appended out of id order
+        self._refresh()
+        self._tables = self._build_tables(self._records, self._count)
+
+    # ------------------------------------------------------------------
+    # Storage
+    # ------------------------------------------------------------------
+
+    @contextlib.contextmanager
+    def _locked_file(self):
+        """The records file opened for appending, locked against other processes"""
+        with open(self.records_file, 'ab') as f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield f
+            finally:
+                f.flush()
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _migrate_separate_files(self):
+        """Merge vectors.f32 and ids.i64 from before records.bin, once"""
+        vectors_file = os.path.join(self.path, 'vectors.f32')
+        ids_file = os.path.join(self.path, 'ids.i64')
+        if not os.path.exists(ids_file):
+            return
+        with self._locked_file() as f:
+            if not os.path.exists(ids_file):
+                return  # another worker got there first
+            if os.fstat(f.fileno()).st_size == 0 and os.path.exists(vectors_file):
+                count = min(os.path.getsize(ids_file) // 8, os.path.getsize(vectors_file) // (self.dim * 4))
+                if count:
+                    vectors = np.memmap(vectors_file, dtype=np.float32, mode='r', shape=(count, self.dim))
+                    ids = np.memmap(ids_file, dtype=np.int64, mode='r', shape=(count,))
+                    for start in range(0, count, BUILD_CHUNK):
+                        chunk = np.zeros(min(BUILD_CHUNK, count - start), dtype=self.record_dtype)
+                        chunk['id'] = ids[start:start + len(chunk)]
+                        chunk['vector'] = vectors[start:start + len(chunk)]
+                        f.write(chunk.tobytes())
+                    del vectors, ids
+            os.remove(ids_file)
+            if os.path.exists(vectors_file):
+                os.remove(vectors_file)
+
+    def _count_on_disk(self):
+        if not os.path.exists(self.records_file):
+            return 0
+        return os.path.getsize(self.records_file) // self.record_dtype.itemsize
+
+    def _map(self, count):
+        if count == 0:
+            return np.zeros(0, dtype=self.record_dtype)
+        return np.memmap(self.records_file, dtype=self.record_dtype, mode='r', shape=(count,))
+
+    def _refresh(self):
+        """Map the rows appended since the last look, by any process"""
+        count = self._count_on_disk()
+        if count <= self._count:
+            return
+        with self._lock:
+            if count <= self._count:
+                return
+            records = self._map(count)
+            new_ids = np.asarray(records['id'][self._count:count])
+            highest_before = np.maximum.accumulate(np.concatenate([[self._max_id], new_ids[:-1]]))
+            late = np.flatnonzero(new_ids <= highest_before)
+            self._late_rows.update(zip(new_ids[late].tolist(), (late + self._count).tolist()))
+            self._max_id = max(self._max_id, int(new_ids.max()))
+            # Readers take _count after _records, so it never runs past the map
+            self._records = records
+            self._count = count
+
+    def _build_tables(self, records, count):
+        """Sorted LSH codes of the first count rows: (sorted codes, row order, count)"""
+        codes = np.empty((count, LSH_TABLES), dtype=np.uint16)
+        for start in range(0, count, BUILD_CHUNK):
+            codes[start:start + BUILD_CHUNK] = self._hash(np.asarray(records['vector'][start:start + BUILD_CHUNK]))
+
+        order = np.argsort(codes, axis=0, kind='stable').astype(np.int32)
+        return np.take_along_axis(codes, order, axis=0).T.copy(), order.T.copy(), count
+
+    def _rebuild(self):
+        try:
+            self._refresh()
+            self._tables = self._build_tables(self._records, self._count)
+        finally:
+            self._rebuilding = False
+
+    def _start_rebuild(self):
+        """Rebuild the tables in the background; queries scan the tail meanwhile"""
+        with self._lock:
+            if self._rebuilding:
+                return
+            self._rebuilding = True
+        threading.Thread(target=self._rebuild, name=f'embedding-index-{self.space}', daemon=True).start()
+
+    def _hash(self, vectors):
+        """(n, dim) -> (n, LSH_TABLES) uint16 codes"""
+        bits = (vectors @ self.planes > 0).reshape(len(vectors), LSH_TABLES, LSH_BITS)
+        return (bits * self.bit_weights).sum(axis=2, dtype=np.uint16)
+
+    def __len__(self):
+        self._refresh()
+        return self._count
+
+    def add(self, entry_id, vector):
+        vector = _normalize(np.asarray(vector, dtype=np.float32).reshape(-1))
+        if vector.shape[0] != self.dim:
+            raise ValueError(f'Expected a {self.dim}-d vector for {self.space}, got {vector.shape[0]}')
+
+        record = np.zeros(1, dtype=self.record_dtype)
+        record['id'] = entry_id
+        record['vector'] = vector
+        with self._locked_file() as f:
+            size = os.fstat(f.fileno()).st_size
+            if size % self.record_dtype.itemsize:
+                # A writer died mid-record; drop the fragment so later rows stay aligned
+                f.truncate(size - size % self.record_dtype.itemsize)
+            f.write(record.tobytes())
+
+        self._refresh()
+        if self._count - self._tables[2] >= REBUILD_TAIL:
+            self._start_rebuild()
+
+    # ------------------------------------------------------------------
+    # Queries
+    # ------------------------------------------------------------------
+
+    def _find_row(self, entry_id, records, count):
+        """Row of an entry (the latest one if indexed twice), or None"""
+        row = self._late_rows.get(entry_id)
+        if row is not None:
+            return row
+        ids = records['id'][:count]
+        pos = int(np.searchsorted(ids, entry_id))
+        # Rows out of order can steer the search a few rows off; look around it
+        lo, hi = max(0, pos - LOOKUP_WINDOW), min(count, pos + LOOKUP_WINDOW)
+        hits = np.flatnonzero(ids[lo:hi] == entry_id)
+        return lo + int(hits[-1]) if len(hits) else None
+
+    def get_vector(self, entry_id):
+        self._refresh()
+        records, count = self._records, self._count
+        row = self._find_row(entry_id, records, count)
+        return np.array(records['vector'][row]) if row is not None else None
+
+    def _candidates(self, codes, tables, count):
+        sorted_codes, order, indexed = tables
+        found = []
+        total = 0
+        probes = [codes]
+        # Multi-probe: also look in buckets one bit away when exact buckets are sparse
+        for bit in range(LSH_BITS + 1):
+            if bit > 0:
+                probes = [codes ^ np.uint16(1 << (bit - 1))]
+            for probe in probes:
+                for t in range(LSH_TABLES):
+                    lo = np.searchsorted(sorted_codes[t], probe[t], side='left')
+                    hi = np.searchsorted(sorted_codes[t], probe[t], side='right')
+                    if hi > lo:
+                        found.append(order[t, lo:hi])
+                        total += hi - lo
+            if total >= MIN_CANDIDATES:
+                break
+
+        if found:
+            candidates, votes = np.unique(np.concatenate(found), return_counts=True)
+            if len(candidates) > MAX_CANDIDATES:
+                # Keep the rows that collided with the query in the most tables
+                candidates = candidates[np.argpartition(-votes, MAX_CANDIDATES)[:MAX_CANDIDATES]]
+        else:
+            candidates = np.zeros(0, dtype=np.int32)
+        tail = np.arange(indexed, count, dtype=np.int32)
+        return np.concatenate([candidates, tail])
+
+    def search(self, vector, k=5, exclude_id=None):
+        """Top-k most similar entries as a list of (entry_id, cosine similarity)"""
+        self._refresh()
+        tables, records, count = self._tables, self._records, self._count
+        if count == 0:
+            return []
+
+        query = _normalize(np.asarray(vector, dtype=np.float32).reshape(1, -1))
+        rows = self._candidates(self._hash(query)[0], tables, count)
+        rows = rows[rows < count]
+
+        matched = records[rows]
+        scores = matched['vector'] @ query[0]
+        row_ids = matched['id']
+        if exclude_id is not None:
+            keep = row_ids != exclude_id
+            scores, row_ids = scores[keep], row_ids[keep]
+
+        top = np.argsort(-scores)[:k]
+        return [(int(row_ids[i]), float(scores[i])) for i in top]
+
+
+def _after_fork_in_child():
+    # Indexes (and a rebuild the parent had running) stay with the parent
+    global _indexes_lock
+    _indexes.clear()
+    _indexes_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def get_index(space, dim):
+    """Shared index for an embedding space, loaded on first use"""
+    with _indexes_lock:
+        index = _indexes.get(space)
+        if index is None or index.dim != dim:
+            metrics.CACHE_REQUESTS.inc('embedding_index', 'miss')
+            index = EmbeddingIndex(space, dim, EMBEDDINGS_DIR)
+            _indexes[space] = index
+        else:
+            metrics.CACHE_REQUESTS.inc('embedding_index', 'hit')
+        return index
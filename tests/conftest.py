@@ -0,0 +1,55 @@
+"""
+Shared test setup. The modules under test create their SQLite files in the
+working directory when imported, so the tests run from a scratch directory
+and point each module at a database of its own.
+"""
+
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.mkdtemp(prefix='cropdoctor-tests-')
+os.chdir(WORKDIR)
+atexit.register(shutil.rmtree, WORKDIR, ignore_errors=True)
+
+import pytest
+
+
+@pytest.fixture
+def history_db(tmp_path, monkeypatch):
+    """history.py on an empty database of its own"""
+    import history
+
+    history.flush()
+    monkeypatch.setattr(history, 'DB_NAME', str(tmp_path / 'history.db'))
+    history.init_db()
+    yield history
+    history.flush()
+    history.close_connection()
+
+
+@pytest.fixture
+def app_client(history_db, tmp_path, monkeypatch):
+    """Test client of app.py with uploads, resumable uploads and history in tmp_path"""
+    import app
+    import resumable_uploads
+
+    monkeypatch.setattr(resumable_uploads, 'DB_NAME', str(tmp_path / 'resumable_uploads.db'))
+    monkeypatch.setattr(resumable_uploads, 'UPLOAD_DIR', str(tmp_path / 'partial'))
+    resumable_uploads.init_db()
+    monkeypatch.setitem(app.app.config, 'UPLOAD_FOLDER', str(tmp_path / 'uploads'))
+    return app.app.test_client()
+
+
+def image_bytes(color='green', size=(64, 64), fmt='JPEG'):
+    """An encoded solid-color image"""
+    import io
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, fmt)
+    return buffer.getvalue()
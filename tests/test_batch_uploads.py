@@ -0,0 +1,53 @@
+import io
+import os
+import zipfile
+
+from conftest import image_bytes
+
+
+def zip_of(members):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as zf:
+        for name, data in members:
+            zf.writestr(name, data)
+    buffer.seek(0)
+    return buffer
+
+
+def uploaded_files(tmp_path):
+    folder = tmp_path / 'uploads'
+    return sorted(os.listdir(folder)) if folder.exists() else []
+
+
+def test_batch_saves_same_named_images_separately(app_client, tmp_path):
+    response = app_client.post('/classify_disease_batch', content_type='multipart/form-data', data={
+        'images': [(io.BytesIO(image_bytes('green')), 'IMG_0001.jpg'),
+                   (io.BytesIO(image_bytes('brown')), 'IMG_0001.jpg')],
+        'archive': (zip_of([('a/IMG_0001.jpg', image_bytes('yellow'))]), 'photos.zip'),
+    })
+
+    assert response.status_code == 200
+    assert len(response.get_json()['results']) == 3
+    assert len(uploaded_files(tmp_path)) == 3
+
+
+def test_rejected_batch_leaves_no_files_behind(app_client, tmp_path):
+    response = app_client.post('/classify_disease_batch', content_type='multipart/form-data', data={
+        'images': [(io.BytesIO(image_bytes()), 'first.jpg'),
+                   (io.BytesIO(image_bytes()), 'second.jpg'),
+                   (io.BytesIO(b'not an image at all'), 'third.jpg')],
+    })
+
+    assert response.status_code == 400
+    assert 'third.jpg' in response.get_json()['error']
+    assert uploaded_files(tmp_path) == []
+
+
+def test_bad_archive_member_removes_the_whole_batch(app_client, tmp_path):
+    response = app_client.post('/classify_disease_batch', content_type='multipart/form-data', data={
+        'images': [(io.BytesIO(image_bytes()), 'first.jpg')],
+        'archive': (zip_of([('ok.jpg', image_bytes()), ('broken.png', b'\x89PNG garbage')]), 'photos.zip'),
+    })
+
+    assert response.status_code == 400
+    assert uploaded_files(tmp_path) == []
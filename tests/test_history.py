@@ -0,0 +1,173 @@
+import datetime
+import multiprocessing
+import os
+import sqlite3
+
+import pytest
+
+
+def _add_in_turn(db_name, turns, my_turn, results):
+    import history
+
+    history.DB_NAME = db_name
+    for turn in range(turns):
+        my_turn.wait()
+        my_turn.clear()
+        results.put(history.add_entry(f'leaf_{os.getpid()}_{turn}.jpg', 'Tomato___healthy', 90.0))
+    # Wait for the parent before the atexit flush, so rows stay queued meanwhile
+    my_turn.wait()
+
+
+def test_add_entry_is_readable_before_the_writer_runs(history_db):
+    entry_id = history_db.add_entry('leaf.jpg', 'Tomato___Early_blight', 87.5)
+
+    assert history_db._pending
+    entry, = history_db.get_entries([entry_id])
+    assert (entry['filename'], entry['prediction'], entry['confidence']) == \
+        ('leaf.jpg', 'Tomato___Early_blight', 87.5)
+    assert not history_db._pending
+
+
+def test_ids_follow_the_order_entries_were_added(history_db):
+    ids = history_db.add_entries(('leaf.jpg', 'Tomato___healthy', 80.0 + i) for i in range(5))
+    ids.append(history_db.add_entry('last.jpg', 'Tomato___healthy', 99.0))
+
+    assert ids == list(range(ids[0], ids[0] + 6))
+    page, cursor = history_db.get_history_page()
+    assert [entry['id'] for entry in page] == ids[::-1]
+    assert cursor is None
+
+
+def test_ids_stay_ordered_across_worker_processes(history_db):
+    history_db.flush()
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    turns = [context.Event(), context.Event()]
+    workers = [context.Process(target=_add_in_turn, args=(history_db.DB_NAME, 10, turn, results))
+               for turn in turns]
+    for worker in workers:
+        worker.start()
+
+    ids = []
+    for i in range(20):
+        turns[i % 2].set()
+        ids.append(results.get(timeout=10))
+    # Ids handed out in one process are found from another one before it flushes
+    assert [entry['id'] for entry in history_db.get_entries(ids)] == ids
+    for turn in turns:
+        turn.set()
+    for worker in workers:
+        worker.join(timeout=10)
+
+    assert ids == sorted(ids)
+    assert len(set(ids)) == 20
+
+
+def test_counter_file_never_goes_behind_the_database(history_db):
+    first = history_db.add_entry('leaf.jpg', 'Tomato___healthy', 90.0)
+    history_db.flush()
+    with open(history_db.DB_NAME + '-ids', 'w') as f:
+        f.write('0')
+    history_db._id_counter_checked = None
+
+    assert history_db.add_entry('leaf.jpg', 'Tomato___healthy', 91.0) == first + 1
+
+
+def test_synchronous_writes(history_db, monkeypatch):
+    monkeypatch.setattr(history_db, 'WRITE_BEHIND', False)
+    entry_id = history_db.add_entry('leaf.jpg', 'Tomato___healthy', 90.0)
+
+    assert not history_db._pending
+    assert history_db.get_entries([entry_id])[0]['id'] == entry_id
+
+
+def test_get_history_returns_every_entry_newest_first(history_db, monkeypatch):
+    monkeypatch.setattr(history_db, 'MAX_PAGE_SIZE', 3)
+    ids = history_db.add_entries(('leaf.jpg', 'Tomato___healthy', 90.0) for _ in range(8))
+
+    assert [entry['id'] for entry in history_db.get_history()] == ids[::-1]
+
+
+def test_failed_flush_keeps_entries_queued(history_db, monkeypatch):
+    entry_id = history_db.add_entry('leaf.jpg', 'Tomato___healthy', 90.0)
+    with monkeypatch.context() as patch:
+        patch.setattr(history_db, 'INSERT_SQL', 'INSERT INTO missing_table VALUES (?, ?, ?, ?, ?, ?)')
+        with pytest.raises(sqlite3.OperationalError):
+            history_db.flush()
+
+    assert [row[0] for row in history_db._pending] == [entry_id]
+    assert history_db.flush() == 1
+
+
+def add_at(history, when, prediction='Tomato___healthy', count=1):
+    """Entries created at a given local datetime"""
+    original_now = history._now
+    history._now = lambda: (when.strftime(history.DATE_FORMAT), history.to_epoch(when))
+    try:
+        return history.add_entries(('leaf.jpg', prediction, 80.0) for _ in range(count))
+    finally:
+        history._now = original_now
+
+
+def all_pages(history, **filters):
+    pages, cursor = [], None
+    while True:
+        entries, cursor = history.get_history_page(before_id=cursor, **filters)
+        pages.append([entry['id'] for entry in entries])
+        if cursor is None:
+            return pages
+
+
+def test_keyset_pages_cover_every_entry_once(history_db):
+    ids = history_db.add_entries(('leaf.jpg', 'Tomato___healthy', 90.0) for _ in range(10))
+
+    pages = all_pages(history_db, limit=3)
+
+    assert [len(page) for page in pages] == [3, 3, 3, 1]
+    assert sum(pages, []) == ids[::-1]
+
+
+def test_keyset_pages_do_not_shift_when_entries_are_added(history_db):
+    ids = history_db.add_entries(('leaf.jpg', 'Tomato___healthy', 90.0) for _ in range(6))
+    first, cursor = history_db.get_history_page(limit=3)
+    history_db.add_entries(('new.jpg', 'Tomato___healthy', 90.0) for _ in range(4))
+
+    second, cursor = history_db.get_history_page(before_id=cursor, limit=3)
+
+    assert [entry['id'] for entry in first + second] == ids[::-1]
+    assert cursor is None
+
+
+def test_pages_filtered_by_prediction_and_time_range(history_db):
+    day = datetime.datetime(2025, 3, 10, 12, 0)
+    old_rust = add_at(history_db, day - datetime.timedelta(days=3), 'Wheat___Rust', 2)
+    rust = add_at(history_db, day, 'Wheat___Rust', 4)
+    add_at(history_db, day, 'Wheat___healthy', 3)
+    new_rust = add_at(history_db, day + datetime.timedelta(days=3), 'Wheat___Rust', 1)
+
+    in_range = dict(start=day - datetime.timedelta(days=1), end=day + datetime.timedelta(days=1))
+    assert sum(all_pages(history_db, limit=3, prediction='Wheat___Rust', **in_range), []) == rust[::-1]
+    assert sum(all_pages(history_db, limit=2, prediction='Wheat___Rust'), []) == (old_rust + rust + new_rust)[::-1]
+    assert history_db.count_range(prediction='Wheat___Rust', **in_range) == 4
+    assert history_db.count_range(**in_range) == 7
+
+
+def test_filtered_pages_are_served_by_an_index(history_db):
+    plan = ' '.join(row[3] for row in history_db.get_connection().execute(
+        'EXPLAIN QUERY PLAN SELECT * FROM history WHERE id < ? AND prediction = ? ORDER BY id DESC LIMIT ?',
+        (100, 'Wheat___Rust', 51)))
+
+    assert 'USING INDEX idx_history_prediction' in plan
+
+
+def test_history_api_follows_next_links(app_client, history_db):
+    ids = history_db.add_entries(('leaf.jpg', 'Tomato___healthy', 90.0) for _ in range(5))
+
+    seen, url = [], '/api/history?limit=2'
+    while url:
+        body = app_client.get(url).get_json()
+        seen.extend(entry['id'] for entry in body['entries'])
+        url = body['next']
+
+    assert seen == ids[::-1]
+    assert app_client.get('/api/history?start=2025-13-01').status_code == 400
@@ -0,0 +1,79 @@
+import datetime
+
+import pytest
+
+import history_archive
+
+NOW = datetime.datetime.now()
+
+
+@pytest.fixture(params=['parquet', 'jsonl'])
+def archive(request, history_db, tmp_path, monkeypatch):
+    if request.param == 'parquet' and not history_archive.PARQUET_AVAILABLE:
+        pytest.skip('pyarrow is not installed')
+    monkeypatch.setattr(history_archive, 'ARCHIVE_DIR', str(tmp_path / 'archive'))
+    monkeypatch.setattr(history_archive, 'ARCHIVE_FORMAT', request.param)
+    monkeypatch.setattr(history_archive, 'BATCH_SIZE', 7)
+    monkeypatch.setattr(history_archive, 'PART_IDS', 10)
+    monkeypatch.setattr(history_archive, 'VACUUM_PAUSE', 0)
+    return history_archive
+
+
+def add_rows(history, days_ago, count, date=True):
+    created = NOW - datetime.timedelta(days=days_ago)
+    with history.get_connection() as conn:
+        conn.executemany(
+            'INSERT INTO history (filename, date, prediction, confidence, created_at) VALUES (?, ?, ?, ?, ?)',
+            [(f'leaf_{days_ago}_{i}.jpg', created.strftime(history.DATE_FORMAT) if date else None,
+              'Tomato___healthy', 90.0, history.to_epoch(created)) for i in range(count)])
+
+
+def archived_ids(archive):
+    return [row['id'] for row in archive.scan_archive()]
+
+
+def test_moves_old_rows_to_day_partitions(archive, history_db):
+    add_rows(history_db, 40, 12)
+    add_rows(history_db, 35, 5)
+    add_rows(history_db, 1, 3)
+
+    summary = archive.archive_old_entries(older_than_days=30)
+
+    assert summary['rows'] == 17
+    assert sorted(archived_ids(archive)) == list(range(1, 18))
+    assert [entry['id'] for entry in history_db.get_history()] == [20, 19, 18]
+    assert [row['id'] for row in archive.iter_all()] == list(range(1, 21))
+
+
+def test_resume_with_a_later_cutoff_archives_every_row_once(archive, history_db, monkeypatch):
+    add_rows(history_db, 40, 5)
+    add_rows(history_db, 20, 19)
+    write_partition = archive._write_partition
+
+    def crash_after_writing(*args):
+        write_partition(*args)
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(archive, '_write_partition', crash_after_writing)
+    with pytest.raises(KeyboardInterrupt):
+        archive.archive_old_entries(older_than_days=30)
+    monkeypatch.setattr(archive, '_write_partition', write_partition)
+    assert archived_ids(archive)
+    assert len(history_db.get_history()) == 24
+
+    # Resumed a few weeks later: the first batch now reaches into newer days
+    summary = archive.archive_old_entries(older_than_days=10)
+
+    assert summary['rows'] == 24
+    assert sorted(archived_ids(archive)) == list(range(1, 25))
+    assert history_db.get_history() == []
+
+
+def test_rows_without_a_date_text_are_archived_by_created_at(archive, history_db):
+    add_rows(history_db, 40, 2, date=False)
+
+    assert archive.archive_old_entries(older_than_days=30)['rows'] == 2
+    day = (NOW - datetime.timedelta(days=40)).strftime('%Y-%m-%d')
+    start = datetime.datetime.strptime(day, '%Y-%m-%d')
+    rows = list(archive.scan_archive(start, start + datetime.timedelta(days=1)))
+    assert [(row['id'], row['date']) for row in rows] == [(1, None), (2, None)]
@@ -0,0 +1,75 @@
+import datetime
+import os
+import time
+
+import pytest
+
+from test_history import add_at
+
+START = datetime.datetime(2025, 3, 9, 22, 10)
+
+
+@pytest.fixture(params=['UTC', 'Asia/Kolkata', 'America/New_York'])
+def local_tz(request):
+    """Run in a whole-hour, a half-hour and a DST time zone"""
+    previous = os.environ.get('TZ')
+    os.environ['TZ'] = request.param
+    time.tzset()
+    yield request.param
+    if previous is None:
+        del os.environ['TZ']
+    else:
+        os.environ['TZ'] = previous
+    time.tzset()
+
+
+def add_spread(history):
+    """Entries every 50 minutes over two days, across a DST change in New York"""
+    for step in range(60):
+        prediction = 'Rice___Blast' if step % 3 else 'Rice___healthy'
+        add_at(history, START + datetime.timedelta(minutes=50 * step), prediction)
+
+
+def rollup_rows(history, granularity):
+    return history.get_rollups(granularity, START - datetime.timedelta(days=1), START + datetime.timedelta(days=3))
+
+
+def test_hour_buckets_start_on_the_local_hour(history_db, local_tz):
+    add_at(history_db, datetime.datetime(2025, 3, 10, 10, 40), count=2)
+
+    row, = rollup_rows(history_db, 'hour')
+
+    assert row['start'] == '2025-03-10 10:00:00'
+    assert row['count'] == 2
+    assert history_db.hour_bucket(row['bucket'] + 3599) == row['bucket']
+
+
+def test_incremental_rollups_match_a_rebuild(history_db, local_tz):
+    add_spread(history_db)
+    history_db.flush()
+    incremental = {granularity: rollup_rows(history_db, granularity) for granularity in ('hour', 'day')}
+
+    history_db.rebuild_rollups()
+
+    for granularity, rows in incremental.items():
+        assert rollup_rows(history_db, granularity) == rows
+
+
+def test_hours_add_up_to_days(history_db, local_tz):
+    add_spread(history_db)
+
+    days = {(row['start'][:10], row['prediction']): row['count'] for row in rollup_rows(history_db, 'day')}
+    hours = {}
+    for row in rollup_rows(history_db, 'hour'):
+        key = (row['start'][:10], row['prediction'])
+        hours[key] = hours.get(key, 0) + row['count']
+
+    assert hours == days
+    assert sum(days.values()) == 60
+    assert all(start.endswith('00:00:00') for start in
+               (row['start'] for row in rollup_rows(history_db, 'day')))
+
+
+def test_rollups_reject_unknown_granularity(history_db):
+    with pytest.raises(ValueError):
+        history_db.get_rollups('week')
@@ -0,0 +1,56 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+
+def run_threads(count, target):
+    threads = [threading.Thread(target=target) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_counter_keeps_the_counts_of_exited_threads():
+    counter = metrics.Counter('test_exited_threads_total', 'test', ['result'])
+    run_threads(50, lambda: counter.inc('ok', amount=2))
+    counter.inc('ok')
+
+    assert counter.samples() == [('test_exited_threads_total', ('ok',), 101)]
+    # Only the calling thread still has a shard
+    assert len(counter._shards) == 1
+
+
+def test_histogram_folds_pool_thread_shards_on_exit():
+    histogram = metrics.Histogram('test_pool_seconds', 'test', buckets=(0.1, 1.0))
+    for _ in range(5):
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            list(pool.map(lambda value: histogram.observe(value), [0.05, 0.5, 5.0] * 4))
+
+    assert not histogram._shards
+    samples = {(name, labels): value for name, labels, value in histogram.samples()}
+    assert samples[('test_pool_seconds_bucket', ('0.1',))] == 20
+    assert samples[('test_pool_seconds_bucket', ('1.0',))] == 40
+    assert samples[('test_pool_seconds_bucket', ('+Inf',))] == 60
+    assert samples[('test_pool_seconds_count', ())] == 60
+
+
+def test_scrape_while_threads_come_and_go_never_loses_counts():
+    counter = metrics.Counter('test_churn_total', 'test')
+    stop = threading.Event()
+    scraped = []
+
+    def scrape():
+        while not stop.is_set():
+            scraped.append(sum(value for _, _, value in counter.samples()))
+
+    scraper = threading.Thread(target=scrape)
+    scraper.start()
+    for _ in range(20):
+        run_threads(10, lambda: counter.inc(amount=1))
+    stop.set()
+    scraper.join()
+
+    assert scraped == sorted(scraped)
+    assert counter.samples() == [('test_churn_total', (), 200)]
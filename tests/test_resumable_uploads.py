@@ -0,0 +1,85 @@
+import base64
+import os
+
+from conftest import image_bytes
+
+TUS_HEADERS = {'Tus-Resumable': '1.0.0'}
+
+
+def create_upload(client, length, filename):
+    response = client.post('/resumable_uploads', headers={
+        **TUS_HEADERS,
+        'Upload-Length': str(length),
+        'Upload-Metadata': 'filename ' + base64.b64encode(filename.encode()).decode(),
+    })
+    assert response.status_code == 201
+    return response.headers['Location']
+
+
+def send_chunk(client, upload_url, data, offset):
+    return client.patch(upload_url, data=data, headers={
+        **TUS_HEADERS,
+        'Upload-Offset': str(offset),
+        'Content-Type': 'application/offset+octet-stream',
+    })
+
+
+def upload_in_chunks(client, data, filename, chunk_size=200):
+    upload_url = create_upload(client, len(data), filename)
+    for offset in range(0, len(data), chunk_size):
+        response = send_chunk(client, upload_url, data[offset:offset + chunk_size], offset)
+        assert response.status_code == 204
+        assert int(response.headers['Upload-Offset']) == min(offset + chunk_size, len(data))
+    return upload_url
+
+
+def test_resumes_at_the_server_offset_after_a_dropped_connection(app_client):
+    data = image_bytes()
+    upload_url = create_upload(app_client, len(data), 'leaf.jpg')
+    send_chunk(app_client, upload_url, data[:300], 0)
+
+    # The client lost track of what arrived and starts over
+    response = send_chunk(app_client, upload_url, data, 0)
+    assert response.status_code == 409
+    assert response.headers['Upload-Offset'] == '300'
+
+    offset = int(app_client.head(upload_url, headers=TUS_HEADERS).headers['Upload-Offset'])
+    assert send_chunk(app_client, upload_url, data[offset:], offset).status_code == 204
+    assert app_client.post(upload_url + '/finalize', headers=TUS_HEADERS).status_code == 200
+
+
+def test_finalize_saves_each_upload_under_its_own_name(app_client, history_db, tmp_path):
+    first = upload_in_chunks(app_client, image_bytes('green'), 'leaf.jpg')
+    second = upload_in_chunks(app_client, image_bytes('brown'), 'leaf.jpg')
+
+    results = [app_client.post(url + '/finalize', headers=TUS_HEADERS) for url in (first, second)]
+
+    assert [response.status_code for response in results] == [200, 200]
+    entries = history_db.get_entries([response.get_json()['history_id'] for response in results])
+    filenames = [entry['filename'] for entry in entries]
+    assert len(set(filenames)) == 2
+    assert all(name.endswith('_leaf.jpg') for name in filenames)
+    assert sorted(os.listdir(tmp_path / 'uploads')) == sorted(filenames)
+    assert os.listdir(tmp_path / 'partial') == []
+
+
+def test_finalize_twice_returns_the_first_result(app_client, history_db):
+    upload_url = upload_in_chunks(app_client, image_bytes(), 'leaf.jpg')
+
+    first = app_client.post(upload_url + '/finalize', headers=TUS_HEADERS)
+    again = app_client.post(upload_url + '/finalize', headers=TUS_HEADERS)
+
+    assert again.status_code == 200
+    assert again.get_json() == first.get_json()
+    assert len(history_db.get_history()) == 1
+
+
+def test_finalize_before_the_last_byte_is_a_conflict(app_client):
+    data = image_bytes()
+    upload_url = create_upload(app_client, len(data), 'leaf.jpg')
+    send_chunk(app_client, upload_url, data[:100], 0)
+
+    response = app_client.post(upload_url + '/finalize', headers=TUS_HEADERS)
+
+    assert response.status_code == 409
+    assert response.headers['Upload-Offset'] == '100'
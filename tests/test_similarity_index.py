@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+import similarity_index
+
+
+def unit(seed, dim=16):
+    vector = np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+@pytest.fixture
+def index(tmp_path):
+    return similarity_index.EmbeddingIndex('test', 16, str(tmp_path))
+
+
+def test_ids_in_order_need_no_per_row_lookup_table(index):
+    for entry_id in range(1, 2001):
+        index.add(entry_id, unit(entry_id))
+
+    assert not index._late_rows
+    for entry_id in (1, 2, 777, 1999, 2000):
+        np.testing.assert_allclose(index.get_vector(entry_id), unit(entry_id), rtol=1e-6)
+    assert index.get_vector(0) is None
+    assert index.get_vector(2001) is None
+
+
+def test_finds_rows_appended_out_of_order_and_reindexed_entries(index):
+    # Two workers racing: 103 and 104 land before 101 and 102
+    for entry_id in [*range(1, 101), 103, 104, 101, 102, *range(105, 300)]:
+        index.add(entry_id, unit(entry_id))
+    index.add(50, unit(5000))
+
+    for entry_id in range(1, 300):
+        expected = unit(5000) if entry_id == 50 else unit(entry_id)
+        np.testing.assert_allclose(index.get_vector(entry_id), expected, rtol=1e-6)
+    assert sorted(index._late_rows) == [50, 101, 102]
+
+
+def test_sees_rows_appended_by_another_process(index, tmp_path):
+    index.add(1, unit(1))
+    other = similarity_index.EmbeddingIndex('test', 16, str(tmp_path))
+    other.add(2, unit(2))
+
+    assert len(index) == 2
+    assert index.search(unit(2), k=1) == [(2, pytest.approx(1.0))]
+    np.testing.assert_allclose(index.get_vector(2), unit(2), rtol=1e-6)
@@ -0,0 +1,64 @@
+"""
+Thumbnails
+Small copies of uploaded images for the history page and PDF reports, made
+on first request and cached on disk next to the uploads.
+
+A thumbnail's cache key hashes the source file's path, size and mtime, so
+an upload saved again under the same name gets a new key (and URL, see
+thumbnail_url() in app.py) instead of a stale thumbnail. The key doubles as
+the ETag, so a conditional request is answered without opening any image.
+"""
+
+import hashlib
+import os
+import uuid
+
+from PIL import Image, ImageOps
+
+import metrics
+import upload_validation
+
+THUMBNAIL_DIR = os.getenv('THUMBNAIL_DIR', os.path.join('uploads', 'thumbs'))
+# Longest side in pixels: 'small' covers the history table on high-DPI
+# screens, 'report' a 100 mm wide image in a PDF at about 200 dpi
+SIZES = {'small': 160, 'report': 800}
+QUALITY = int(os.getenv('THUMBNAIL_QUALITY', 80))
+
+FORMATS = {'webp': ('WEBP', 'image/webp'), 'jpeg': ('JPEG', 'image/jpeg')}
+
+
+def cache_key(source_path, size, image_format):
+    """Identifies one rendition of the source as it is now; raises FileNotFoundError"""
+    stat = os.stat(source_path)
+    digest = hashlib.sha1(f'{os.path.abspath(source_path)}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    return f'{digest.hexdigest()[:16]}-{size}-{image_format}'
+
+
+def best_format(accepts_webp):
+    return 'webp' if accepts_webp and upload_validation.WEBP_SUPPORTED else 'jpeg'
+
+
+def thumbnail_path(source_path, size='small', image_format='jpeg'):
+    """Path of the cached thumbnail, rendering it first if needed"""
+    key = cache_key(source_path, size, image_format)
+    stem = os.path.splitext(os.path.basename(source_path))[0]
+    path = os.path.join(THUMBNAIL_DIR, f'{stem}-{key}.{image_format}')
+    if os.path.exists(path):
+        metrics.CACHE_REQUESTS.inc('thumbnail', 'hit')
+        return path
+
+    metrics.CACHE_REQUESTS.inc('thumbnail', 'miss')
+    max_side = SIZES[size]
+    with Image.open(source_path) as img:
+        img.draft('RGB', (max_side, max_side))  # JPEG: decode at a reduced scale
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+
+        os.makedirs(THUMBNAIL_DIR, exist_ok=True)
+        # Concurrent requests may render the same thumbnail; each writes its own file
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        img.save(tmp_path, FORMATS[image_format][0], quality=QUALITY)
+        os.replace(tmp_path, path)
+    return path
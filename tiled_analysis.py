@@ -0,0 +1,217 @@
+"""
+Tiled Analysis of Large Images
+Splits field and drone images into overlapping 224x224 tiles, classifies them
+in fixed-size batches and builds a per-tile disease grid and heatmap.
+
+With pyvips installed (pip install pyvips pyvips-binary) the image is
+streamed: rows are read top to bottom, one band of TILE_SIZE rows at a time,
+and analyzed at full resolution. Memory grows with the image width only, so
+images up to MAX_IMAGE_PIXELS (1 gigapixel) are accepted.
+
+Without it Pillow decodes the whole image. JPEGs larger than
+MAX_DECODE_PIXELS are decoded at a reduced scale by libjpeg (draft mode) and
+analyzed at that scale; PNG and WebP above it are rejected, and uploads stay
+under upload_validation.MAX_IMAGE_PIXELS (100 megapixels).
+"""
+
+import importlib.util
+import os
+
+import numpy as np
+from PIL import Image
+
+import upload_validation
+
+TILE_SIZE = 224
+TILE_OVERLAP = int(os.getenv('TILE_OVERLAP', 32))
+TILE_BATCH_SIZE = int(os.getenv('TILE_BATCH_SIZE', 32))
+MAX_DECODE_PIXELS = int(os.getenv('TILED_MAX_DECODE_PIXELS', 64_000_000))
+
+STREAMING_AVAILABLE = importlib.util.find_spec('pyvips') is not None
+# Largest image accepted for tiled analysis (see the module docstring)
+MAX_IMAGE_PIXELS = (int(os.getenv('TILED_MAX_IMAGE_PIXELS', 1_000_000_000)) if STREAMING_AVAILABLE
+                    else upload_validation.MAX_IMAGE_PIXELS)
+HEATMAP_MAX_SIDE = 1024
+
+HEALTHY_COLOR = (46, 204, 113)
+DISEASED_COLOR = (231, 76, 60)
+
+
+def open_bounded(image_path, max_pixels=MAX_DECODE_PIXELS):
+    """Open an image decoded at no more than max_pixels.
+
+    Returns (RGB image, scale) where scale is decoded size / original size.
+    """
+    img = Image.open(image_path)
+    width, height = img.size
+
+    if width * height > max_pixels:
+        if img.format != 'JPEG':
+            raise ValueError(f'Image is too large for tiled analysis ({width}x{height}); '
+                             f'use JPEG or reduce it below {max_pixels} pixels')
+        # libjpeg can only scale by 1/2, 1/4 or 1/8 while decoding and picks
+        # the smallest scale that is at least the requested size, so ask for
+        # half the target to land below max_pixels
+        factor = (width * height / max_pixels) ** 0.5
+        img.draft('RGB', (int(width / factor / 2), int(height / factor / 2)))
+        if img.size[0] * img.size[1] > max_pixels:
+            raise ValueError(f'Image is too large for tiled analysis ({width}x{height})')
+
+    img = img.convert('RGB')
+    return img, img.size[0] / width
+
+
+def tile_positions(width, height, tile_size=TILE_SIZE, overlap=TILE_OVERLAP):
+    """Top-left corners of overlapping tiles covering the whole image"""
+    stride = tile_size - overlap
+
+    def axis(length):
+        if length <= tile_size:
+            return [0]
+        starts = list(range(0, length - tile_size + 1, stride))
+        if starts[-1] != length - tile_size:
+            starts.append(length - tile_size)
+        return starts
+
+    return axis(height), axis(width)
+
+
+def iter_pil_bands(img, ys, tile_size=TILE_SIZE):
+    """Yield (row, uint8 array of tile_size image rows) from a decoded Pillow image"""
+    for row, y in enumerate(ys):
+        yield row, np.asarray(img.crop((0, y, img.size[0], min(y + tile_size, img.size[1]))))
+
+
+def _vips_rgb(image):
+    """8-bit sRGB without alpha, like Pillow's convert('RGB')"""
+    if image.hasalpha():
+        image = image.flatten()
+    image = image.colourspace('srgb')
+    if image.bands == 1:
+        image = image.bandjoin([image, image])
+    return image
+
+
+def open_streaming(image_path):
+    """Open an image with pyvips for sequential reading; returns (image, width, height)"""
+    import pyvips
+    image = _vips_rgb(pyvips.Image.new_from_file(image_path, access='sequential'))
+    return image, image.width, image.height
+
+
+def iter_streamed_bands(image, ys, tile_size=TILE_SIZE):
+    """Yield (row, uint8 array of tile_size image rows), reading each image row once.
+
+    The rows shared by overlapping bands are kept from the previous band, so
+    the file is read strictly top to bottom.
+    """
+    band = np.zeros((0, image.width, 3), dtype=np.uint8)
+    top = 0  # image row of band[0]
+    for row, y in enumerate(ys):
+        end = min(y + tile_size, image.height)
+        read_from = top + len(band)
+        if end > read_from:
+            band = np.concatenate([band, image.crop(0, read_from, image.width, end - read_from).numpy()])
+        band = band[y - top:]
+        top = y
+        yield row, band[:end - y]
+
+
+def iter_tile_batches(bands, xs, batch_size=TILE_BATCH_SIZE, tile_size=TILE_SIZE):
+    """Yield (cells, uint8 batch of shape (n, tile, tile, 3)) in row-major order.
+
+    bands yields (row, array of that tile row's image rows). Tiles past the
+    edge of a small image are padded with black.
+    """
+    batch = np.zeros((batch_size, tile_size, tile_size, 3), dtype=np.uint8)
+    cells = []
+
+    for row, band in bands:
+        for col, x in enumerate(xs):
+            tile = band[:, x:x + tile_size]
+            batch[len(cells)] = 0
+            batch[len(cells), :tile.shape[0], :tile.shape[1]] = tile
+            cells.append((row, col))
+            if len(cells) == batch_size:
+                yield cells, batch
+                cells = []
+
+    if cells:
+        yield cells, batch[:len(cells)]
+
+
+def analyze_tiled(image_path, classify_batch, heatmap_path=None):
+    """Classify every tile of an image, optionally saving a heatmap PNG.
+
+    classify_batch(uint8 array (n, 224, 224, 3)) -> list of (class_name, confidence)
+    """
+    if STREAMING_AVAILABLE:
+        image, width, height = open_streaming(image_path)
+        scale = 1.0
+        ys, xs = tile_positions(width, height)
+        bands = iter_streamed_bands(image, ys)
+    else:
+        img, scale = open_bounded(image_path)
+        width, height = img.size
+        ys, xs = tile_positions(width, height)
+        bands = iter_pil_bands(img, ys)
+
+    classes = []
+    class_index = {}
+    class_grid = np.zeros((len(ys), len(xs)), dtype=np.int32)
+    confidence_grid = np.zeros((len(ys), len(xs)), dtype=np.float32)
+
+    for cells, batch in iter_tile_batches(bands, xs):
+        for (row, col), (class_name, confidence) in zip(cells, classify_batch(batch)):
+            if class_name not in class_index:
+                class_index[class_name] = len(classes)
+                classes.append(class_name)
+            class_grid[row, col] = class_index[class_name]
+            confidence_grid[row, col] = confidence
+
+    healthy = np.array(['healthy' in name.lower() for name in classes], dtype=bool)
+    counts = np.bincount(class_grid.ravel(), minlength=len(classes))
+    diseased_tiles = int(counts[~healthy].sum()) if len(classes) else 0
+
+    if heatmap_path:
+        if STREAMING_AVAILABLE:
+            # A second, shrink-on-load pass: only the preview is decoded
+            import pyvips
+            img = Image.fromarray(_vips_rgb(pyvips.Image.thumbnail(image_path, HEATMAP_MAX_SIDE)).numpy())
+        render_heatmap(img, class_grid, confidence_grid, healthy, heatmap_path)
+
+    return {
+        'image_size': [int(width / scale), int(height / scale)],
+        'analysis_scale': round(scale, 4),
+        'tile_size': TILE_SIZE,
+        'stride': TILE_SIZE - TILE_OVERLAP,
+        'rows': len(ys),
+        'cols': len(xs),
+        'classes': classes,
+        'class_grid': class_grid.tolist(),
+        'confidence_grid': np.round(confidence_grid, 2).tolist(),
+        'tile_counts': {name: int(n) for name, n in zip(classes, counts)},
+        'diseased_fraction': round(diseased_tiles / class_grid.size, 4)
+    }
+
+
+def render_heatmap(img, class_grid, confidence_grid, healthy, output_path):
+    """Overlay the tile grid on a preview of the image and save it as PNG.
+
+    Healthy tiles are tinted green and diseased tiles red, with opacity
+    proportional to the tile's confidence.
+    """
+    confidence = confidence_grid / 100.0
+    diseased = ~healthy[class_grid]
+
+    overlay = np.zeros(class_grid.shape + (4,), dtype=np.uint8)
+    overlay[..., :3] = np.where(diseased[..., None], DISEASED_COLOR, HEALTHY_COLOR)
+    overlay[..., 3] = (np.clip(confidence, 0, 1) * 160).astype(np.uint8)
+
+    preview = img.copy()
+    preview.thumbnail((HEATMAP_MAX_SIDE, HEATMAP_MAX_SIDE))
+    heat = Image.fromarray(overlay, 'RGBA').resize(preview.size, Image.NEAREST)
+
+    result = Image.alpha_composite(preview.convert('RGBA'), heat)
+    result.convert('RGB').save(output_path, 'PNG')
+    return output_path
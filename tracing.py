@@ -0,0 +1,229 @@
+"""
+Logging and Request Tracing
+Leveled, structured (key=value) logging for the request hot paths, plus
+lightweight traces kept in an in-memory ring buffer.
+
+Log records are handed to a background thread through a queue, so request
+threads never block on stdout. Every request gets a trace made of timed
+spans (cascade stages, history insert, ...); the last TRACE_BUFFER_SIZE
+traces are served at /debug/traces when DEBUG_ENDPOINTS=1 or the app runs
+in debug mode.
+
+Per-image color feature dumps are verbose, so they are only attached to a
+trace (and logged) for a TRACE_FEATURE_SAMPLE_RATE fraction of images, or
+for every image at LOG_LEVEL=DEBUG.
+"""
+
+import atexit
+import contextvars
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+TRACE_BUFFER_SIZE = int(os.getenv('TRACE_BUFFER_SIZE', 200))
+FEATURE_SAMPLE_RATE = float(os.getenv('TRACE_FEATURE_SAMPLE_RATE', 0.01))
+DEBUG_ENDPOINTS = os.getenv('DEBUG_ENDPOINTS', '0') == '1'
+
+# Requests that are not worth a trace
+UNTRACED_ENDPOINTS = {'static', 'metrics', 'debug_traces'}
+
+_traces = deque(maxlen=TRACE_BUFFER_SIZE)
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+_log_queue = None
+_listener = None
+
+
+class StructuredFormatter(logging.Formatter):
+    """'time LEVEL logger message key=value ...' from the record's fields"""
+
+    def format(self, record):
+        line = super().format(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            line += ' ' + ' '.join(f'{key}={_format_field(value)}' for key, value in fields.items())
+        return line
+
+
+def _format_field(value):
+    if isinstance(value, float):
+        return f'{value:.4g}'
+    text = str(value)
+    return f'"{text}"' if ' ' in text else text
+
+
+def configure_logging():
+    """Send the 'cropdoctor' loggers to stderr through a background thread"""
+    global _listener
+    if _listener is not None:
+        return
+
+    global _log_queue
+    handler = logging.StreamHandler()
+    handler.setFormatter(StructuredFormatter('%(asctime)s %(levelname)s %(name)s %(message)s'))
+
+    _log_queue = queue.SimpleQueue()
+    root = logging.getLogger('cropdoctor')
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(logging.handlers.QueueHandler(_log_queue))
+    root.propagate = False
+
+    _listener = logging.handlers.QueueListener(_log_queue, handler)
+    _listener.start()
+    atexit.register(_stop_listener)
+    os.register_at_fork(after_in_child=_restart_listener)
+
+
+def _stop_listener():
+    if _listener is not None:
+        _listener.stop()
+
+
+def _restart_listener():
+    """The listener thread does not survive fork() (gunicorn workers, the
+    color pool); without a new one a child's records would pile up unread"""
+    global _listener
+    _listener = logging.handlers.QueueListener(_log_queue, *_listener.handlers)
+    _listener.start()
+
+
+def get_logger(name):
+    return logging.getLogger(f'cropdoctor.{name}')
+
+
+def log(logger, level, message, **fields):
+    """Log a message with key=value fields, skipping all work when the level is off"""
+    if logger.isEnabledFor(level):
+        logger.log(level, message, extra={'fields': fields})
+
+
+# ============================================================================
+# TRACES
+# ============================================================================
+
+def start_trace(name, **attrs):
+    """Begin a trace for the current request or job; returns a token for finish_trace"""
+    trace = {
+        'trace_id': uuid.uuid4().hex[:16],
+        'name': name,
+        'started_at': time.time(),
+        'attrs': attrs,
+        'spans': [],
+        'events': [],
+        '_start': time.perf_counter(),
+    }
+    return _current_trace.set(trace)
+
+
+def finish_trace(token, **attrs):
+    trace = _current_trace.get()
+    _current_trace.reset(token)
+    if trace is None:
+        return
+    trace['duration_ms'] = round((time.perf_counter() - trace.pop('_start')) * 1000, 3)
+    trace['attrs'].update(attrs)
+    _traces.append(trace)  # deque.append is thread-safe
+
+
+@contextmanager
+def trace(name, **attrs):
+    token = start_trace(name, **attrs)
+    try:
+        yield
+    except Exception as e:
+        annotate(error=str(e))
+        raise
+    finally:
+        finish_trace(token)
+
+
+@contextmanager
+def span(name, **attrs):
+    """Time a block as a span of the current trace (a no-op outside a trace)"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield attrs
+        return
+    start = time.perf_counter()
+    try:
+        yield attrs
+    finally:
+        trace['spans'].append({
+            'name': name,
+            'offset_ms': round((start - trace['_start']) * 1000, 3),
+            'duration_ms': round((time.perf_counter() - start) * 1000, 3),
+            **attrs,
+        })
+
+
+def annotate(**attrs):
+    """Attach attributes to the current trace"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace['attrs'].update(attrs)
+
+
+def event(name, **fields):
+    """Attach a point-in-time record (e.g. a feature dump) to the current trace"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace['events'].append({'name': name, 'offset_ms': round((time.perf_counter() - trace['_start']) * 1000, 3),
+                                **fields})
+
+
+def sample_features(logger):
+    """Whether this image's full feature dump should be recorded"""
+    return logger.isEnabledFor(logging.DEBUG) or (FEATURE_SAMPLE_RATE > 0 and random.random() < FEATURE_SAMPLE_RATE)
+
+
+def recent_traces(limit=50, name=None):
+    """Most recent finished traces, newest first"""
+    traces = [t for t in reversed(list(_traces)) if name is None or t['name'] == name]
+    return traces[:limit]
+
+
+def init_app(app):
+    """Trace every request of a Flask app and serve /debug/traces"""
+    from flask import abort, g, jsonify, request
+
+    @app.before_request
+    def _start_request_trace():
+        if request.endpoint not in UNTRACED_ENDPOINTS:
+            g.trace_token = start_trace(request.endpoint or 'unmatched', method=request.method, path=request.path)
+
+    @app.after_request
+    def _record_trace_status(response):
+        if 'trace_token' in g:
+            g.trace_status = response.status_code
+        return response
+
+    # Teardown also runs when the view (or an after_request hook) raised
+    @app.teardown_request
+    def _finish_request_trace(exc):
+        token = g.pop('trace_token', None)
+        if token is None:
+            return
+        attrs = {'status': g.pop('trace_status', 500)}
+        if exc is not None:
+            attrs['error'] = f'{type(exc).__name__}: {exc}'
+        finish_trace(token, **attrs)
+
+    def debug_traces():
+        """Recent request traces (?limit=50&name=<endpoint>)"""
+        if not (DEBUG_ENDPOINTS or app.debug):
+            abort(404)
+        limit = min(request.args.get('limit', 50, type=int), TRACE_BUFFER_SIZE)
+        return jsonify({'buffer_size': TRACE_BUFFER_SIZE,
+                        'feature_sample_rate': FEATURE_SAMPLE_RATE,
+                        'traces': recent_traces(limit, request.args.get('name'))})
+
+    app.add_url_rule('/debug/traces', 'debug_traces', debug_traces)
+
+
+configure_logging()
@@ -0,0 +1,268 @@
+"""
+Offline replay and re-tuning of the color heuristic decision table
+(color_rules.py).
+
+Feature vectors are extracted once and stored, so the table can then be
+replayed against thousands of images in milliseconds and its thresholds
+tuned by coordinate search against known labels.
+
+Usage:
+    # 1. Extract features from a labelled image folder (one sub-folder per
+    #    class, named like the classes, e.g. Tomato___Late_blight/)
+    python tune_color_rules.py extract dataset/ -o features.npz
+
+    # 2. Replay a table against stored features
+    python tune_color_rules.py replay features.npz
+    python tune_color_rules.py replay features.npz --rules tuned_rules.json
+
+    # 3. Tune thresholds and save the table; load it with COLOR_RULES_FILE
+    python tune_color_rules.py tune features.npz -o tuned_rules.json --rounds 3
+
+    # Dump the built-in table as JSON for hand editing
+    python tune_color_rules.py export -o color_rules.json
+
+Stored features can also be JSON lines, one feature dict per line with an
+optional "label" (e.g. the color_features events from /debug/traces).
+"""
+
+import argparse
+import copy
+import json
+import os
+import re
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import color_analysis
+import color_rules
+from color_analysis import FEATURE_NAMES
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+# Relative threshold changes tried for every condition in each tuning round
+TUNE_STEPS = (-0.3, -0.2, -0.1, -0.05, 0.05, 0.1, 0.2, 0.3)
+
+
+def normalize_label(name):
+    return re.sub(r'[^a-z0-9]', '', name.lower())
+
+
+# ============================================================================
+# STORED FEATURES
+# ============================================================================
+
+def _extract(path):
+    try:
+        return color_rules.features_to_row(color_analysis.extract_features(path))
+    except Exception:
+        return None
+
+
+def extract_dataset(image_dir, output, workers=None):
+    paths, labels = [], []
+    for label in sorted(os.listdir(image_dir)):
+        class_dir = os.path.join(image_dir, label)
+        if not os.path.isdir(class_dir):
+            continue
+        for name in sorted(os.listdir(class_dir)):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.join(class_dir, name))
+                labels.append(label)
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        rows = list(executor.map(_extract, paths, chunksize=32))
+    keep = [i for i, row in enumerate(rows) if row is not None]
+
+    np.savez_compressed(output,
+                        features=np.array([rows[i] for i in keep], dtype=np.float64),
+                        labels=np.array([labels[i] for i in keep]),
+                        paths=np.array([paths[i] for i in keep]),
+                        feature_names=np.array(FEATURE_NAMES))
+    print(f"[OK] {len(keep)} feature vectors from {len(paths)} images saved to {output} "
+          f"({time.perf_counter() - start:.1f}s, {len(paths) - len(keep)} unreadable)")
+
+
+def load_features(path):
+    """-> (X matrix, labels array or None)"""
+    if path.endswith('.npz'):
+        data = np.load(path, allow_pickle=False)
+        if tuple(data['feature_names']) != FEATURE_NAMES:
+            raise ValueError(f'{path} was extracted with a different feature set')
+        return data['features'], data['labels'] if 'labels' in data else None
+
+    rows, labels = [], []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            features = record.get('features', record)
+            rows.append([float(features[name]) for name in FEATURE_NAMES])
+            labels.append(record.get('label'))
+    has_labels = all(label is not None for label in labels)
+    return np.array(rows, dtype=np.float64), np.array(labels) if has_labels else None
+
+
+# ============================================================================
+# REPLAY
+# ============================================================================
+
+def evaluate(table, X, truth, metric='accuracy'):
+    """Share of rows whose predicted class (or healthy/diseased call) is right"""
+    _, labels = table.classify_matrix(X)
+    if metric == 'health':
+        healthy = np.array(['healthy' in name.lower() for name in table.label_names])
+        return float(np.mean(healthy[labels] == truth))
+    names = np.array([normalize_label(name) for name in table.label_names])
+    return float(np.mean(names[labels] == truth))
+
+
+def encode_truth(labels, metric='accuracy'):
+    """Ground-truth labels in the form evaluate() compares against"""
+    if metric == 'health':
+        return np.array(['healthy' in label.lower() for label in labels])
+    return np.array([normalize_label(label) for label in labels])
+
+
+def replay(table, X, labels):
+    start = time.perf_counter()
+    plants, label_idx = table.classify_matrix(X)
+    elapsed = time.perf_counter() - start
+    predicted = table.label_names[label_idx]
+
+    print("\n" + "="*72)
+    print(f"REPLAYED {len(X)} FEATURE VECTORS in {elapsed * 1000:.1f} ms "
+          f"({elapsed / max(len(X), 1) * 1e6:.2f} us/vector)")
+    print("="*72)
+
+    print("\nPlant types:")
+    for idx, n in Counter(plants.tolist()).most_common():
+        print(f"  {table.plant_names[idx]:<20}{n:>8}{n / len(X) * 100:>8.1f}%")
+
+    print("\nPredicted classes:")
+    for name, n in Counter(predicted.tolist()).most_common():
+        print(f"  {name:<52}{n:>8}")
+
+    if labels is not None:
+        print(f"\nClass accuracy:  {evaluate(table, X, encode_truth(labels)) * 100:.1f}%")
+        print(f"Health accuracy: {evaluate(table, X, encode_truth(labels, 'health'), 'health') * 100:.1f}%")
+        print("\nRecall per true class:")
+        for label in sorted(set(labels.tolist())):
+            rows = labels == label
+            hits = np.mean([normalize_label(p) == normalize_label(label) for p in predicted[rows]])
+            print(f"  {label:<52}{hits * 100:>7.1f}%  (n={rows.sum()})")
+    print("="*72 + "\n")
+
+
+# ============================================================================
+# TUNING
+# ============================================================================
+
+def threshold_leaves(table):
+    """Every [feature, op, threshold] condition in the table (shared ones once)"""
+    leaves, seen = [], set()
+
+    def walk(cond):
+        if isinstance(cond, dict):
+            for part in next(iter(cond.values())):
+                walk(part)
+        elif id(cond) not in seen:
+            seen.add(id(cond))
+            leaves.append(cond)
+
+    for rule in table['plants']:
+        walk(rule['when'])
+    for rules in table['diseases'].values():
+        for rule in rules:
+            if rule.get('when') is not None:
+                walk(rule['when'])
+    return leaves
+
+
+def tune(table, X, labels, rounds=3, metric='accuracy', holdout=0.2, min_gain=1e-4, seed=0):
+    """Greedy coordinate search over every threshold; returns the tuned table dict"""
+    table = copy.deepcopy(table)
+    truth = encode_truth(labels, metric)
+
+    order = np.random.default_rng(seed).permutation(len(X))
+    n_holdout = int(len(X) * holdout)
+    test, train = order[:n_holdout], order[n_holdout:]
+
+    def score(candidate, rows):
+        return evaluate(color_rules.DecisionTable(candidate), X[rows], truth[rows], metric)
+
+    best = score(table, train)
+    print(f"[INFO] Start: train {best * 100:.2f}%"
+          + (f", holdout {score(table, test) * 100:.2f}%" if n_holdout else ''))
+
+    leaves = threshold_leaves(table)
+    for round_no in range(1, rounds + 1):
+        changed = 0
+        for leaf in leaves:
+            original = leaf[2]
+            best_value = original
+            for step in TUNE_STEPS:
+                leaf[2] = round(original * (1 + step), 6) if original else step
+                value = score(table, train)
+                if value > best + min_gain:
+                    best, best_value = value, leaf[2]
+            leaf[2] = best_value
+            if best_value != original:
+                changed += 1
+                print(f"  {leaf[0]} {leaf[1]} {original} -> {best_value}  (train {best * 100:.2f}%)")
+        print(f"[INFO] Round {round_no}: {changed} thresholds changed, train {best * 100:.2f}%"
+              + (f", holdout {score(table, test) * 100:.2f}%" if n_holdout else ''))
+        if not changed:
+            break
+    return table
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay and re-tune the color heuristic decision table')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('extract', help='extract features from a labelled image folder')
+    p.add_argument('image_dir')
+    p.add_argument('-o', '--output', default='color_features.npz')
+    p.add_argument('-j', '--workers', type=int, default=None)
+
+    p = sub.add_parser('replay', help='classify stored features with a table')
+    p.add_argument('features')
+    p.add_argument('--rules', help='table JSON (default: built-in table)')
+
+    p = sub.add_parser('tune', help='tune thresholds against labelled features')
+    p.add_argument('features')
+    p.add_argument('--rules', help='starting table JSON (default: built-in table)')
+    p.add_argument('-o', '--output', default='tuned_color_rules.json')
+    p.add_argument('--rounds', type=int, default=3)
+    p.add_argument('--metric', choices=['accuracy', 'health'], default='accuracy')
+    p.add_argument('--holdout', type=float, default=0.2, help='fraction held out to check for overfitting')
+
+    p = sub.add_parser('export', help='write the built-in table as JSON')
+    p.add_argument('-o', '--output', default='color_rules.json')
+
+    args = parser.parse_args()
+
+    if args.command == 'extract':
+        extract_dataset(args.image_dir, args.output, args.workers)
+
+    elif args.command == 'export':
+        color_rules.save_table(color_rules.DEFAULT_TABLE, args.output)
+        print(f"[OK] Built-in table written to {args.output}")
+
+    else:
+        table = color_rules.load_table(args.rules) if args.rules else color_rules.DecisionTable()
+        X, labels = load_features(args.features)
+
+        if args.command == 'replay':
+            replay(table, X, labels)
+        else:
+            if labels is None:
+                parser.error('tuning needs labelled features')
+            tuned = tune(table.table, X, labels, args.rounds, args.metric, args.holdout)
+            color_rules.save_table(tuned, args.output)
+            print(f"[OK] Tuned table written to {args.output} (use COLOR_RULES_FILE={args.output})")
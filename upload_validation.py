@@ -0,0 +1,164 @@
+"""
+Upload Validation
+Checks an uploaded image from its first bytes, before anything is decoded:
+the format is sniffed from the magic bytes (the extension is not trusted) and
+the dimensions are read from the header, so corrupt files, decompression
+bombs and absurd shapes are rejected in microseconds.
+
+MAX_IMAGE_PIXELS is also installed as PIL's own Image.MAX_IMAGE_PIXELS, as
+a backstop for any image that reaches a decoder without passing through here.
+
+client_upload_config() tells browsers how far they can downscale a photo
+before uploading it (/upload_config): analysis works on 224x224, so a
+12 MP phone JPEG is mostly wasted bandwidth on a slow mobile link.
+"""
+
+import os
+import struct
+
+from PIL import Image, features
+
+import metrics
+
+# 100 MP covers current phone cameras; drone images above
+# tiled_analysis.MAX_DECODE_PIXELS are decoded at a reduced scale
+MAX_IMAGE_PIXELS = int(os.getenv('MAX_IMAGE_PIXELS', 100_000_000))
+MAX_ASPECT_RATIO = float(os.getenv('MAX_IMAGE_ASPECT_RATIO', 10))
+MIN_IMAGE_SIDE = int(os.getenv('MIN_IMAGE_SIDE', 16))
+
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+# Longest side clients are asked to downscale to. Analysis only needs 224
+# pixels; the rest keeps reports and history readable.
+CLIENT_MAX_DIMENSION = int(os.getenv('UPLOAD_MAX_DIMENSION', 1024))
+CLIENT_QUALITY = float(os.getenv('UPLOAD_QUALITY', 0.85))
+
+WEBP_SUPPORTED = features.check('webp')
+ACCEPTED_TYPES = ['image/jpeg', 'image/png'] + (['image/webp'] if WEBP_SUPPORTED else [])
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+JPEG_SIGNATURE = b'\xff\xd8\xff'
+
+# Start-of-frame markers carry the dimensions (C4, C8 and CC are not frames)
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# Metadata segments (EXIF, ICC, ...) before the frame header; real files have a handful
+MAX_JPEG_SEGMENTS = 64
+
+REJECTIONS = metrics.Counter('upload_rejections_total', 'Uploads rejected before decoding, by reason',
+                             ['reason'])
+
+
+class InvalidImage(ValueError):
+    """An upload that must not be decoded; reason is a short metric label"""
+
+    def __init__(self, message, reason):
+        super().__init__(message)
+        self.reason = reason
+
+
+def _jpeg_size(stream):
+    stream.seek(2)
+    for _ in range(MAX_JPEG_SEGMENTS):
+        if stream.read(1) != b'\xff':
+            break
+        marker = stream.read(1)
+        while marker == b'\xff':  # fill bytes
+            marker = stream.read(1)
+        if not marker:
+            break
+        code = marker[0]
+        if code in JPEG_SOF_MARKERS:
+            frame = stream.read(7)  # length, precision, height, width
+            if len(frame) < 7:
+                break
+            height, width = struct.unpack('>HH', frame[3:7])
+            return width, height
+        if code == 0x01 or 0xD0 <= code <= 0xD7:
+            continue  # standalone markers
+        if code in (0xD9, 0xDA):
+            break  # end of image or scan data before any frame header
+        length = stream.read(2)
+        if len(length) < 2 or struct.unpack('>H', length)[0] < 2:
+            break
+        stream.seek(struct.unpack('>H', length)[0] - 2, os.SEEK_CUR)
+    raise InvalidImage('Corrupted JPEG: no frame header found', 'corrupt')
+
+
+def _png_size(head):
+    if len(head) < 24 or head[12:16] != b'IHDR':
+        raise InvalidImage('Corrupted PNG: missing image header', 'corrupt')
+    return struct.unpack('>II', head[16:24])
+
+
+def _webp_size(head):
+    chunk = head[12:16]
+    if chunk == b'VP8 ' and head[23:26] == b'\x9d\x01\x2a':  # lossy
+        width, height = struct.unpack('<HH', head[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b'VP8L' and head[20] == 0x2F:  # lossless
+        bits = struct.unpack('<I', head[21:25])[0]
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b'VP8X':  # extended (alpha, animation, metadata)
+        return int.from_bytes(head[24:27], 'little') + 1, int.from_bytes(head[27:30], 'little') + 1
+    raise InvalidImage('Corrupted WebP: missing image header', 'corrupt')
+
+
+def read_header(stream):
+    """(format, width, height) from the first bytes of a seekable stream"""
+    start = stream.tell()
+    try:
+        stream.seek(0)
+        head = stream.read(32)
+        if head.startswith(JPEG_SIGNATURE):
+            return ('JPEG',) + _jpeg_size(stream)
+        if head.startswith(PNG_SIGNATURE):
+            return ('PNG',) + _png_size(head)
+        if head[:4] == b'RIFF' and head[8:12] == b'WEBP' and len(head) >= 30:
+            if not WEBP_SUPPORTED:
+                raise InvalidImage('WebP images are not supported by this server', 'format')
+            return ('WEBP',) + _webp_size(head)
+        raise InvalidImage('Unsupported or unrecognized image format. Please upload JPG, PNG or WebP',
+                           'format')
+    finally:
+        stream.seek(start)
+
+
+def validate_image(stream, max_pixels=MAX_IMAGE_PIXELS, partial=False):
+    """Check an upload without decoding it.
+
+    Returns (format, width, height); raises InvalidImage. The stream is left
+    at the position it was in. With partial=True (an upload still arriving)
+    a header that is cut short returns None instead.
+    """
+    try:
+        image_format, width, height = read_header(stream)
+
+        if min(width, height) < MIN_IMAGE_SIDE:
+            raise InvalidImage(f'Image is too small ({width}x{height}); '
+                               f'both sides must be at least {MIN_IMAGE_SIDE} pixels', 'too_small')
+        if width * height > max_pixels:
+            raise InvalidImage(f'Image is too large ({width}x{height}); '
+                               f'the limit is {max_pixels:,} pixels', 'too_large')
+        if max(width, height) / min(width, height) > MAX_ASPECT_RATIO:
+            raise InvalidImage(f'Image aspect ratio is too extreme ({width}x{height}); '
+                               f'the limit is {MAX_ASPECT_RATIO:g}:1', 'aspect')
+    except InvalidImage as e:
+        if partial and e.reason == 'corrupt':
+            return None
+        REJECTIONS.inc(e.reason)
+        raise
+
+    return image_format, width, height
+
+
+def client_upload_config(max_upload_bytes=None):
+    """What a browser should send: longest side, format and quality"""
+    return {
+        'max_dimension': CLIENT_MAX_DIMENSION,
+        'preferred_format': 'image/webp' if WEBP_SUPPORTED else 'image/jpeg',
+        'fallback_format': 'image/jpeg',
+        'quality': CLIENT_QUALITY,
+        'accepted_formats': ACCEPTED_TYPES,
+        'max_pixels': MAX_IMAGE_PIXELS,
+        'max_upload_bytes': max_upload_bytes,
+    }